@@ -15,7 +15,8 @@ CREATE TABLE fts_db.books_text ( id INTEGER PRIMARY KEY,
     text_size INTEGER NOT NULL DEFAULT 0,
     text_hash TEXT NOT NULL COLLATE NOCASE DEFAULT '',
     err_msg TEXT DEFAULT '',
-    UNIQUE(book, format)
+    spine_index INTEGER NOT NULL DEFAULT 0,
+    UNIQUE(book, format, spine_index)
 );
 
 
@@ -44,4 +45,4 @@ BEGIN
     DELETE FROM dirtied_formats WHERE book=NEW.book AND format=NEW.format;
 END;
 
-PRAGMA fts_db.user_version=1;
+PRAGMA fts_db.user_version=2;
@@ -17,6 +17,7 @@
 import uuid
 from contextlib import closing, suppress
 from functools import partial
+from threading import RLock
 from typing import Optional
 
 import apsw
@@ -79,6 +80,9 @@
 
 CUSTOM_DATA_TYPES = frozenset(('rating', 'text', 'comments', 'datetime',
     'int', 'float', 'bool', 'series', 'composite', 'enumeration'))
+# Tables that are always read when the library is opened, even with lazy table
+# loading, as they are needed for practically every operation
+EAGER_TABLES = frozenset(('uuid',))
 WINDOWS_RESERVED_NAMES = frozenset('CON PRN AUX NUL COM1 COM2 COM3 COM4 COM5 COM6 COM7 COM8 COM9 LPT1 LPT2 LPT3 LPT4 LPT5 LPT6 LPT7 LPT8 LPT9'.split())
 
 
@@ -447,6 +451,18 @@ def __init__(self, library_path, default_prefs=None, read_only=False,
                  restore_all_prefs=False, progress_callback=lambda x, y:True,
                  load_user_formatter_functions=True):
         self.is_closed = False
+        # Store the in-memory tables in compact arrays rather than dicts, uses
+        # much less memory for large libraries at the cost of slightly slower
+        # access. See calibre.db.columnar
+        self.columnar_tables = os.environ.get('CALIBRE_COLUMNAR_TABLES') == '1'
+        # Read the in-memory tables from metadata.db only when they are first
+        # used, so that opening a library is fast when only a few fields are
+        # needed. See read_tables()
+        self.lazy_tables = os.environ.get('CALIBRE_LAZY_TABLES') == '1'
+        self.lazy_tables_lock = RLock()
+        self.tables_being_loaded = set()
+        # Map of table name to the time in seconds taken to read it
+        self.table_load_times = {}
         if isbytestring(library_path):
             library_path = library_path.decode(filesystem_encoding)
         self.field_metadata = FieldMetadata()
@@ -597,12 +613,16 @@ def initialize_prefs(self, default_prefs, restore_all_prefs, progress_callback):
         defs['virtual_lib_on_startup'] = defs['cs_virtual_lib_on_startup'] = ''
         defs['virt_libs_hidden'] = defs['virt_libs_order'] = ()
         defs['update_all_last_mod_dates_on_start'] = False
+        defs['warm_composite_cache_on_start'] = False
         defs['field_under_covers_in_grid'] = 'title'
         defs['cover_browser_title_template'] = '{title}'
         defs['cover_browser_subtitle_field'] = 'rating'
         defs['styled_columns'] = {}
         defs['edit_metadata_ignore_display_order'] = False
         defs['fts_enabled'] = False
+        defs['fts_index_chapters'] = False
+        # The maximum number of characters of text indexed per book format, 0 for no limit
+        defs['fts_max_text_size'] = 16 * 1024 * 1024
 
         # Migrate the bool tristate tweak
         defs['bools_are_tristate'] = \
@@ -1107,6 +1127,10 @@ def commit_fts_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg):
         if self.fts is not None:
             return self.fts.commit_result(book_id, fmt, fmt_size, fmt_hash, text, err_msg)
 
+    def commit_fts_results(self, results):
+        if self.fts is not None:
+            return self.fts.commit_results(results)
+
     def fts_unindex(self, book_id, fmt=None):
         self.fts.unindex(book_id, fmt=fmt)
 
@@ -1114,10 +1138,15 @@ def reindex_fts_book(self, book_id, *fmts):
         return self.fts.dirty_book(book_id, *fmts)
 
     def fts_search(self,
-        fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids, return_text, process_each_result
+        fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids, return_text, process_each_result,
+        offset=0, limit=None
     ):
         yield from self.fts.search(
-            fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids, return_text, process_each_result)
+            fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids, return_text, process_each_result,
+            offset, limit)
+
+    def fts_count(self, fts_engine_query, use_stemming, restrict_to_book_ids):
+        return self.fts.count_matches(fts_engine_query, use_stemming, restrict_to_book_ids)
 
     def shutdown_fts(self):
         if self.fts_enabled:
@@ -1436,6 +1465,20 @@ def user_version(self):
     def user_version(self, val):
         self.execute('PRAGMA user_version=%d'%int(val))
 
+    @property
+    def data_version(self):
+        '''Changes whenever changes to the database are committed by any other
+        connection, including connections in other processes'''
+        return self.conn.get('PRAGMA data_version;', all=False)
+
+    def metadata_signature(self):
+        '''A value that changes when books are added or removed, when the
+        metadata of a book is changed, as that updates its last_modified, or
+        when the preferences are changed. Unlike data_version, it does not
+        change for changes to annotations, last read positions, etc.'''
+        books = self.conn.get('SELECT COUNT(*), MAX(id), MAX(last_modified) FROM books')[0]
+        return tuple(books) + (hash(tuple(self.conn.get('SELECT key, val FROM preferences'))),)
+
     def initialize_database(self):
         metadata_sqlite = P('metadata_sqlite.sql', data=True,
                 allow_user_override=False).decode('utf-8')
@@ -1551,19 +1594,62 @@ def last_modified(self):
 
     def read_tables(self):
         '''
-        Read all data from the db into the python in-memory tables
+        Read all data from the db into the python in-memory tables. When
+        lazy_tables is True, only the tables that are always needed are read
+        here, the rest are read when their data is first accessed, see
+        :meth:`load_lazy_table`.
         '''
 
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
             for table in itervalues(self.tables):
+                if self.lazy_tables and table.name not in EAGER_TABLES and table.metadata['datatype'] != 'composite':
+                    table.lazy_loader = self.load_lazy_table
+                    continue
                 try:
-                    table.read(self)
+                    self.read_table(table)
                 except:
                     prints('Failed to read table:', table.name)
                     import pprint
                     pprint.pprint(table.metadata)
                     raise
 
+    def read_table(self, table):
+        st = time.monotonic()
+        table.read(self)
+        if self.columnar_tables:
+            table.use_columnar_storage()
+        table.__dict__.pop('lazy_loader', None)
+        self.table_load_times[table.name] = time.monotonic() - st
+
+    def load_lazy_table(self, table):
+        ' Called by a table the first time its data is accessed, if it was not read by :meth:`read_tables` '
+        with self.lazy_tables_lock:
+            if 'lazy_loader' not in table.__dict__:
+                return  # loaded by another thread
+            if id(table) in self.tables_being_loaded:
+                raise AttributeError(f'The {table.name} table accessed its data while reading it')
+            self.tables_being_loaded.add(id(table))
+            try:
+                with self.conn:
+                    self.read_table(table)
+            except:
+                prints('Failed to read table:', table.name)
+                raise
+            finally:
+                self.tables_being_loaded.discard(id(table))
+
+    def load_all_tables(self):
+        ''' Read all tables not yet read because of lazy loading. Must be called
+        before changing the database, as reading a table later would see the
+        changes half made, for example, the links to books that have been
+        deleted would be missing. '''
+        if all('lazy_loader' not in table.__dict__ for table in itervalues(self.tables)):
+            return
+        with self.conn:
+            for table in itervalues(self.tables):
+                if 'lazy_loader' in table.__dict__:
+                    self.load_lazy_table(table)
+
     def find_path_for_book(self, book_id):
         q = BOOK_ID_PATH_TEMPLATE.format(book_id)
         for author_dir in os.scandir(self.library_path):
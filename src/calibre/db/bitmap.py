@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+A compact, immutable set of book ids, used by the search code for candidates,
+results and cached results. Book ids are small, dense integers, so the set is
+stored as a bytemap, with one byte per possible book id that is 1 if the id is
+in the set and 0 otherwise. This is many times smaller than a Python set, and
+the set operations are done a whole bytemap at a time by converting to
+arbitrary precision integers, so they run at C speed regardless of the size of
+the sets. Conversion to and from Python sets is also done without a Python
+level loop.
+'''
+
+from collections import deque
+from collections.abc import Set
+from itertools import compress, repeat
+
+
+def bytemap_from_ids(ids):
+    if isinstance(ids, BookIdSet):
+        return ids.bytemap
+    if not isinstance(ids, (set, frozenset, list, tuple)):
+        ids = tuple(ids)
+    if not ids:
+        return b''
+    ans = bytearray(max(ids) + 1)
+    # Set the bytes for all ids without a Python level loop
+    deque(map(ans.__setitem__, ids, repeat(1)), maxlen=0)
+    return bytes(ans)
+
+
+def as_int(bytemap):
+    return int.from_bytes(bytemap, 'little')
+
+
+def as_bytemap(val, size):
+    return val.to_bytes(size, 'little').rstrip(b'\0')
+
+
+class BookIdSet(Set):
+
+    '''
+    An immutable set of non-negative integers. Supports all the operations of
+    frozenset and can be freely mixed with sets and frozensets in binary
+    operations, the result is a BookIdSet, except when the left operand is a
+    plain set, when it is a set, so that in place operations such as
+    ``s -= ids`` leave s a mutable set. Use :meth:`as_set` to get a plain set.
+    '''
+
+    __slots__ = ('bytemap', 'count', 'hash_value')
+
+    def __init__(self, ids=()):
+        self.bytemap = bytemap_from_ids(ids).rstrip(b'\0')
+        self.count = self.bytemap.count(1)
+        self.hash_value = None
+
+    @classmethod
+    def from_bytemap(cls, bytemap):
+        ans = cls.__new__(cls)
+        ans.bytemap = bytemap
+        ans.count = bytemap.count(1)
+        ans.hash_value = None
+        return ans
+
+    @classmethod
+    def coerce(cls, ids):
+        return ids if isinstance(ids, cls) else cls(ids)
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __contains__(self, book_id):
+        try:
+            return book_id >= 0 and self.bytemap[book_id] == 1
+        except (IndexError, TypeError):
+            return False
+
+    def __iter__(self):
+        return compress(range(len(self.bytemap)), self.bytemap)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({sorted(self)!r})'
+
+    def __reduce__(self):
+        return self.__class__.from_bytemap, (self.bytemap,)
+
+    def __hash__(self):
+        # Must be the same as the hash of an equal frozenset, as they compare equal
+        if self.hash_value is None:
+            self.hash_value = self._hash()
+        return self.hash_value
+
+    def __eq__(self, other):
+        if isinstance(other, BookIdSet):
+            return self.bytemap == other.bytemap
+        return Set.__eq__(self, other)
+
+    def __ne__(self, other):
+        ans = self.__eq__(other)
+        return ans if ans is NotImplemented else not ans
+
+    def as_set(self):
+        return set(compress(range(len(self.bytemap)), self.bytemap))
+
+    def copy(self):
+        return self  # immutable
+
+    def __and__(self, other):
+        if not isinstance(other, BookIdSet):
+            if not isinstance(other, Set):
+                return NotImplemented
+            if len(other) < (self.count >> 4):
+                # Cheaper to test the few ids in other for membership
+                return BookIdSet(tuple(filter(self.__contains__, other)))
+            other = BookIdSet(other)
+        a, b = self.bytemap, other.bytemap
+        size = min(len(a), len(b))
+        return BookIdSet.from_bytemap(as_bytemap(as_int(a[:size]) & as_int(b[:size]), size))
+
+    def __rand__(self, other):
+        if isinstance(other, set):
+            return other & self.as_set()
+        return self.__and__(other)
+
+    def __or__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        a, b = self.bytemap, bytemap_from_ids(other)
+        size = max(len(a), len(b))
+        return BookIdSet.from_bytemap(as_bytemap(as_int(a) | as_int(b), size))
+
+    def __ror__(self, other):
+        if isinstance(other, set):
+            return other | self.as_set()
+        return self.__or__(other)
+
+    def __xor__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        a, b = self.bytemap, bytemap_from_ids(other)
+        size = max(len(a), len(b))
+        return BookIdSet.from_bytemap(as_bytemap(as_int(a) ^ as_int(b), size))
+
+    def __rxor__(self, other):
+        if isinstance(other, set):
+            return other ^ self.as_set()
+        return self.__xor__(other)
+
+    def __sub__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        a = self.bytemap
+        b = bytemap_from_ids(other)[:len(a)]
+        x = as_int(a)
+        return BookIdSet.from_bytemap(as_bytemap(x ^ (x & as_int(b)), len(a)))
+
+    def __rsub__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        if isinstance(other, set):
+            return other - self.as_set()
+        return BookIdSet(other) - self
+
+    def __le__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return len(self - other) == 0
+
+    def __ge__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return len(BookIdSet.coerce(other) - self) == 0
+
+    def __lt__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return len(self) < len(other) and self.__le__(other)
+
+    def __gt__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return len(self) > len(other) and self.__ge__(other)
+
+    def isdisjoint(self, other):
+        return not (self & BookIdSet.coerce(other))
+
+    # The named methods of frozenset, which accept arbitrary iterables
+
+    def intersection(self, *others):
+        ans = self
+        for x in others:
+            ans = ans & BookIdSet.coerce(x)
+        return ans
+
+    def union(self, *others):
+        ans = self
+        for x in others:
+            ans = ans | BookIdSet.coerce(x)
+        return ans
+
+    def difference(self, *others):
+        ans = self
+        for x in others:
+            ans = ans - BookIdSet.coerce(x)
+        return ans
+
+    def symmetric_difference(self, other):
+        return self ^ BookIdSet.coerce(other)
+
+    def issubset(self, other):
+        return self <= BookIdSet.coerce(other)
+
+    def issuperset(self, other):
+        return self >= BookIdSet.coerce(other)
@@ -18,7 +18,7 @@
 from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
 from queue import Queue
-from threading import Lock
+from threading import Lock, Thread, local
 from time import mktime, monotonic, sleep, time
 from typing import NamedTuple, Optional, Tuple
 
@@ -28,6 +28,8 @@
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
 from calibre.db.annotations import merge_annotations
 from calibre.db.categories import get_categories
+from calibre.db.category_index import CategoryIndex
+from calibre.db.composite_cache import CompositeCache, is_template_persistable, templates_signature
 from calibre.db.constants import NOTES_DIR_NAME
 from calibre.db.errors import NoSuchBook, NoSuchFormat
 from calibre.db.fields import IDENTITY, InvalidLinkTable, create_field
@@ -36,6 +38,8 @@
 from calibre.db.locking import DowngradeLockError, LockingError, SafeReadLock, create_locks, try_lock
 from calibre.db.notes.connect import copy_marked_up_text
 from calibre.db.search import Search
+from calibre.db.snapshot import SNAPSHOT_READ_APIS, prepare_snapshot, tables_changed_by
+from calibre.db.sort_index import SortKeyIndex
 from calibre.db.tables import VirtualTable
 from calibre.db.utils import type_safe_sort_key_function
 from calibre.db.write import get_series_values, uniq
@@ -91,6 +95,46 @@ def call_func_with_lock(*args, **kwargs):
     return call_func_with_lock
 
 
+def wrap_snapshot_read(cache, lock, name, func):
+    # Use the snapshot, if any, instead of waiting for a writer
+    shlock = lock._shlock
+
+    @wraps(func)
+    def call_func_with_snapshot(*args, **kwargs):
+        try:
+            got_lock = shlock.acquire(blocking=False, shared=True)
+        except DowngradeLockError:
+            # This thread is the writer
+            return func(*args, **kwargs)
+        if got_lock:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                shlock.release()
+        snapshot = cache.snapshot
+        if snapshot is None:
+            with lock:
+                return func(*args, **kwargs)
+        return getattr(snapshot, '_' + name)(*args, **kwargs)
+    return call_func_with_snapshot
+
+
+def wrap_snapshot_write(cache, lock, name, func):
+    # Record the tables the write can change, so that only they are copied
+    # into the snapshot, see calibre.db.snapshot
+    call_func_with_lock = wrap_simple(lock, func)
+    writing = cache.writing_tables
+
+    @wraps(func)
+    def call_func_recording_tables(*args, **kwargs):
+        writing.names = tables_changed_by(cache, name, args, kwargs)
+        try:
+            return call_func_with_lock(*args, **kwargs)
+        finally:
+            writing.names = None
+    return call_func_recording_tables
+
+
 def run_import_plugins(path_or_stream, fmt):
     fmt = fmt.lower()
     if hasattr(path_or_stream, 'seek'):
@@ -150,6 +194,7 @@ class Cache:
 
     def __init__(self, backend, library_database_instance=None):
         self.shutting_down = False
+        self.composite_cache_warmup_thread = None
         self.is_doing_rebuild_or_vacuum = False
         self.backend = backend
         self.library_database_instance = (None if library_database_instance is None else
@@ -157,7 +202,17 @@ def __init__(self, backend, library_database_instance=None):
         self.event_dispatcher = EventDispatcher()
         self.fields = {}
         self.composites = {}
-        self.read_lock, self.write_lock = create_locks()
+        self.is_snapshot = False
+        self.snapshot = None
+        self.snapshot_reads = os.environ.get('CALIBRE_SNAPSHOT_READS') == '1'
+        self.live_snapshots = weakref.WeakSet()
+        self.writing_tables = local()
+        if self.snapshot_reads:
+            self.read_lock, self.write_lock = create_locks(self._before_write, self._free_snapshot)
+        elif backend.lazy_tables:
+            self.read_lock, self.write_lock = create_locks(self._before_write)
+        else:
+            self.read_lock, self.write_lock = create_locks()
         self.format_metadata_cache = defaultdict(dict)
         self.formatter_template_cache = {}
         self.dirtied_cache = {}
@@ -169,6 +224,14 @@ def __init__(self, backend, library_database_instance=None):
         self.dirtied_sequence = 0
         self.cover_caches = set()
         self.clear_search_cache_count = 0
+        # The sort key index and composite values are not persisted when
+        # working on a temporary copy of metadata.db, as for read-only libraries
+        persist_caches = os.path.dirname(os.path.abspath(backend.dbpath)) == backend.library_path
+        self.sort_key_index = SortKeyIndex(backend.dbpath if persist_caches else None)
+        # The data_version of the db when this Cache last read it, see close()
+        self.synced_data_version = None
+        self.composite_cache = CompositeCache(backend.dbpath if persist_caches else None)
+        self.category_index = CategoryIndex()
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -182,7 +245,12 @@ def __init__(self, backend, library_database_instance=None):
                 setattr(self, '_'+name, func)
                 # Wrap it in a lock
                 lock = self.read_lock if ira else self.write_lock
-                setattr(self, name, wrap_simple(lock, func))
+                if self.snapshot_reads and name in SNAPSHOT_READ_APIS:
+                    setattr(self, name, wrap_snapshot_read(self, lock, name, func))
+                elif self.snapshot_reads and not ira:
+                    setattr(self, name, wrap_snapshot_write(self, lock, name, func))
+                else:
+                    setattr(self, name, wrap_simple(lock, func))
 
         self._search_api = Search(self, 'saved_searches', self.field_metadata.get_search_terms())
         self.initialize_dynamic()
@@ -192,6 +260,20 @@ def __init__(self, backend, library_database_instance=None):
     def new_api(self):
         return self
 
+    def _before_write(self):
+        # Called with the write lock held, before any changes are made. Tables
+        # not yet read must be read before the database is changed. Until the
+        # snapshot is ready readers wait for the lock, the snapshot copies
+        # only the tables the write can change, which is none for writes
+        # such as set_pref().
+        self.backend.load_all_tables()
+        if self.snapshot_reads:
+            prepare_snapshot(self, getattr(self.writing_tables, 'names', None))
+
+    def _free_snapshot(self):
+        # Called with the write lock held, after all changes have been made
+        self.snapshot = None
+
     @property
     def library_id(self):
         return self.backend.library_id
@@ -270,6 +352,50 @@ def initialize_template_cache(self):
     def set_user_template_functions(self, user_template_functions):
         self.backend.set_user_template_functions(user_template_functions)
 
+    def _initialize_composite_cache(self):
+        if not self.composites:
+            return
+        user_functions = self.backend.prefs.get('user_template_functions', [])
+        user_function_names = frozenset(x[0] for x in user_functions)
+        templates = {name: field.metadata['display']['composite_template'] for name, field in iteritems(self.composites)}
+        self.composite_cache.signature = templates_signature(templates, user_functions)
+        last_modified_table = self.fields['last_modified'].table
+        for name, field in iteritems(self.composites):
+            if is_template_persistable(name, templates, user_function_names):
+                field.use_persistent_cache(self.composite_cache, last_modified_table)
+
+    @api
+    def start_composite_cache_warmup(self):
+        '''
+        Render the values of all composite columns for all books in a
+        background thread, so that sorting and searching on them does not
+        have to wait for the templates to run. The read lock is released
+        between batches of books so that the library remains usable.
+        Returns the thread.
+        '''
+        t = self.composite_cache_warmup_thread = Thread(target=self._warm_composite_cache, name='WarmCompositeCache', daemon=True)
+        t.start()
+        return t
+
+    def _warm_composite_cache(self, batch_size=100):
+        book_ids = tuple(self.all_book_ids())
+        fields = tuple(self.composites.values())
+        try:
+            for i in range(0, len(book_ids), batch_size):
+                if self.shutting_down:
+                    return
+                with self.safe_read_lock:
+                    existing = self.fields['uuid'].table.book_col_map
+                    for book_id in book_ids[i:i+batch_size]:
+                        if book_id in existing:
+                            for field in fields:
+                                field.get_value_with_cache(book_id, self._get_proxy_metadata)
+            if not self.shutting_down:
+                self.composite_cache.flush()
+        except Exception:
+            if not self.shutting_down:
+                traceback.print_exc()
+
     @write_api
     def clear_composite_caches(self, book_ids=None):
         for field in itervalues(self.composites):
@@ -293,6 +419,16 @@ def clear_extra_files_cache(self, book_id=None):
     def last_modified(self):
         return self.backend.last_modified()
 
+    @read_api
+    def data_version(self):
+        ' A number that changes whenever another process commits changes to the database '
+        return self.backend.data_version
+
+    @read_api
+    def metadata_signature(self):
+        ' A value that changes whenever books, their metadata or the preferences are changed, by any process '
+        return self.backend.metadata_signature()
+
     @write_api
     def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
         if template_cache:
@@ -307,6 +443,8 @@ def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
             self.format_metadata_cache.clear()
         if search_cache:
             self._clear_search_caches(book_ids)
+        self.sort_key_index.invalidate(book_ids)
+        self.category_index.invalidate(book_ids)
         self._clear_link_map_cache(book_ids)
 
     @write_api
@@ -325,8 +463,9 @@ def reload_from_db(self, clear_caches=True):
             self.backend.prefs.load_from_db()
             self._search_api.saved_searches.load_from_db()
             for field in itervalues(self.fields):
-                if hasattr(field, 'table'):
-                    field.table.read(self.backend)  # Reread data from metadata.db
+                if hasattr(field, 'table') and field.table.is_loaded:
+                    self.backend.read_table(field.table)  # Reread data from metadata.db
+            self.synced_data_version = self.backend.data_version
 
     @property
     def field_metadata(self):
@@ -452,6 +591,11 @@ def init(self):
                     field.author_sort_field = self.fields['author_sort']
                 elif name == 'title':
                     field.title_sort_field = self.fields['sort']
+            self.sort_key_index.load()
+            self.synced_data_version = self.backend.data_version
+            self._initialize_composite_cache()
+        if self.composites and self.backend.prefs['warm_composite_cache_on_start']:
+            self.start_composite_cache_warmup()
         if self.backend.prefs['update_all_last_mod_dates_on_start']:
             self.update_last_modified(self.all_book_ids())
             self.backend.prefs.set('update_all_last_mod_dates_on_start', False)
@@ -487,7 +631,7 @@ def fts_start_measuring_rate(self, measure=True):
         self.fts_measuring_rate = monotonic() if measure else None
         self.fts_num_done_since_start = 0
 
-    def _update_fts_indexing_numbers(self, job_time=None):
+    def _update_fts_indexing_numbers(self, job_time=None, num_done=1):
         # this is called when new formats are added and when a format is
         # indexed, but NOT when books or formats are deleted, so total may not
         # be up to date.
@@ -496,7 +640,7 @@ def _update_fts_indexing_numbers(self, job_time=None):
         if not nl:
             self._fts_start_measuring_rate(measure=False)
         if job_time is not None and self.fts_measuring_rate is not None:
-            self.fts_num_done_since_start += 1
+            self.fts_num_done_since_start += num_done
         if (self.fts_indexing_left, self.fts_indexing_total) != (nl, nt) or job_time is not None:
             self.fts_indexing_left = nl
             self.fts_indexing_total = nt
@@ -596,6 +740,14 @@ def commit_fts_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg, sta
         self._update_fts_indexing_numbers(monotonic() - start_time)
         return ans
 
+    @write_api
+    def commit_fts_results(self, results):
+        ''' Commit the results of several indexing jobs in a single transaction.
+        results is a list of (book_id, fmt, fmt_size, fmt_hash, text, err_msg, start_time) '''
+        if results:
+            self.backend.commit_fts_results([r[:-1] for r in results])
+            self._update_fts_indexing_numbers(monotonic() - min(r[-1] for r in results), num_done=len(results))
+
     @write_api
     def reindex_fts_book(self, book_id, *fmts):
         if not self.is_fts_enabled():
@@ -629,6 +781,23 @@ def set_fts_num_of_workers(self, num):
             return True
         return False
 
+    @read_api
+    def fts_indexes_chapters(self):
+        return self.backend.prefs['fts_index_chapters']
+
+    @api
+    def set_fts_index_chapters(self, index_chapters=True):
+        ''' Store the text of every chapter (spine item) of a book in the full
+        text index separately, so that searches can return the matching
+        chapters, at the cost of a larger index. Changing this causes all books
+        to be re-indexed. '''
+        with self.write_lock:
+            if index_chapters == self.backend.prefs['fts_index_chapters']:
+                return False
+            self.backend.prefs['fts_index_chapters'] = index_chapters
+        self.reindex_fts()
+        return True
+
     @write_api
     def set_fts_speed(self, slow=True):
         orig = self.fts_indexing_sleep_time
@@ -655,7 +824,15 @@ def fts_search(
         return_text=True,
         result_type=tuple,
         process_each_result=None,
+        offset=0,
+        limit=None,
     ):
+        ''' Search the full text index. Results are sorted by relevance. Use
+        offset and limit to get only a page of the results. When return_text
+        is False, there is one result per matching book format, otherwise
+        there is one result per matching chapter when chapters are indexed
+        separately, see set_fts_index_chapters(). The spine_index of results
+        is the index of their chapter in the spine of the book. '''
         return result_type(self.backend.fts_search(
             fts_engine_query,
             use_stemming=use_stemming,
@@ -665,8 +842,17 @@ def fts_search(
             return_text=return_text,
             restrict_to_book_ids=restrict_to_book_ids,
             process_each_result=process_each_result,
+            offset=offset,
+            limit=limit,
         ))
 
+    @write_api  # see fts_search()
+    def fts_count(self, fts_engine_query, use_stemming=True, restrict_to_book_ids=None):
+        ''' Return the number of book formats matching the full text query,
+        without ranking them, for use with the offset and limit of fts_search()
+        when return_text is False '''
+        return self.backend.fts_count(fts_engine_query, use_stemming, restrict_to_book_ids)
+
     # }}}
 
     # Notes API {{{
@@ -1420,7 +1606,14 @@ def multisort(self, fields, ids_to_sort=None, virtual_fields=None):
         '''
         ids_to_sort = self._all_book_ids() if ids_to_sort is None else ids_to_sort
         get_metadata = self._get_proxy_metadata
-        lang_map = self.fields['languages'].book_value_map
+        bools_are_tristate = self.backend.prefs['bools_are_tristate']
+        lang_maps = []
+
+        def lang_map():
+            # Only needed when sort keys have to be calculated
+            if not lang_maps:
+                lang_maps.append(self.fields['languages'].book_value_map)
+            return lang_maps[0]
         virtual_fields = virtual_fields or {}
 
         fm = {'title':'sort', 'authors':'author_sort'}
@@ -1430,19 +1623,28 @@ def sort_key_func(field):
             idx = field + '_index'
             is_series = idx in self.fields
             try:
-                func = self.fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
+                f = self.fields[fm.get(field, field)]
             except KeyError:
                 if field == 'id':
                     return IDENTITY
                 else:
-                    return virtual_fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
-            if is_series:
-                idx_func = self.fields[idx].sort_keys_for_books(get_metadata, lang_map)
+                    return virtual_fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map())
+
+            def create_key_func():
+                func = f.sort_keys_for_books(get_metadata, lang_map())
+                if is_series:
+                    idx_func = self.fields[idx].sort_keys_for_books(get_metadata, lang_map())
 
-                def skf(book_id):
-                    return (func(book_id), idx_func(book_id))
-                return skf
-            return func
+                    def skf(book_id):
+                        return (func(book_id), idx_func(book_id))
+                    return skf
+                return func
+
+            if not f.sort_keys_indexable:
+                return create_key_func()
+            # Use the persistent sort key index so that sort keys are only
+            # calculated for books whose metadata has changed
+            return self.sort_key_index.key_func(field, repr((f.metadata, is_series, bools_are_tristate)), create_key_func)
 
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
@@ -1518,6 +1720,16 @@ def search(self, query, restriction='', virtual_fields=None, book_ids=None):
         '''
         return self._search_api(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids)
 
+    @read_api
+    def explain_search(self, query, restriction='', virtual_fields=None):
+        '''
+        Search the database for the specified query, without using the search
+        cache, returning the set of matched book ids and the plan used for
+        the search. See :meth:`calibre.db.search.Search.explain` for the
+        format of the plan.
+        '''
+        return self._search_api.explain(self, query, restriction, virtual_fields=virtual_fields)
+
     @read_api
     def books_in_virtual_library(self, vl, search_restriction=None, virtual_fields=None):
         ' Return the set of books in the specified virtual library '
@@ -1564,6 +1776,8 @@ def update_last_modified(self, book_ids, now=None):
             if self.composites:
                 self._clear_composite_caches(book_ids)
             self._clear_search_caches(book_ids)
+            self.sort_key_index.invalidate(book_ids)
+            self.category_index.invalidate(book_ids)
 
     @write_api
     def mark_as_dirty(self, book_ids):
@@ -1656,9 +1870,9 @@ def update_path(self, book_ids, mark_as_dirtied=True):
                 author = _('Unknown')
             self.backend.update_path(book_id, title, author, self.fields['path'], self.fields['formats'])
             self.format_metadata_cache.pop(book_id, None)
-            if mark_as_dirtied:
-                self._mark_as_dirty(book_ids)
-            self._clear_link_map_cache(book_ids)
+        if mark_as_dirtied:
+            self._mark_as_dirty(book_ids)
+        self._clear_link_map_cache(book_ids)
 
     @read_api
     def get_a_dirtied_book(self):
@@ -1917,6 +2131,153 @@ def protected_set_field(name, val):
             raise
         return dirtied
 
+    @write_api
+    def set_metadata_many(self, book_id_to_mi_map, ignore_errors=False, force_changes=False,
+                          set_title=True, set_authors=True, allow_case_change=False):
+        '''
+        Set metadata for many books at once from a mapping of book id to
+        `Metadata` object. The result is the same as calling
+        :meth:`set_metadata` for every book with the same arguments, but all
+        the values for a field are set with a single call to :meth:`set_field`
+        and all changes to metadata.db are made in a single transaction, which
+        is much faster for large numbers of books. Book folders are renamed and
+        covers are set after the transaction is committed. Returns the set of
+        ids of all changed books.
+        '''
+        dirtied = set()
+        book_id_to_mi_map = dict(book_id_to_mi_map)
+        for book_id, mi in iteritems(book_id_to_mi_map):
+            try:
+                # Handle code passing in an OPF object instead of a Metadata object
+                book_id_to_mi_map[book_id] = mi.to_book_metadata()
+            except (AttributeError, TypeError):
+                pass
+
+        def set_field(name, book_id_to_val_map, protected=True):
+            if not book_id_to_val_map:
+                return
+            try:
+                dirtied.update(self._set_field(name, book_id_to_val_map, do_path_update=False, allow_case_change=allow_case_change))
+            except Exception:
+                if not protected or not ignore_errors:
+                    raise
+                if len(book_id_to_val_map) == 1:
+                    traceback.print_exc()
+                else:
+                    # Find the books that caused the error
+                    for book_id, val in iteritems(book_id_to_val_map):
+                        set_field(name, {book_id: val})
+
+        title_map, authors_map = {}, {}
+        for book_id, mi in iteritems(book_id_to_mi_map):
+            if set_title and mi.title:
+                title_map[book_id] = mi.title
+            if set_authors:
+                if not mi.authors:
+                    mi.authors = [_('Unknown')]
+                authors = []
+                for a in mi.authors:
+                    authors += string_to_authors(a)
+                authors_map[book_id] = authors
+        path_changed = set(title_map) | set(authors_map)
+
+        covers = {}
+        for book_id, mi in iteritems(book_id_to_mi_map):
+            # force_changes has no effect on cover manipulation
+            try:
+                cdata = mi.cover_data[1]
+                if cdata is None and isinstance(mi.cover, string_or_bytes) and mi.cover and os.access(mi.cover, os.R_OK):
+                    with open(mi.cover, 'rb') as f:
+                        cdata = f.read() or None
+                if cdata is not None:
+                    covers[book_id] = cdata
+            except Exception:
+                if ignore_errors:
+                    traceback.print_exc()
+                else:
+                    raise
+
+        try:
+            with self.backend.conn:
+                set_field('title', title_map, protected=False)
+                set_field('authors', authors_map, protected=False)
+
+                # The values for each field, in the order set_metadata() sets them
+                field_maps = {field: {} for field in (
+                    'rating', 'series_index', 'timestamp', 'author_sort', 'publisher', 'series', 'tags',
+                    'comments', 'languages', 'pubdate', 'sort', 'identifiers')}
+                fm = self.field_metadata
+                for book_id, mi in iteritems(book_id_to_mi_map):
+                    for field in ('rating', 'series_index', 'timestamp'):
+                        val = getattr(mi, field)
+                        if val is not None:
+                            field_maps[field][book_id] = val
+
+                    authors_changed = book_id in authors_map
+                    val = mi.get('author_sort', None)
+                    if authors_changed and (not val or mi.is_null('author_sort')):
+                        val = self._author_sort_from_authors(mi.authors)
+                    if authors_changed or (force_changes and val is not None) or not mi.is_null('author_sort'):
+                        field_maps['author_sort'][book_id] = val
+
+                    for field in ('publisher', 'series', 'tags', 'comments', 'languages', 'pubdate'):
+                        val = mi.get(field, None)
+                        if (force_changes and val is not None) or not mi.is_null(field):
+                            field_maps[field][book_id] = val
+
+                    val = mi.get('title_sort', None)
+                    if (force_changes and val is not None) or not mi.is_null('title_sort'):
+                        field_maps['sort'][book_id] = val
+
+                    # identifiers will always be replaced if force_changes is True
+                    mi_idents = mi.get_identifiers()
+                    if force_changes:
+                        field_maps['identifiers'][book_id] = mi_idents
+                    elif mi_idents:
+                        identifiers = self._field_for('identifiers', book_id, default_value={})
+                        for key, val in iteritems(mi_idents):
+                            if val and val.strip():  # Don't delete an existing identifier
+                                identifiers[icu_lower(key)] = val
+                        field_maps['identifiers'][book_id] = identifiers
+
+                    user_mi = mi.get_all_user_metadata(make_copy=False)
+                    for key in user_mi:
+                        if (key in fm and user_mi[key]['datatype'] == fm[key]['datatype'] and (
+                            user_mi[key]['datatype'] != 'text' or (
+                                user_mi[key]['is_multiple'] == fm[key]['is_multiple']))):
+                            val = mi.get(key, None)
+                            if force_changes or val is not None:
+                                field_maps.setdefault(key, {})[book_id] = val
+                                idx = key + '_index'
+                                if idx in self.fields:
+                                    extra = mi.get_extra(key)
+                                    if extra is not None or force_changes:
+                                        field_maps.setdefault(idx, {})[book_id] = extra
+
+                for field, book_id_to_val_map in iteritems(field_maps):
+                    set_field(field, book_id_to_val_map)
+        except:
+            # sqlite will rollback the entire transaction, thanks to the with
+            # statement, so we have to re-read everything form the db to ensure
+            # the db and Cache are in sync
+            self._reload_from_db()
+            raise
+
+        if path_changed:
+            self._update_path(path_changed)
+        if covers:
+            try:
+                self._set_cover(covers)
+            except Exception:
+                if not ignore_errors:
+                    raise
+                for book_id, cdata in iteritems(covers):
+                    try:
+                        self._set_cover({book_id: cdata})
+                    except Exception:
+                        traceback.print_exc()
+        return dirtied
+
     def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None):
         path = self._field_for('path', book_id)
         if path is None:
@@ -2830,8 +3191,20 @@ def close(self):
                     except Exception:
                         traceback.print_exc()
         self._shutdown_fts(stage=2)
+        if self.composite_cache_warmup_thread is not None:
+            # The thread stops at the next batch, as shutting_down is set
+            self.composite_cache_warmup_thread.join()
+            self.composite_cache_warmup_thread = None
         with self.write_lock:
+            # If another process, such as another server process, has changed
+            # metadata.db since it was last read, the sort keys may be out of
+            # date and must not be saved. The composite values are safe, as
+            # they are only used for books whose last_modified is unchanged.
+            in_sync = self.backend.data_version == self.synced_data_version
             self.backend.close()
+            if in_sync:
+                self.sort_key_index.save()
+            self.composite_cache.close()
 
     @property
     def is_closed(self):
@@ -9,6 +9,7 @@
 from collections import OrderedDict
 from functools import partial
 
+from calibre.db.fields import BookValueGetter
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.config_base import prefs, tweaks
 from calibre.utils.icu import collation_order, sort_key
@@ -194,8 +195,11 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False)
 
     hierarchical_categories = frozenset(dbcache.pref('categories_using_hierarchy', ()))
     fm = dbcache.field_metadata
-    book_rating_map = dbcache.fields['rating'].book_value_map
-    lang_map = dbcache.fields['languages'].book_value_map
+    # Values are only needed for the books of items that are not in the
+    # category index
+    book_rating_map = BookValueGetter(dbcache.fields['rating'])
+    lang_map = BookValueGetter(dbcache.fields['languages'])
+    category_index = dbcache.category_index
 
     categories = OrderedDict()
     book_ids = frozenset(book_ids) if book_ids else book_ids
@@ -226,11 +230,11 @@ def get_metadata(book_id):
             dt = cat['datatype']
             if dt == 'rating':
                 if category != 'rating':
-                    brm = dbcache.fields[category].book_value_map
+                    brm = BookValueGetter(dbcache.fields[category])
                 if sort_on == 'name':
                     sort_on, reverse = 'rating', True
             cats = dbcache.fields[category].get_categories(
-                tag_class, brm, lang_map, book_ids)
+                tag_class, brm, lang_map, book_ids, aggregates=category_index.aggregates_for(dbcache.fields, category))
             if (category != 'authors' and dt == 'text' and
                 cat['is_multiple'] and cat['display'].get('is_names', False)):
                 for item in cats:
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+The per item data shown in the Tag browser (name, sort value and average
+rating), kept for all the many-one and many-many fields, so that it only has
+to be re-calculated for the items of books that have changed, instead of for
+every item every time the Tag browser is refreshed.
+'''
+
+from threading import Lock
+
+
+class CategoryIndex:
+
+    def __init__(self):
+        self.lock = Lock()
+        # Map of field name to a dict of item id to (number of books, name, sort value, average rating)
+        self.aggregates = {}
+        self.dirty_books = set()
+
+    def invalidate(self, book_ids=None):
+        ' Must be called with the ids of all books whose metadata is changed, or None if everything changed '
+        with self.lock:
+            if book_ids is None:
+                self.aggregates.clear()
+                self.dirty_books.clear()
+            elif self.aggregates:
+                self.dirty_books.update(book_ids)
+
+    def aggregates_for(self, fields, name):
+        '''
+        Return the aggregates dict for the field name, after removing the
+        items of all changed books from all fields. The aggregates for items
+        that have lost books are detected by the number of books not matching,
+        so only the items the changed books have now need to be removed.
+        '''
+        with self.lock:
+            if self.dirty_books:
+                dirty, self.dirty_books = self.dirty_books, set()
+                for field_name, aggregates in tuple(self.aggregates.items()):
+                    field = fields.get(field_name)
+                    if field is None:
+                        del self.aggregates[field_name]
+                        continue
+                    bcm = field.table.book_col_map
+                    for book_id in dirty:
+                        items = bcm.get(book_id)
+                        if items is not None:
+                            if field.is_many_many:
+                                for item_id in items:
+                                    aggregates.pop(item_id, None)
+                            else:
+                                aggregates.pop(items, None)
+            ans = self.aggregates.get(name)
+            if ans is None:
+                ans = self.aggregates[name] = {}
+            return ans
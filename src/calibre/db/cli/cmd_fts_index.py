@@ -104,7 +104,7 @@ def show_progress(left, total, rate):
     from calibre.db.utils import IndexingProgress
     ip = IndexingProgress()
     ip.update(left, total, rate)
-    print('\r\x1b[K' + _('{} of {} book files indexed, {}').format(total-left, total, ip.time_left), flush=True, end=' ...')
+    print('\r\x1b[K' + _('{} of {} book files indexed, {}, {}').format(total-left, total, ip.throughput, ip.time_left), flush=True, end=' ...')
 
 
 def remote_wait_for_completion(dbctx, indexing_speed):
@@ -5,12 +5,14 @@
 from calibre import prints
 
 readonly = True
-version = 0  # change this if you change signature of implementation()
+version = 1  # change this if you change signature of implementation()
 
 
-def implementation(db, notify_changes, query):
+def implementation(db, notify_changes, query, explain=False):
     from calibre.utils.search_query_parser import ParseException
     try:
+        if explain:
+            return db.explain_search(query)
         return db.search(query)
     except ParseException as err:
         e = ValueError(_('Failed to parse search query: ({0}) with error: {1}').format(query, err))
@@ -40,15 +42,37 @@ def option_parser(get_parser, args):
         type=int,
         help=_('The maximum number of results to return. Default is all results.')
     )
+    parser.add_option(
+        '--explain',
+        default=False,
+        action='store_true',
+        help=_('Print the order in which the terms of the search expression were evaluated,'
+               ' with the number of books each term was run on and the time it took.'
+               ' The search cache is not used.')
+    )
     return parser
 
 
+def print_plan(plan):
+    rows = [(_('Term'), _('Est. cost'), _('Candidates'), _('Matches'), _('Time (ms)'))]
+    for depth, term, cost, candidates, matches, elapsed in plan:
+        rows.append(('  ' * depth + term, f'{cost:g}', str(candidates), str(matches), f'{elapsed * 1000:.2f}'))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        prints(row[0].ljust(widths[0]), *(x.rjust(w) for x, w in zip(row[1:], widths[1:])), sep='  ')
+    prints()
+
+
 def main(opts, args, dbctx):
     if len(args) < 1:
         raise SystemExit(_('Error: You must specify the search expression'))
     q = ' '.join(args)
     try:
-        ids = dbctx.run('search', q)
+        if opts.explain:
+            ids, plan = dbctx.run('search', q, True)
+            print_plan(plan)
+        else:
+            ids = dbctx.run('search', q)
     except Exception as e:
         if getattr(e, 'suppress_traceback', False):
             raise SystemExit(str(e))
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Compact, array backed replacements for the dicts used by the in-memory tables
+in :mod:`calibre.db.tables`. They implement the same mapping interface as the
+dicts they replace, so the fields, writers and tables need not know which
+storage is in use. Book ids and item ids are small, dense integers, so they
+are used directly as indices into arrays, which avoids the per entry overhead
+of a dict slot plus a boxed int key, which is several times larger than
+the value itself for most columns.
+
+Mutations are applied to a small overlay on top of the packed arrays, which is
+folded back into the arrays once it grows large enough.
+'''
+
+from array import array
+from collections.abc import ItemsView, MutableMapping, ValuesView
+
+MISSING = -1
+COMPACT_THRESHOLD = 4096
+
+
+def new_index_array(size=0):
+    return array('i', (MISSING,)) * size
+
+
+def intern_values():
+    ''' Return a list of unique values and a function that maps a value to
+    its index in that list. Values that compare equal but have different
+    types, such as 1, 1.0 and True are kept separate. '''
+    pool, index_map = [], {}
+
+    def index_of(val):
+        try:
+            key = val.__class__, val
+            ans = index_map.get(key)
+        except TypeError:  # unhashable
+            ans = key = None
+        if ans is None:
+            ans = len(pool)
+            pool.append(val)
+            if key is not None:
+                index_map[key] = ans
+        return ans
+    return pool, index_of
+
+
+class FastItemsView(ItemsView):
+
+    def __iter__(self):
+        return self._mapping.iteritems()
+
+
+class FastValuesView(ValuesView):
+
+    def __iter__(self):
+        for k, v in self._mapping.iteritems():
+            yield v
+
+
+class ColumnMap(MutableMapping):
+
+    ''' Common code for mappings keyed by a dense integer id '''
+
+    __slots__ = ()
+
+    def items(self):
+        return FastItemsView(self)
+
+    def values(self):
+        return FastValuesView(self)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({dict(self.iteritems())!r})'
+
+    def clear(self):
+        self.__init__()
+
+
+class ValueColumn(ColumnMap):
+
+    '''
+    Replacement for the book_col_map of one-to-one tables. Every distinct
+    value is stored once in a pool and books refer to values by their index in
+    the pool. Overwritten values are left in the pool as garbage until there is
+    enough of it to be worth compacting.
+    '''
+
+    __slots__ = ('indices', 'pool', 'count', 'garbage')
+
+    def __init__(self, mapping=None):
+        self.indices, self.pool, self.count, self.garbage = new_index_array(), [], 0, 0
+        if mapping:
+            self.load(mapping)
+
+    def load(self, mapping):
+        self.pool, index_of = intern_values()
+        self.indices = new_index_array(max(mapping) + 1 if mapping else 0)
+        idx = self.indices
+        for book_id, val in mapping.items():
+            idx[book_id] = index_of(val)
+        self.count, self.garbage = len(mapping), 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, book_id):
+        try:
+            return book_id >= 0 and self.indices[book_id] > MISSING
+        except (IndexError, TypeError):
+            return False
+
+    def get(self, book_id, default=None):
+        try:
+            i = self.indices[book_id] if book_id >= 0 else MISSING
+        except (IndexError, TypeError):
+            return default
+        return default if i < 0 else self.pool[i]
+
+    def __getitem__(self, book_id):
+        try:
+            i = self.indices[book_id] if book_id >= 0 else MISSING
+        except (IndexError, TypeError):
+            i = MISSING
+        if i < 0:
+            raise KeyError(book_id)
+        return self.pool[i]
+
+    def __setitem__(self, book_id, val):
+        idx = self.indices
+        if book_id >= len(idx):
+            idx.extend(new_index_array(book_id + 1 - len(idx)))
+        if idx[book_id] < 0:
+            self.count += 1
+        else:
+            self.garbage += 1
+        idx[book_id] = len(self.pool)
+        self.pool.append(val)
+        self.maybe_compact()
+
+    def __delitem__(self, book_id):
+        if book_id not in self:
+            raise KeyError(book_id)
+        self.indices[book_id] = MISSING
+        self.count -= 1
+        self.garbage += 1
+        self.maybe_compact()
+
+    def update(self, other=(), **kw):
+        # Optimized for the common case of applying many values at once
+        if hasattr(other, 'items'):
+            other = other.items()
+        for book_id, val in other:
+            self[book_id] = val
+        for book_id, val in kw.items():
+            self[book_id] = val
+
+    def __iter__(self):
+        for book_id, i in enumerate(self.indices):
+            if i > MISSING:
+                yield book_id
+
+    def iteritems(self):
+        pool = self.pool
+        for book_id, i in enumerate(self.indices):
+            if i > MISSING:
+                yield book_id, pool[i]
+
+    def maybe_compact(self):
+        if self.garbage > COMPACT_THRESHOLD and self.garbage > len(self.pool) // 2:
+            self.load(dict(self.iteritems()))
+
+
+class IdColumn(ColumnMap):
+
+    '''
+    Replacement for the book_col_map of many-to-one tables, mapping book ids
+    to item ids, stored directly in an array.
+    '''
+
+    __slots__ = ('ids', 'count')
+
+    def __init__(self, mapping=None):
+        self.ids, self.count = new_index_array(), 0
+        if mapping:
+            self.ids = new_index_array(max(mapping) + 1)
+            for book_id, item_id in mapping.items():
+                self.ids[book_id] = item_id
+            self.count = len(mapping)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, book_id):
+        try:
+            return book_id >= 0 and self.ids[book_id] > MISSING
+        except (IndexError, TypeError):
+            return False
+
+    def get(self, book_id, default=None):
+        try:
+            ans = self.ids[book_id] if book_id >= 0 else MISSING
+        except (IndexError, TypeError):
+            return default
+        return default if ans < 0 else ans
+
+    def __getitem__(self, book_id):
+        ans = self.get(book_id, MISSING)
+        if ans == MISSING:
+            raise KeyError(book_id)
+        return ans
+
+    def __setitem__(self, book_id, item_id):
+        ids = self.ids
+        if book_id >= len(ids):
+            ids.extend(new_index_array(book_id + 1 - len(ids)))
+        if ids[book_id] < 0:
+            self.count += 1
+        ids[book_id] = item_id
+
+    def __delitem__(self, book_id):
+        if book_id not in self:
+            raise KeyError(book_id)
+        self.ids[book_id] = MISSING
+        self.count -= 1
+
+    def __iter__(self):
+        for book_id, item_id in enumerate(self.ids):
+            if item_id > MISSING:
+                yield book_id
+
+    def iteritems(self):
+        for book_id, item_id in enumerate(self.ids):
+            if item_id > MISSING:
+                yield book_id, item_id
+
+
+class LinkColumn(ColumnMap):
+
+    '''
+    Replacement for a mapping of integer ids to collections of integer ids,
+    stored in CSR form, that is, the ids linked to key are
+    targets[offsets[key]:offsets[key+1]]. Since the packed arrays cannot be
+    modified cheaply, changes are kept in an overlay dict, where a value of
+    None means the key has been deleted.
+
+    With as_sets=True this behaves like the defaultdict(set) used for the
+    col_book_map of many-one and many-many tables. Getting a value with
+    ``mapping[key]`` moves it into the overlay as a mutable set, so that code
+    such as ``col_book_map[item_id].add(book_id)`` works as expected. Use
+    ``mapping.get()`` or iterate over items() for read-only access, these
+    leave the packed arrays untouched and changes to the sets they return
+    may not be reflected in the mapping.
+
+    With as_sets=False this behaves like the dict of tuples used for the
+    book_col_map of many-many tables, preserving link order.
+    '''
+
+    __slots__ = ('offsets', 'targets', 'overlay', 'count', 'as_sets')
+
+    def __init__(self, mapping=None, as_sets=False):
+        self.as_sets = as_sets
+        self.overlay = {}
+        self.load(mapping or {})
+
+    def clear(self):
+        self.__init__(as_sets=self.as_sets)
+
+    def load(self, mapping):
+        self.overlay = {}
+        size = max(mapping) + 1 if mapping else 0
+        self.offsets = offsets = array('l', (0,)) * (size + 1)
+        self.targets = targets = array('i')
+        pos = 0
+        for key in range(size):
+            vals = mapping.get(key)
+            if vals:
+                targets.extend(sorted(vals) if self.as_sets else vals)
+                pos += len(vals)
+            offsets[key + 1] = pos
+        # Empty values cannot be represented in packed form, they are dropped
+        self.count = sum(1 for v in mapping.values() if v)
+
+    def packed(self, key):
+        ' Return the packed value for key as an array or None if not present '
+        try:
+            if key < 0:
+                return None
+            start, end = self.offsets[key], self.offsets[key + 1]
+        except (IndexError, TypeError):
+            return None
+        return self.targets[start:end] if end > start else None
+
+    def _lookup(self, key):
+        ans = self.overlay.get(key, MISSING) if self.overlay else MISSING
+        if ans is MISSING:
+            ans = self.packed(key)
+            if ans is None:
+                return MISSING
+            return set(ans) if self.as_sets else tuple(ans)
+        return MISSING if ans is None else ans
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self._lookup(key) is not MISSING
+
+    def get(self, key, default=None):
+        ans = self._lookup(key)
+        return default if ans is MISSING else ans
+
+    def __getitem__(self, key):
+        ans = self._lookup(key)
+        if ans is not MISSING and (not self.as_sets or key in self.overlay):
+            return ans
+        if not self.as_sets:
+            raise KeyError(key)
+        # Compact before adding to the overlay, as compacting would disconnect
+        # the returned set from this mapping
+        self.maybe_compact()
+        if ans is MISSING:
+            # defaultdict(set) semantics
+            ans = set()
+            self.count += 1
+        self.overlay[key] = ans
+        return ans
+
+    def __setitem__(self, key, val):
+        self.maybe_compact()
+        if self._lookup(key) is MISSING:
+            self.count += 1
+        self.overlay[key] = val
+
+    def __delitem__(self, key):
+        self.maybe_compact()
+        if self._lookup(key) is MISSING:
+            raise KeyError(key)
+        self.count -= 1
+        self.overlay[key] = None
+
+    def __iter__(self):
+        for key, val in self.iteritems():
+            yield key
+
+    def iteritems(self):
+        overlay, offsets, targets = self.overlay, self.offsets, self.targets
+        conv = set if self.as_sets else tuple
+        for key in range(len(offsets) - 1):
+            if key in overlay:
+                continue
+            start, end = offsets[key], offsets[key + 1]
+            if end > start:
+                yield key, conv(targets[start:end])
+        for key, val in tuple(overlay.items()):
+            if val is not None:
+                yield key, val
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def maybe_compact(self):
+        if len(self.overlay) > COMPACT_THRESHOLD and len(self.overlay) > len(self.offsets) // 8:
+            self.compact()
+
+    def compact(self):
+        ''' Fold the overlay back into the packed arrays. Note that this means
+        sets previously returned by ``mapping[key]`` are no longer live. '''
+        self.load(dict(self.iteritems()))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+An on-disk cache of the rendered values of composite columns, so that the
+templates do not have to be re-run for every book after a restart before
+composite columns can be sorted or searched. Values are stored with a hash
+of the templates and the last_modified date of the book they were rendered
+for, and are only used if both are unchanged.
+
+Only templates that depend solely on the metadata of the book are cached on
+disk, see :func:`is_template_persistable`.
+'''
+
+import hashlib
+import os
+import re
+from threading import Lock
+
+from calibre.constants import __version__
+from calibre.db.constants import CACHE_DIR_NAME
+
+COMPOSITE_CACHE_DB_NAME = 'composite-values.db'
+FLUSH_THRESHOLD = 1000
+# Template functions and fields whose values depend on something other than
+# the metadata of the book being rendered
+VOLATILE_TEMPLATE_NAMES = frozenset((
+    'today', 'book_count', 'book_values', 'virtual_libraries', 'current_virtual_library_name',
+    'connected_device_name', 'connected_device_uuid', 'ondevice', 'marked', 'in_tag_browser',
+    'has_extra_files', 'extra_file_names', 'extra_file_size', 'extra_file_modtime',
+    'annotation_count', 'current_library_name', 'current_library_path', 'formats_modtimes',
+    'formats_paths', 'formats_path_segments', 'selected_books', 'selected_column', 'show_dialog',
+    'get_note', 'has_note', 'get_link', 'is_dark_mode', 'globals', 'set_globals', 'user_categories',
+))
+
+
+def referenced_composites(template, templates):
+    ' The names of the composite columns from templates that template refers to '
+    names = frozenset(re.findall(r'#\w+', template))
+    return {name for name in names if name in templates}
+
+
+def is_template_persistable(name, templates, user_function_names=()):
+    '''
+    Return True if the value of the composite column name depends only on
+    the metadata of the book. templates is a mapping of the lookup names of
+    all composite columns to their templates, as the template of name can
+    refer to other composite columns, whose templates must also be
+    persistable.
+    '''
+    seen, pending = set(), [name]
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        template = templates[name]
+        if template.startswith('python:'):
+            return False
+        names = frozenset(re.findall(r'\w+', template))
+        if not names.isdisjoint(VOLATILE_TEMPLATE_NAMES) or not names.isdisjoint(user_function_names):
+            return False
+        pending.extend(referenced_composites(template, templates) - seen)
+    return True
+
+
+def templates_signature(templates, user_template_functions=()):
+    ' A hash of everything other than book metadata that rendered values depend on '
+    from calibre.utils.config_base import tweaks
+    from calibre.utils.localization import get_lang
+    data = repr((__version__, get_lang(), sorted(tweaks.items()), sorted(templates.items()), user_template_functions))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class CompositeCache:
+
+    def __init__(self, dbpath=None):
+        # If dbpath is None values are not persisted
+        self.path = None if dbpath is None else os.path.join(os.path.dirname(dbpath), CACHE_DIR_NAME, COMPOSITE_CACHE_DB_NAME)
+        self.lock = Lock()
+        self._conn = None
+        self.pending = {}
+        self.signature = ''
+
+    @property
+    def conn(self):
+        if self._conn is None and self.path is not None:
+            import apsw
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                conn = apsw.Connection(self.path)
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS composite_values (
+                    field TEXT NOT NULL,
+                    book INTEGER NOT NULL,
+                    signature TEXT NOT NULL,
+                    last_modified TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (field, book)
+                ) WITHOUT ROWID;
+                ''')
+                # Remove values rendered with templates that no longer apply
+                conn.execute('DELETE FROM composite_values WHERE signature != ?', (self.signature,))
+            except (OSError, apsw.Error):
+                # read-only library or corrupted cache, dont persist
+                import traceback
+                traceback.print_exc()
+                self.path = None
+            else:
+                self._conn = conn
+        return self._conn
+
+    def load(self, field, last_modified_map):
+        '''
+        Return a dict of book id to value for all values of field that were
+        rendered with the current templates for the current last_modified
+        date of the book.
+        '''
+        with self.lock:
+            self._flush()
+            conn = self.conn
+            if conn is None:
+                return {}
+            ans = {}
+            for book_id, last_modified, value in conn.execute(
+                    'SELECT book, last_modified, value FROM composite_values WHERE field=? AND signature=?', (field, self.signature)):
+                lm = last_modified_map.get(book_id)
+                if lm is not None and lm.isoformat() == last_modified:
+                    ans[book_id] = value
+            return ans
+
+    def store(self, field, book_id, last_modified, value):
+        if last_modified is None or self.path is None:
+            return
+        with self.lock:
+            self.pending[(field, book_id)] = (last_modified.isoformat(), value)
+            if len(self.pending) >= FLUSH_THRESHOLD:
+                self._flush()
+
+    def invalidate(self, field, book_ids):
+        if self.path is None:
+            return
+        with self.lock:
+            for book_id in book_ids:
+                self.pending[(field, book_id)] = None
+            if len(self.pending) >= FLUSH_THRESHOLD:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending or self.conn is None:
+            self.pending.clear()
+            return
+        pending, self.pending = self.pending, {}
+        removed = tuple(key for key, val in pending.items() if val is None)
+        added = tuple((field, book_id, self.signature) + val for (field, book_id), val in pending.items() if val is not None)
+        import apsw
+        try:
+            with self.conn:
+                if removed:
+                    self.conn.executemany('DELETE FROM composite_values WHERE field=? AND book=?', removed)
+                if added:
+                    self.conn.executemany(
+                        'INSERT OR REPLACE INTO composite_values (field, book, signature, last_modified, value) VALUES (?,?,?,?,?)', added)
+        except apsw.Error:
+            import traceback
+            traceback.print_exc()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            # Nothing is persisted after close, so that a late store or
+            # flush does not re-open the database
+            self.path = None
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -9,6 +9,7 @@
 DEFAULT_TRASH_EXPIRY_TIME_SECONDS = 14 * 86400
 TRASH_DIR_NAME =  '.caltrash'
 NOTES_DIR_NAME = '.calnotes'
+CACHE_DIR_NAME = '.calcache'
 NOTES_DB_NAME = 'notes.db'
 DATA_DIR_NAME = 'data'
 DATA_FILE_PATTERN = f'{DATA_DIR_NAME}/**/*'
@@ -62,6 +62,9 @@ class Field:
     is_many = False
     is_many_many = False
     is_composite = False
+    # Whether the sort keys for this field can be stored in the sort key
+    # index, that is, they change only when the metadata of the book changes
+    sort_keys_indexable = True
 
     def __init__(self, name, table, bools_are_tristate, get_template_functions):
         self.name, self.table = name, table
@@ -96,6 +99,10 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions):
 
         if self.name == 'languages':
             self._sort_key = lambda x:sort_key(calibre_langcode_to_name(x))
+        elif self.name in ('formats', 'size'):
+            # The tables for these are updated directly by the format
+            # management code, without marking books as changed
+            self.sort_keys_indexable = False
         self.is_multiple = (bool(self.metadata['is_multiple']) or self.name ==
                 'formats')
         self.sort_sort_key = True
@@ -167,17 +174,58 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         '''
         raise NotImplementedError()
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def restricted_col_book_map(self, book_ids):
+        '''
+        Return a map of item id to the ids of the books in book_ids that have
+        the item. Small sets of book ids, such as typical virtual libraries, are
+        handled by looking up the items for each book rather than intersecting
+        the book ids for every item.
+        '''
+        cbm = self.table.col_book_map
+        bcm = self.table.book_col_map
+        if len(book_ids) * 8 > len(bcm):
+            return {item_id: item_book_ids.intersection(book_ids) for item_id, item_book_ids in iteritems(cbm)}
+        ans = defaultdict(set)
+        if self.is_many_many:
+            for book_id in book_ids:
+                for item_id in bcm.get(book_id, ()):
+                    ans[item_id].add(book_id)
+        else:
+            for book_id in book_ids:
+                item_id = bcm.get(book_id)
+                if item_id is not None:
+                    ans[item_id].add(book_id)
+        return ans
+
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, aggregates=None):
+        '''
+        Return the tag browser items for this field. aggregates, if not None,
+        is a dict of item id to (number of books, name, sort value, average
+        rating) for all the books in the library. It is used for items whose
+        number of books is unchanged and updated for the rest, see
+        :class:`calibre.db.category_index.CategoryIndex`.
+        '''
         ans = []
         if not self.is_many:
             return ans
 
         id_map = self.table.id_map
         special_sort = hasattr(self, 'category_sort_value')
-        for item_id, item_book_ids in iteritems(self.table.col_book_map):
-            if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
-            if item_book_ids:
+        if book_ids is None:
+            col_book_map = self.table.col_book_map
+            full = True
+        else:
+            col_book_map = self.restricted_col_book_map(book_ids)
+            full = False
+        if aggregates is None:
+            aggregates = {}
+        cbm = self.table.col_book_map
+        for item_id, item_book_ids in iteritems(col_book_map):
+            if not item_book_ids:
+                continue
+            count = len(item_book_ids)
+            agg = aggregates.get(item_id)
+            if agg is None or agg[0] != count or (not full and count != len(cbm.get(item_id, ()))):
                 ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for
                                             book_id in item_book_ids) if r > 0)
                 avg = sum(ratings)/len(ratings) if ratings else 0
@@ -190,12 +238,36 @@ def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
                     raise InvalidLinkTable(self.name)
                 sval = (self.category_sort_value(item_id, item_book_ids, lang_map)
                     if special_sort else name)
-                c = tag_class(name, id=item_id, sort=sval, avg=avg,
-                              id_set=item_book_ids, count=len(item_book_ids))
-                ans.append(c)
+                agg = (count, name, sval, avg)
+                if full or count == len(cbm.get(item_id, ())):
+                    # The item is in all the books it is in in the library
+                    aggregates[item_id] = agg
+            c = tag_class(agg[1], id=item_id, sort=agg[2], avg=agg[3],
+                          id_set=item_book_ids, count=count)
+            ans.append(c)
         return ans
 
 
+class BookValueGetter:
+
+    '''
+    A mapping like object that returns the value of a field for books as
+    needed, for use instead of :attr:`book_value_map` when only the values for
+    a few books may be needed.
+    '''
+
+    __slots__ = ('field',)
+
+    def __init__(self, field):
+        self.field = field
+
+    def get(self, book_id, default=None):
+        try:
+            return self.field.for_book(book_id, default)
+        except KeyError:
+            raise InvalidLinkTable(self.field.name)
+
+
 class OneToOneField(Field):
 
     def for_book(self, book_id, default_value=None):
@@ -234,6 +306,7 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
 class CompositeField(OneToOneField):
 
     is_composite = True
+    sort_keys_indexable = False
     SIZE_SUFFIX_MAP = {suffix:i for i, suffix in enumerate(('', 'K', 'M', 'G', 'T', 'P', 'E'))}
 
     def __init__(self, name, table, bools_are_tristate, get_template_functions):
@@ -241,6 +314,9 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions):
 
         self._render_cache = {}
         self._lock = Lock()
+        # Set by the Cache if rendered values are to be stored on disk
+        self.persistent_cache = self.last_modified_table = None
+        self._persisted_loaded = False
         m = self.metadata
         self._composite_name = '#' + m['label']
         try:
@@ -303,15 +379,37 @@ def __render_composite(self, book_id, mi, formatter, template_cache):
             global_vars={rendering_composite_name:'1'}).strip()
         with self._lock:
             self._render_cache[book_id] = ans
+        if self.persistent_cache is not None:
+            self.persistent_cache.store(self.name, book_id, self.last_modified_table.book_col_map.get(book_id), ans)
+        return ans
+
+    def _cached_value(self, book_id):
+        with self._lock:
+            ans = self._render_cache.get(book_id, None)
+        if ans is None and self.persistent_cache is not None and not self._persisted_loaded:
+            self._persisted_loaded = True
+            vals = self.persistent_cache.load(self.name, self.last_modified_table.book_col_map)
+            with self._lock:
+                for k, v in vals.items():
+                    self._render_cache.setdefault(k, v)
+                ans = self._render_cache.get(book_id, None)
         return ans
 
+    def use_persistent_cache(self, persistent_cache, last_modified_table):
+        ''' Store rendered values in persistent_cache, a
+        :class:`calibre.db.composite_cache.CompositeCache`, so they can be
+        re-used after a restart as long as the last modified date of the book
+        does not change. '''
+        with self._lock:
+            self.persistent_cache, self.last_modified_table = persistent_cache, last_modified_table
+            self._persisted_loaded = False
+
     def _render_composite_with_cache(self, book_id, mi, formatter, template_cache):
         ''' INTERNAL USE ONLY. DO NOT USE METHOD DIRECTLY. INSTEAD USE
          db.composite_for() OR mi.get(). Those methods make sure there is no
          risk of infinite recursion when evaluating templates that refer to
          themselves. '''
-        with self._lock:
-            ans = self._render_cache.get(book_id, None)
+        ans = self._cached_value(book_id)
         if ans is None:
             return self.__render_composite(book_id, mi, formatter, template_cache)
         return ans
@@ -320,13 +418,17 @@ def clear_caches(self, book_ids=None):
         with self._lock:
             if book_ids is None:
                 self._render_cache.clear()
+                # Values on disk depend only on the metadata of the book,
+                # so they are still valid
+                self._persisted_loaded = False
             else:
                 for book_id in book_ids:
                     self._render_cache.pop(book_id, None)
+        if book_ids is not None and self.persistent_cache is not None:
+            self.persistent_cache.invalidate(self.name, book_ids)
 
     def get_value_with_cache(self, book_id, get_metadata):
-        with self._lock:
-            ans = self._render_cache.get(book_id, None)
+        ans = self._cached_value(book_id)
         if ans is None:
             mi = get_metadata(book_id)
             return self.__render_composite(book_id, mi, mi.formatter, mi.template_cache)
@@ -403,6 +505,8 @@ def get_books_for_val(self, value, get_metadata, book_ids):
 
 class OnDeviceField(OneToOneField):
 
+    sort_keys_indexable = False
+
     def __init__(self, name, table, bools_are_tristate, get_template_functions):
         self.name = name
         self.book_on_device_func = None
@@ -623,7 +727,7 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=()):
             if val:
                 yield val, {book_id}
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, aggregates=None):
         ans = []
 
         for id_key, item_book_ids in iteritems(self.table.col_book_map):
@@ -677,7 +781,7 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         for val, book_ids in iteritems(val_map):
             yield val, book_ids
 
-    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
+    def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None, aggregates=None):
         ans = []
 
         for fmt, item_book_ids in iteritems(self.table.col_book_map):
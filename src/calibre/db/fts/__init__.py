@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# Separates the texts of the spine items of a book in the output of the text
+# extraction workers
+CHAPTER_SEPARATOR = '\x1f'
@@ -14,6 +14,7 @@
 
 from calibre.db import FTSQueryError
 from calibre.db.annotations import unicode_normalize
+from calibre.db.fts import CHAPTER_SEPARATOR
 from calibre.utils.date import EPOCH, utcnow
 
 from .pool import Pool
@@ -98,22 +99,36 @@ def unindex(self, book_id, fmt=None):
         else:
             conn.execute('DELETE FROM books_text WHERE book=? AND format=?', (book_id, fmt.upper()))
 
+    @property
+    def index_chapters(self):
+        db = self.dbref()
+        return db is not None and db.backend.prefs['fts_index_chapters']
+
     def add_text(self, book_id, fmt, text, text_hash='', fmt_size=0, fmt_hash='', err_msg=''):
         conn = self.get_connection()
         ts = (utcnow() - EPOCH).total_seconds()
         fmt = fmt.upper()
         if err_msg:
+            conn.execute('DELETE FROM fts_db.books_text WHERE book=? AND format=? AND spine_index != 0', (book_id, fmt))
             conn.execute(
                 'INSERT OR REPLACE INTO fts_db.books_text '
                 '(book, timestamp, format, format_size, format_hash, err_msg) VALUES '
                 '(?, ?, ?, ?, ?, ?)', (
                     book_id, ts, fmt, fmt_size, fmt_hash, err_msg))
         elif text:
-            conn.execute(
+            chapters = text.split(CHAPTER_SEPARATOR)
+            if self.index_chapters:
+                # One row per spine item that has text
+                chapters = [(i, c) for i, c in enumerate(chapters) if c.strip()] or [(0, '')]
+            else:
+                chapters = [(0, '\n\n\n'.join(chapters))]
+            conn.execute('DELETE FROM fts_db.books_text WHERE book=? AND format=? AND spine_index NOT IN ({})'.format(
+                ','.join(str(i) for i, c in chapters)), (book_id, fmt))
+            conn.executemany(
                 'INSERT OR REPLACE INTO fts_db.books_text '
-                '(book, timestamp, format, format_size, format_hash, searchable_text, text_size, text_hash) VALUES '
-                '(?, ?, ?, ?, ?, ?, ?, ?)', (
-                    book_id, ts, fmt, fmt_size, fmt_hash, text, len(text), text_hash))
+                '(book, timestamp, format, format_size, format_hash, searchable_text, text_size, text_hash, spine_index) VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)', tuple(
+                    (book_id, ts, fmt, fmt_size, fmt_hash, c, len(c), text_hash, i) for i, c in chapters))
         else:
             conn.execute('DELETE FROM fts_db.dirtied_formats WHERE book=? AND format=?', (book_id, fmt))
 
@@ -133,6 +148,26 @@ def commit_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg=''):
                 break
         self.add_text(book_id, fmt, text, text_hash, fmt_size, fmt_hash, err_msg)
 
+    def commit_results(self, results):
+        conn = self.get_connection()
+        try:
+            with conn:  # a single transaction for all the results
+                for book_id, fmt, fmt_size, fmt_hash, text, err_msg in results:
+                    try:
+                        with conn:  # a savepoint, so that a failure undoes only this result
+                            self.commit_result(book_id, fmt, fmt_size, fmt_hash, text, err_msg)
+                    except Exception:
+                        # Record the failure, so that the format is not left
+                        # in progress, and re-queued, forever
+                        import traceback
+                        self.commit_result(book_id, fmt, fmt_size, fmt_hash, '', traceback.format_exc())
+        except Exception:
+            # Let the formats be indexed again
+            with suppress(Exception), conn:
+                conn.executemany('UPDATE fts_db.dirtied_formats SET in_progress=FALSE WHERE book=? AND format=?', tuple(
+                    (r[0], r[1]) for r in results))
+            raise
+
     def queue_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
         conn = self.get_connection()
         fmt = fmt.upper()
@@ -148,9 +183,15 @@ def queue_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
             os.remove(path)
         return False
 
+    def restriction_table(self, conn, restrict_to_book_ids):
+        temp_table_name = f'fts_restrict_search_{next(self.temp_table_counter)}'
+        conn.execute(f'CREATE TABLE temp.{temp_table_name}(x INTEGER)')
+        conn.executemany(f'INSERT INTO temp.{temp_table_name} VALUES (?)', tuple((x,) for x in restrict_to_book_ids))
+        return temp_table_name
+
     def search(self,
         fts_engine_query, use_stemming, highlight_start, highlight_end, snippet_size, restrict_to_book_ids,
-        return_text=True, process_each_result=None
+        return_text=True, process_each_result=None, offset=0, limit=None
     ):
         if restrict_to_book_ids is not None and not restrict_to_book_ids:
             return
@@ -166,20 +207,34 @@ def search(self,
             text = ', ' + text
         else:
             text = ''
-        query = 'SELECT {0}.id, {0}.book, {0}.format {1} FROM {0} '.format('books_text', text)
-        query += f' JOIN {fts_table} ON fts_db.books_text.id = {fts_table}.rowid'
-        query += ' WHERE '
+        join = f' FROM books_text JOIN {fts_table} ON fts_db.books_text.id = {fts_table}.rowid WHERE '
+        where = ''
         data = []
         conn = self.get_connection()
         temp_table_name = ''
         if restrict_to_book_ids:
-            temp_table_name = f'fts_restrict_search_{next(self.temp_table_counter)}'
-            conn.execute(f'CREATE TABLE temp.{temp_table_name}(x INTEGER)')
-            conn.executemany(f'INSERT INTO temp.{temp_table_name} VALUES (?)', tuple((x,) for x in restrict_to_book_ids))
-            query += f' fts_db.books_text.book IN temp.{temp_table_name} AND '
-        query += f' "{fts_table}" MATCH ?'
+            temp_table_name = self.restriction_table(conn, restrict_to_book_ids)
+            where += f' fts_db.books_text.book IN temp.{temp_table_name} AND '
+        where += f' "{fts_table}" MATCH ?'
         data.append(fts_engine_query)
-        query += f' ORDER BY {fts_table}.rank '
+        order = f' ORDER BY {fts_table}.rank '
+        select = f'SELECT books_text.id, books_text.book, books_text.format, books_text.spine_index {text}' + join
+        if not return_text:
+            # One result per book format, even when its chapters are indexed
+            # separately, ranked by the combined rank of the matching chapters
+            query = 'SELECT MIN(books_text.id), books_text.book, books_text.format, MIN(books_text.spine_index)' + join + where
+            query += f' GROUP BY books_text.book, books_text.format ORDER BY SUM({fts_table}.rank)'
+            if limit is not None or offset:
+                query += ' LIMIT ? OFFSET ?'
+                data.extend((-1 if limit is None else limit, offset))
+        elif limit is None and not offset:
+            query = select + where + order
+        else:
+            page = 'SELECT books_text.id' + join + where + order + ' LIMIT ? OFFSET ?'
+            data.extend((-1 if limit is None else limit, offset))
+            # Generate text only for the matches in the requested page
+            query = select + f' "{fts_table}" MATCH ? AND books_text.id IN ({page})' + order
+            data.insert(0, fts_engine_query)
         if temp_table_name:
             query += f'; DROP TABLE temp.{temp_table_name}'
         try:
@@ -188,7 +243,8 @@ def search(self,
                     'id': record[0],
                     'book_id': record[1],
                     'format': record[2],
-                    'text': record[3] if return_text else '',
+                    'spine_index': record[3],
+                    'text': record[4] if return_text else '',
                 }
                 if process_each_result is not None:
                     result = process_each_result(result)
@@ -198,5 +254,27 @@ def search(self,
         except apsw.SQLError as e:
             raise FTSQueryError(fts_engine_query, query, e) from e
 
+    def count_matches(self, fts_engine_query, use_stemming, restrict_to_book_ids):
+        if restrict_to_book_ids is not None and not restrict_to_book_ids:
+            return 0
+        fts_engine_query = unicode_normalize(fts_engine_query)
+        fts_table = 'books_fts' + ('_stemmed' if use_stemming else '')
+        conn = self.get_connection()
+        query = (
+            'SELECT COUNT(*) FROM (SELECT DISTINCT books_text.book, books_text.format'
+            f' FROM books_text JOIN {fts_table} ON fts_db.books_text.id = {fts_table}.rowid WHERE ')
+        temp_table_name = ''
+        if restrict_to_book_ids:
+            temp_table_name = self.restriction_table(conn, restrict_to_book_ids)
+            query += f' fts_db.books_text.book IN temp.{temp_table_name} AND '
+        query += f' "{fts_table}" MATCH ?)'
+        try:
+            return conn.get(query, (fts_engine_query,), all=False)
+        except apsw.SQLError as e:
+            raise FTSQueryError(fts_engine_query, query, e) from e
+        finally:
+            if temp_table_name:
+                conn.execute(f'DROP TABLE temp.{temp_table_name}')
+
     def shutdown(self):
         self.pool.shutdown()
@@ -2,16 +2,18 @@
 # License: GPL v3 Copyright: 2022, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import json
 import os
 import subprocess
 import sys
 import traceback
 from contextlib import suppress
-from queue import Queue
+from queue import Empty, Queue
 from threading import Event, Thread
 from time import monotonic
 
 from calibre import detect_ncpus, human_readable
+from calibre.ptempfile import PersistentTemporaryFile
 from calibre.utils.ipc.simple_worker import start_pipe_worker
 
 check_for_work = object()
@@ -20,13 +22,14 @@
 
 class Job:
 
-    def __init__(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
+    def __init__(self, book_id, fmt, path, fmt_size, fmt_hash, start_time, max_text_size=0):
         self.book_id = book_id
         self.fmt = fmt
         self.fmt_size = fmt_size
         self.fmt_hash = fmt_hash
         self.path = path
         self.start_time = start_time
+        self.max_text_size = max_text_size
 
 
 class Result:
@@ -49,11 +52,25 @@ def __init__(self, job, err_msg=''):
             self.text = err_msg
 
 
+def read_replies(stdout, replies):
+    try:
+        for line in stdout:
+            replies.put(json.loads(line))
+    except Exception:
+        traceback.print_exc()
+    finally:
+        replies.put(None)
+
+
 class Worker(Thread):
 
-    code_to_exec = 'from calibre.db.fts.text import main; main({!r})'
+    code_to_exec = 'from calibre.db.fts.text import serve; serve({}, {})'
     max_duration = 30  # minutes
     poll_interval = 0.1  # seconds
+    # Extraction processes are re-started after this many jobs, or once
+    # they use more than this much memory, in MB
+    max_jobs_per_process = 100
+    max_rss = 1024
 
     def __init__(self, jobs_queue, supervise_queue):
         super().__init__(name='FTSWorker', daemon=True)
@@ -62,61 +79,107 @@ def __init__(self, jobs_queue, supervise_queue):
         self.supervise_queue = supervise_queue
         self.keep_going = True
         self.working = False
+        self.process = self.replies = self.error_log = None
 
     def run(self):
-        while self.keep_going:
-            x = self.jobs_queue.get()
-            if x is quit:
-                break
-            self.working = True
-            try:
-                res = self.run_job(x)
-                if res is not None and self.keep_going:
-                    self.supervise_queue.put(res)
-            except Exception:
-                tb = traceback.format_exc()
-                traceback.print_exc()
-                if self.keep_going:
-                    self.supervise_queue.put(Result(x, tb))
-            finally:
-                self.working = False
+        try:
+            while self.keep_going:
+                x = self.jobs_queue.get()
+                if x is quit:
+                    break
+                self.working = True
+                try:
+                    res = self.run_job(x)
+                    if res is not None and self.keep_going:
+                        self.supervise_queue.put(res)
+                except Exception:
+                    tb = traceback.format_exc()
+                    traceback.print_exc()
+                    if self.keep_going:
+                        self.supervise_queue.put(Result(x, tb))
+                finally:
+                    self.working = False
+        finally:
+            self.stop_process(kill=not self.keep_going)
+
+    def start_process(self):
+        with PersistentTemporaryFile(suffix='-fts-worker.log') as error_log:
+            self.process = start_pipe_worker(
+                self.code_to_exec.format(self.max_jobs_per_process, self.max_rss), stderr=error_log, priority='low')
+        self.error_log = error_log.name
+        self.replies = Queue()
+        Thread(name='FTSWorkerReplies', daemon=True, target=read_replies, args=(self.process.stdout, self.replies)).start()
+
+    def stop_process(self, kill=False):
+        p, self.process = self.process, None
+        if p is None:
+            return
+        if not kill:
+            # the process exits once its stdin is closed
+            with suppress(OSError):
+                p.stdin.close()
+            with suppress(subprocess.TimeoutExpired):
+                p.wait(1)
+        if p.returncode is None:
+            p.kill()
+            p.wait()
+        with suppress(OSError):
+            p.stdin.close()
+        with suppress(OSError):
+            os.remove(self.error_log)
+
+    def process_errors(self):
+        with suppress(OSError), open(self.error_log, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 8192))
+            return f.read().decode('utf-8', 'replace')
+        return ''
 
     def run_job(self, job):
         time_limit = monotonic() + (self.max_duration * 60)
         txtpath = job.path + '.txt'
-        errpath = job.path + '.error'
         try:
-            with open(errpath, 'wb') as error:
-                p = start_pipe_worker(
-                    self.code_to_exec.format(job.path),
-                    stdout=subprocess.DEVNULL, stderr=error, stdin=subprocess.DEVNULL, priority='low',
-                )
-                while self.keep_going and monotonic() <= time_limit:
-                    with suppress(subprocess.TimeoutExpired):
-                        p.wait(self.poll_interval)
-                        break
-                if p.returncode is None:
-                    p.kill()
-                    if not self.keep_going:
-                        return
-                    return Result(job, _('Extracting text from the {0} file of size {1} took too long').format(
-                        job.fmt, human_readable(job.fmt_size)))
-                if os.path.exists(txtpath):
-                    return Result(job)
-            with open(errpath, 'rb') as f:
-                err = f.read().decode('utf-8', 'replace')
-                return Result(job, err)
+            if self.process is None:
+                self.start_process()
+            with suppress(OSError):  # if the process has died, there will be no reply
+                self.process.stdin.write(json.dumps((job.path, job.max_text_size)).encode('utf-8') + b'\n')
+                self.process.stdin.flush()
+            reply = timed_out = object()
+            while self.keep_going and monotonic() <= time_limit:
+                with suppress(Empty):
+                    reply = self.replies.get(timeout=self.poll_interval)
+                    break
+            if reply is timed_out:
+                self.stop_process(kill=True)
+                if not self.keep_going:
+                    return
+                return Result(job, _('Extracting text from the {0} file of size {1} took too long').format(
+                    job.fmt, human_readable(job.fmt_size)))
+            if reply is None:
+                err = self.process_errors()
+                self.stop_process(kill=True)
+                return Result(job, err or _('The text extraction process failed'))
+            if reply['exiting']:
+                self.stop_process()
+            if not reply['ok']:
+                return Result(job, reply['tb'])
+            return Result(job)
         finally:
             with suppress(OSError):
                 os.remove(job.path)
             with suppress(OSError):
                 os.remove(txtpath)
-            with suppress(OSError):
-                os.remove(errpath)
 
 
 class Pool:
 
+    # Indexing results are committed to the db once there are this many of
+    # them, or their text is this many bytes, or the oldest of them has waited
+    # this many seconds
+    batch_size = 32
+    batch_bytes = 8 * 1024 * 1024
+    batch_time = 2
+
     def __init__(self, dbref):
         self.max_workers = 1
         self.jobs_queue = Queue()
@@ -180,20 +243,25 @@ def check_for_work(self):
 
     def add_job(self, book_id, fmt, path, fmt_size, fmt_hash, start_time):
         self.initialize()
-        job = Job(book_id, fmt, path, fmt_size, fmt_hash, start_time)
+        db = self.dbref()
+        max_text_size = 0 if db is None else db.backend.prefs['fts_max_text_size']
+        job = Job(book_id, fmt, path, fmt_size, fmt_hash, start_time, max_text_size)
         self.jobs_queue.put(job)
 
-    def commit_result(self, result):
-        text = result.text
-        err_msg = ''
-        if not result.ok:
-            print(f'Failed to get text from book_id: {result.book_id} format: {result.fmt}', file=sys.stderr)
-            print(text, file=sys.stderr)
-            err_msg = text
-            text = ''
+    def commit_results(self, results):
+        batch = []
+        for result in results:
+            text = result.text
+            err_msg = ''
+            if not result.ok:
+                print(f'Failed to get text from book_id: {result.book_id} format: {result.fmt}', file=sys.stderr)
+                print(text, file=sys.stderr)
+                err_msg = text
+                text = ''
+            batch.append((result.book_id, result.fmt, result.fmt_size, result.fmt_hash, text, err_msg, result.start_time))
         db = self.dbref()
         if db is not None:
-            db.commit_fts_result(result.book_id, result.fmt, result.fmt_size, result.fmt_hash, text, err_msg, result.start_time)
+            db.commit_fts_results(batch)
 
     def shutdown(self):
         if self.initialized.is_set():
@@ -220,15 +288,41 @@ def do_check_for_work(self):
             db.queue_next_fts_job()
 
     def supervise(self):
+        # Results are committed in batches, in a single transaction per batch,
+        # as committing them one by one spends most of the time in fsync(). A
+        # batch that is lost, for example, because of a crash, is harmless, as
+        # the formats in it remain dirtied and are indexed again.
+        pending, pending_size, deadline = [], 0, 0
+
+        def commit_pending():
+            nonlocal pending, pending_size
+            batch, pending, pending_size = pending, [], 0
+            if batch:
+                self.commit_results(batch)
+
         while self.keep_going:
-            x = self.supervise_queue.get()
             try:
-                if x is check_for_work:
+                x = self.supervise_queue.get(timeout=max(0, deadline - monotonic()) if pending else None)
+            except Empty:
+                x = None
+            try:
+                if x is None:
+                    commit_pending()
+                elif x is check_for_work:
                     self.do_check_for_work()
                 elif x is quit:
                     break
                 elif isinstance(x, Result):
-                    self.commit_result(x)
+                    if not pending:
+                        deadline = monotonic() + self.batch_time
+                    pending.append(x)
+                    pending_size += len(x.text)
+                    if len(pending) >= self.batch_size or pending_size >= self.batch_bytes:
+                        commit_pending()
                     self.do_check_for_work()
             except Exception:
                 traceback.print_exc()
+        try:
+            commit_pending()
+        except Exception:
+            traceback.print_exc()
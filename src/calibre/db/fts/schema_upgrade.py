@@ -37,3 +37,48 @@ def user_version(self):
     @user_version.setter
     def user_version(self, val):
         self.conn.execute(f'PRAGMA fts_db.user_version={val}')
+
+    def upgrade_version_1(self):
+        ''' Allow storing the text of every spine item of a book in its own row '''
+        self.conn.execute('''
+CREATE TABLE fts_db.books_text_new ( id INTEGER PRIMARY KEY,
+    book INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    format TEXT NOT NULL COLLATE NOCASE,
+    format_hash TEXT NOT NULL COLLATE NOCASE,
+    format_size INTEGER NOT NULL DEFAULT 0,
+    searchable_text TEXT NOT NULL DEFAULT '',
+    text_size INTEGER NOT NULL DEFAULT 0,
+    text_hash TEXT NOT NULL COLLATE NOCASE DEFAULT '',
+    err_msg TEXT DEFAULT '',
+    spine_index INTEGER NOT NULL DEFAULT 0,
+    UNIQUE(book, format, spine_index)
+);
+-- the ids are preserved, so the full text indices remain valid
+INSERT INTO fts_db.books_text_new (id, book, timestamp, format, format_hash, format_size, searchable_text, text_size, text_hash, err_msg)
+    SELECT id, book, timestamp, format, format_hash, format_size, searchable_text, text_size, text_hash, err_msg FROM fts_db.books_text;
+DROP TABLE fts_db.books_text;
+ALTER TABLE fts_db.books_text_new RENAME TO books_text;
+
+CREATE TRIGGER fts_db.books_fts_insert_trg AFTER INSERT ON fts_db.books_text
+BEGIN
+    INSERT INTO books_fts(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+    INSERT INTO books_fts_stemmed(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+    DELETE FROM dirtied_formats WHERE book=NEW.book AND format=NEW.format;
+END;
+
+CREATE TRIGGER fts_db.books_fts_delete_trg AFTER DELETE ON fts_db.books_text
+BEGIN
+    INSERT INTO books_fts(books_fts, rowid, searchable_text) VALUES('delete', OLD.id, OLD.searchable_text);
+    INSERT INTO books_fts_stemmed(books_fts_stemmed, rowid, searchable_text) VALUES('delete', OLD.id, OLD.searchable_text);
+END;
+
+CREATE TRIGGER fts_db.books_fts_update_trg AFTER UPDATE ON fts_db.books_text
+BEGIN
+    INSERT INTO books_fts(books_fts, rowid, searchable_text) VALUES('delete', OLD.id, OLD.searchable_text);
+    INSERT INTO books_fts(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+    INSERT INTO books_fts_stemmed(books_fts_stemmed, rowid, searchable_text) VALUES('delete', OLD.id, OLD.searchable_text);
+    INSERT INTO books_fts_stemmed(rowid, searchable_text) VALUES (NEW.id, NEW.searchable_text);
+    DELETE FROM dirtied_formats WHERE book=NEW.book AND format=NEW.format;
+END;
+''')
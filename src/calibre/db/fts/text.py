@@ -2,11 +2,15 @@
 # License: GPL v3 Copyright: 2022, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import codecs
+import json
 import os
 import re
+import sys
 import unicodedata
 
 from calibre.customize.ui import plugin_for_input_format
+from calibre.db.fts import CHAPTER_SEPARATOR
 from calibre.ebooks.oeb.base import XPNSMAP, barename
 from calibre.ebooks.oeb.iterator.book import extract_book
 from calibre.ebooks.oeb.polish.container import Container as ContainerBase
@@ -14,6 +18,8 @@
 from calibre.ptempfile import TemporaryDirectory
 from calibre.utils.logging import default_log
 
+PDFTOTEXT_CHUNK_SIZE = 1024 * 1024
+
 
 class SimpleContainer(ContainerBase):
 
@@ -61,21 +67,38 @@ def is_fmt_ok(input_fmt):
     return input_plugin
 
 
-def pdftotext(path):
+def pdftotext(path, max_text_size=0):
     import subprocess
 
     from calibre.ebooks.pdf.pdftohtml import PDFTOTEXT, popen
     from calibre.utils.cleantext import clean_ascii_chars
     cmd = [PDFTOTEXT] + '-enc UTF-8 -nodiag -eol unix'.split() + [os.path.basename(path), '-']
     p = popen(cmd, cwd=os.path.dirname(path), stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
-    raw = p.stdout.read()
-    p.stdout.close()
-    if p.wait() != 0:
+    # Read the output in chunks so that at most max_text_size characters are
+    # ever held in memory, no matter how large the PDF is
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    chunks, size, truncated = [], 0, False
+    with p.stdout:
+        while not truncated:
+            raw = p.stdout.read(PDFTOTEXT_CHUNK_SIZE)
+            if not raw:
+                break
+            # the control chars are all ASCII, so they can be removed before decoding
+            text = decoder.decode(clean_ascii_chars(raw))
+            size += len(text)
+            if max_text_size and size >= max_text_size:
+                text = text[:len(text) - (size - max_text_size)]
+                truncated = True
+                p.kill()
+            chunks.append(text)
+    if p.wait() != 0 and not truncated:
         return ''
-    return clean_ascii_chars(raw).decode('utf-8', 'replace')
+    if not truncated:
+        chunks.append(decoder.decode(b'', True))
+    return ''.join(chunks)
 
 
-def extract_text(pathtoebook):
+def extract_text(pathtoebook, max_text_size=0):
     input_fmt = pathtoebook.rpartition('.')[-1].upper()
     ans = ''
     input_plugin = is_fmt_ok(input_fmt)
@@ -83,7 +106,7 @@ def extract_text(pathtoebook):
         return ans
     input_plugin = plugin_for_input_format(input_fmt)
     if input_fmt == 'PDF':
-        ans = pdftotext(pathtoebook)
+        ans = pdftotext(pathtoebook, max_text_size)
     else:
         with TemporaryDirectory() as tdir:
             texts = []
@@ -93,13 +116,48 @@ def extract_text(pathtoebook):
             if is_comic:
                 return ''
             container = SimpleContainer(tdir, opfpath, default_log)
+            size = 0
             for name, is_linear in container.spine_names:
-                texts.extend(to_text(container, name))
-            ans = '\n\n\n'.join(texts)
+                text = '\n\n\n'.join(to_text(container, name)).replace(CHAPTER_SEPARATOR, '')
+                if max_text_size and size + len(text) >= max_text_size:
+                    texts.append(text[:max_text_size - size])
+                    break
+                size += len(text)
+                texts.append(text)
+            # The text of every spine item is kept, even if empty, so that
+            # the chapters can be mapped back to spine indices
+            ans = CHAPTER_SEPARATOR.join(texts)
     return unicodedata.normalize('NFC', ans).replace('\u00ad', '')
 
 
-def main(pathtoebook):
-    text = extract_text(pathtoebook)
+def main(pathtoebook, max_text_size=0):
+    text = extract_text(pathtoebook, max_text_size)
     with open(pathtoebook + '.txt', 'wb') as f:
         f.write(text.encode('utf-8'))
+
+
+def serve(max_jobs, max_rss):
+    ''' Run in a long lived worker process. Extracts text from the books whose
+    paths are sent as JSON lines on stdin and replies to each with a JSON line
+    on stdout. Exits after max_jobs jobs or once the memory used by the process
+    exceeds max_rss MB, setting exiting in the last reply. '''
+    from calibre.utils.mem import memory
+    # The conversion code can print to stdout, keep it for the replies only
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    num_done = 0
+    for line in sys.stdin.buffer:
+        path, max_text_size = json.loads(line)
+        result = {'ok': True}
+        try:
+            main(path, max_text_size)
+        except Exception as e:
+            import traceback
+            result = {'ok': False, 'err': str(e), 'tb': traceback.format_exc()}
+        num_done += 1
+        result['exiting'] = num_done >= max_jobs or memory() > max_rss
+        print(json.dumps(result), file=replies, flush=True)
+        if result['exiting']:
+            break
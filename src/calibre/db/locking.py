@@ -10,6 +10,7 @@
 import traceback
 from contextlib import contextmanager
 from threading import Condition, Lock, current_thread
+from time import monotonic
 
 
 @contextmanager
@@ -35,7 +36,7 @@ class DowngradeLockError(LockingError):
     pass
 
 
-def create_locks():
+def create_locks(before_write=None, after_write=None):
     '''
     Return a pair of locks: (read_lock, write_lock)
 
@@ -56,8 +57,15 @@ def create_locks():
     B. Bad things will happen if you violate this rule, the most benign of
     which is the raising of a LockingError (I haven't been able to eliminate
     the possibility of deadlocking in this scenario).
+
+    If before_write is not None, it is called every time a thread acquires
+    the write_lock when it does not already hold it, after the lock has been
+    acquired. Similarly, after_write is called when the thread releases the
+    write_lock for the last time, just before the lock is released.
     '''
     l = SHLock()
+    if before_write is not None or after_write is not None:
+        return RWLockWrapper(l), SnapshotWriteLock(l, before_write, after_write)
     wrapper = DebugRWLockWrapper if os.environ.get('CALIBRE_DEBUG_DB_LOCKING') == '1' else RWLockWrapper
     return wrapper(l), wrapper(l, is_shared=False)
 
@@ -89,6 +97,9 @@ def __init__(self):
         self._exclusive_queue = []
         #  This is for recycling waiter objects.
         self._free_waiters = []
+        #  The number of times threads had to wait for the lock and the
+        #  total time they waited, in seconds, for each mode
+        self._waits = {'shared': [0, 0.], 'exclusive': [0, 0.]}
 
     def acquire(self, blocking=True, shared=False):
         '''
@@ -173,12 +184,14 @@ def _acquire_shared(self, blocking=True):
             if not blocking:
                 return False
             waiter = self._take_waiter()
+            start = monotonic()
             try:
                 self._shared_queue.append((me, waiter))
                 waiter.wait()
                 assert not self.is_exclusive
             finally:
                 self._return_waiter(waiter)
+                self._record_wait('shared', start)
         else:
             self.is_shared += 1
             self._shared_owners[me] = 1
@@ -200,11 +213,13 @@ def _acquire_exclusive(self, blocking=True):
             if not blocking:
                 return False
             waiter = self._take_waiter()
+            start = monotonic()
             try:
                 self._exclusive_queue.append((me, waiter))
                 waiter.wait()
             finally:
                 self._return_waiter(waiter)
+                self._record_wait('exclusive', start)
         else:
             self._exclusive_owner = me
             self.is_exclusive += 1
@@ -219,6 +234,16 @@ def _take_waiter(self):
     def _return_waiter(self, waiter):
         self._free_waiters.append(waiter)
 
+    def _record_wait(self, mode, start):
+        w = self._waits[mode]
+        w[0] += 1
+        w[1] += monotonic() - start
+
+    def wait_stats(self):
+        ' Return {mode: (number of waits, total wait time in seconds)} for the shared and exclusive modes '
+        with self._lock:
+            return {k: tuple(v) for k, v in self._waits.items()}
+
 # }}}
 
 
@@ -240,6 +265,40 @@ def release(self, *args):
     def owns_lock(self):
         return self._shlock.owns_lock()
 
+    def wait_stats(self):
+        return self._shlock.wait_stats()
+
+
+class SnapshotWriteLock(RWLockWrapper):
+
+    ''' An exclusive lock that calls before_write() on the outermost
+    acquisition and after_write() on the outermost release, used to create
+    and free the snapshot of the data that readers use while a writer holds
+    the lock. '''
+
+    def __init__(self, shlock, before_write=None, after_write=None):
+        RWLockWrapper.__init__(self, shlock, is_shared=False)
+        self.before_write, self.after_write = before_write, after_write
+
+    def acquire(self):
+        self._shlock.acquire(shared=False)
+        if self.before_write is not None and self._shlock.is_exclusive == 1:
+            try:
+                self.before_write()
+            except Exception:
+                traceback.print_exc()
+
+    def release(self, *args):
+        if self.after_write is not None and self._shlock.is_exclusive == 1:
+            try:
+                self.after_write()
+            except Exception:
+                traceback.print_exc()
+        self._shlock.release()
+
+    __enter__ = acquire
+    __exit__ = release
+
 
 class DebugRWLockWrapper(RWLockWrapper):
 
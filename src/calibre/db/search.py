@@ -10,10 +10,12 @@
 from collections import OrderedDict, deque
 from datetime import timedelta
 from functools import partial
+from time import monotonic
 
 import regex
 
 from calibre.constants import DEBUG, preferred_encoding
+from calibre.db.bitmap import BookIdSet
 from calibre.db.utils import force_to_bool
 from calibre.utils.config_base import prefs
 from calibre.utils.date import UNDEFINED_DATE, dt_as_local, now, parse_date
@@ -472,6 +474,27 @@ def names(self):
 # }}}
 
 
+# Query planner costs {{{
+# The approximate relative cost of matching a query against a single value,
+# used to decide the order in which the terms of an and are evaluated.
+PRESENCE_COST = 0.5  # field:true and field:false
+EXACT_COST = 1
+CONTAINS_COST = 2
+REGEXP_COST = 5
+LONG_TEXT_FACTOR = 4  # comments columns, where values are long
+COMPOSITE_COST = 50  # rendering the template for a composite column
+TEMPLATE_COST = 200  # template: searches run the template for every book
+SAVED_SEARCH_COST = 20  # unknown, as it depends on the saved search
+SPECIAL_LOCATIONS = frozenset(('all', 'search', 'template', 'vl'))
+
+
+def describe_term(tree):
+    if tree[0] == 'token':
+        return f'{tree[1]}:{tree[2]}'
+    return tree[0]
+# }}}
+
+
 class Parser(SearchQueryParser):  # {{{
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
@@ -485,6 +508,8 @@ def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
         self.limit_search_columns, self.limit_search_columns_to = (
             limit_search_columns, limit_search_columns_to)
         self.virtual_fields = virtual_fields or {}
+        # Set to a list to record the plan used when evaluating a query
+        self.explain, self.explain_depth = None, 0
         if 'marked' not in self.virtual_fields:
             self.virtual_fields['marked'] = self
         if 'in_tag_browser' not in self.virtual_fields:
@@ -515,6 +540,95 @@ def parse(self, *args, **kwargs):
         self.virtual_field_used = False
         return SearchQueryParser.parse(self, *args, **kwargs)
 
+    def evaluate(self, parse_result, candidates):
+        if self.explain is None:
+            return SearchQueryParser.evaluate(self, parse_result, candidates)
+        row = [self.explain_depth, describe_term(parse_result),
+               self.estimate_cost(parse_result, len(candidates)), len(candidates), 0, 0]
+        self.explain.append(row)
+        self.explain_depth += 1
+        st = monotonic()
+        try:
+            ans = SearchQueryParser.evaluate(self, parse_result, candidates)
+        finally:
+            self.explain_depth -= 1
+        row[4], row[5] = len(ans), monotonic() - st
+        return ans
+
+    def evaluate_and(self, argument, candidates):
+        # Evaluate the terms of a chain of ands in order of increasing cost, so
+        # that cheap terms narrow the candidates before expensive terms are
+        # run, stopping as soon as there are no candidates left. As and is
+        # commutative, this does not change the result.
+        terms = []
+        stack = list(reversed(argument))
+        while stack:
+            term = stack.pop()
+            if term[0] == 'and':
+                stack.extend(reversed(term[1:]))
+            else:
+                terms.append(term)
+        num_candidates = len(candidates)
+        terms.sort(key=lambda term: self.estimate_cost(term, num_candidates))
+        for term in terms:
+            if not candidates:
+                break
+            candidates = candidates.intersection(self.evaluate(term, candidates))
+        return candidates
+
+    def estimate_cost(self, tree, num_candidates):
+        ''' Estimate the cost of evaluating the parse tree over the specified
+        number of candidates, using the number of distinct values in the
+        tables of the searched fields. '''
+        if tree[0] == 'token':
+            return self.term_cost(tree[1], tree[2], num_candidates)
+        if tree[0] == 'not':
+            return self.estimate_cost(tree[1], num_candidates)
+        return sum(self.estimate_cost(x, num_candidates) for x in tree[1:])
+
+    def term_cost(self, location, query, num_candidates, allow_recursion=True):
+        location = icu_lower(location.strip())
+        if location == 'template':
+            return TEMPLATE_COST * num_candidates
+        if location == 'search':
+            return SAVED_SEARCH_COST * num_candidates
+        if location == 'vl':
+            # Virtual library searches are usually cached
+            return EXACT_COST * num_candidates
+        if location == 'all':
+            return sum(self.term_cost(loc, query, num_candidates, allow_recursion=False)
+                       for loc in self.all_search_locations if loc not in SPECIAL_LOCATIONS)
+        if len(location) > 1 and location.startswith('@'):
+            location = location[1:]
+        key = self.field_metadata.search_term_to_field_key(location)
+        if isinstance(key, list):  # grouped search term
+            if not allow_recursion:
+                return CONTAINS_COST * num_candidates
+            return sum(self.term_cost(loc, query, num_candidates, allow_recursion=False) for loc in key)
+        field = self.dbcache.fields.get(key)
+        if field is None:  # virtual fields and user categories
+            return EXACT_COST * num_candidates
+        q = query.strip().lower()
+        if q in ('true', 'false'):
+            cost = PRESENCE_COST
+        elif q.startswith('~'):
+            cost = REGEXP_COST
+        elif q.startswith('='):
+            cost = EXACT_COST
+        else:
+            cost = CONTAINS_COST
+        if field.is_composite:
+            cost += COMPOSITE_COST
+        elif field.metadata['datatype'] == 'comments':
+            cost *= LONG_TEXT_FACTOR
+        num_values = num_candidates
+        col_book_map = getattr(field.table, 'col_book_map', None)
+        if col_book_map is not None:
+            # Fields with a separate table of values are searched by matching
+            # each distinct value once
+            num_values = min(num_values, len(col_book_map))
+        return cost * num_values
+
     def get_matches(self, location, query, candidates=None,
                     allow_recursion=True):
         # If candidates is not None, it must not be modified. Changing its
@@ -868,6 +982,11 @@ def __len__(self):
     def __getitem__(self, key):
         return self.get(key)
 
+    def replace(self, key, val):
+        'Change the value for an existing key, without changing its age'
+        if key in self.item_map:
+            self.item_map[key] = val
+
     def __iter__(self):
         return iteritems(self.item_map)
 # }}}
@@ -876,6 +995,10 @@ def __iter__(self):
 class Search:
 
     MAX_CACHE_UPDATE = 50
+    # The type used to store results in the results cache. A BookIdSet is
+    # many times smaller than a set, at the cost of converting it back to a
+    # set on every cache hit. The parser itself always works with sets.
+    cached_result_type = BookIdSet
 
     def __init__(self, db, opt_name, all_search_locations=()):
         self.all_search_locations = all_search_locations
@@ -886,6 +1009,7 @@ def __init__(self, db, opt_name, all_search_locations=()):
         self.saved_searches = SavedSearchQueries(db, opt_name)
         self.cache = LRUCache()
         self.parse_cache = LRUCache(limit=100)
+        self.all_book_ids_cache = None
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -904,6 +1028,18 @@ def update_or_clear(self, dbcache, book_ids=None):
 
     def clear_caches(self):
         self.cache.clear()
+        self.all_book_ids_cache = None
+
+    def all_book_ids(self, dbcache):
+        ''' All book ids in the library as a frozenset. Books are only added by
+        create_book_entry(), which changes the number of books, and removed by
+        remove_books(), which calls discard_books(), so the cached value is
+        rebuilt only when needed. '''
+        book_col_map = dbcache.fields['uuid'].table.book_col_map
+        ans = self.all_book_ids_cache
+        if ans is None or len(ans) != len(book_col_map):
+            ans = self.all_book_ids_cache = frozenset(book_col_map)
+        return ans
 
     def update_caches(self, dbcache, book_ids):
         sqp = self.create_parser(dbcache)
@@ -914,8 +1050,10 @@ def update_caches(self, dbcache, book_ids):
 
     def discard_books(self, book_ids):
         book_ids = set(book_ids)
-        for query, result in self.cache:
-            result.difference_update(book_ids)
+        self.all_book_ids_cache = None
+        # The cached results are immutable, so they are replaced, not updated
+        for query, result in tuple(self.cache):
+            self.cache.replace(query, result - book_ids)
 
     def _update_caches(self, sqp, book_ids):
         book_ids = sqp.all_book_ids = set(book_ids)
@@ -926,13 +1064,20 @@ def _update_caches(self, sqp, book_ids):
             except ParseException:
                 remove.add(query)
             else:
-                # remove books that no longer match
-                result.difference_update(book_ids - matches)
-                # add books that now match but did not before
-                result.update(matches)
+                # remove books that no longer match and add books that now
+                # match but did not before
+                self.cache.replace(query, (result - (book_ids - matches)) | matches)
         for query in remove:
             self.cache.pop(query)
 
+    def cache_get(self, query):
+        ans = self.cache.get(query)
+        if ans is not None:
+            return ans.as_set() if isinstance(ans, BookIdSet) else set(ans)
+
+    def cache_add(self, query, result):
+        self.cache.add(query, self.cached_result_type(result))
+
     def create_parser(self, dbcache, virtual_fields=None):
         return Parser(
             dbcache, set(), dbcache._pref('grouped_search_terms'),
@@ -951,7 +1096,28 @@ def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book
         # thread safe.
         sqp = self.create_parser(dbcache, virtual_fields)
         try:
-            return self._do_search(sqp, query, search_restriction, dbcache, book_ids=book_ids)
+            ans = self._do_search(sqp, query, search_restriction, dbcache, book_ids=book_ids)
+            # Callers are free to modify the returned set
+            return set(ans) if isinstance(ans, frozenset) else ans
+        finally:
+            sqp.dbcache = sqp.lookup_saved_search = None
+
+    def explain(self, dbcache, query, search_restriction='', virtual_fields=None):
+        '''
+        Run the search without using the results cache, returning the set of
+        matched book ids and the plan used to evaluate it, as a list of
+        (depth, term, estimated cost, number of candidates, number of matches,
+        time in seconds) tuples, in the order the terms were evaluated.
+        '''
+        query, search_restriction = query.strip(), (search_restriction or '').strip()
+        if search_restriction:
+            query = f'({search_restriction}) and ({query})' if query else search_restriction
+        sqp = self.create_parser(dbcache, virtual_fields)
+        sqp.explain = []
+        try:
+            sqp.all_book_ids = self.all_book_ids(dbcache)
+            matches = sqp.parse(query) if query else sqp.all_book_ids
+            return set(matches), list(map(tuple, sqp.explain))
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
@@ -981,20 +1147,20 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         use_cache = self.query_is_cacheable(sqp, dbcache, query)
 
         if use_cache and book_ids is None and query and not search_restriction:
-            cached = self.cache.get(query)
+            cached = self.cache_get(query)
             if cached is not None:
                 return cached
 
-        restricted_ids = all_book_ids = dbcache._all_book_ids(type=set)
+        restricted_ids = all_book_ids = self.all_book_ids(dbcache)
         if search_restriction and search_restriction.strip():
             sr = search_restriction.strip()
             sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
             if self.query_is_cacheable(sqp, dbcache, sr):
-                cached = self.cache.get(sr)
+                cached = self.cache_get(sr)
                 if cached is None:
                     restricted_ids = sqp.parse(sr)
                     if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                        self.cache.add(sr, restricted_ids)
+                        self.cache_add(sr, restricted_ids)
                 else:
                     restricted_ids = cached
                     if book_ids is not None:
@@ -1008,7 +1174,7 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
             return restricted_ids
 
         if use_cache and restricted_ids is all_book_ids:
-            cached = self.cache.get(query)
+            cached = self.cache_get(query)
             if cached is not None:
                 return cached
 
@@ -1016,6 +1182,6 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         result = sqp.parse(query)
 
         if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+            self.cache_add(query, result)
 
         return result
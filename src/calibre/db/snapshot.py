@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Read-only snapshots of the in-memory tables of a :class:`calibre.db.cache.Cache`,
+so that readers do not have to wait for writers. When snapshot reads are
+enabled, a snapshot is taken whenever a thread acquires the write lock and is
+freed when the thread releases it. While the write lock is held, the read API
+methods in :data:`SNAPSHOT_READ_APIS` use the snapshot instead of waiting for
+the lock, so they see the data as it was at the start of the write in
+progress. Until the snapshot is ready, readers wait for the lock as usual.
+
+A snapshot is a shallow copy of the Cache with its own copies of the
+preferences and of the caches that readers fill in, so nothing computed from a
+snapshot can leak into the live Cache. Tables are copied on write: a snapshot
+gets copies only of the tables that the write in progress can change, see
+:func:`tables_changed_by`, and shares all others with the live Cache. Before
+a later write changes a table that an older snapshot, still in use by some
+reader, shares, that snapshot is given a copy of it and the write waits for
+the readers that started before that to finish. A snapshot has no access to
+the database, as that could expose the uncommitted changes of the writer.
+'''
+
+import copy
+import weakref
+from collections import defaultdict
+from functools import wraps
+from threading import Condition, Lock
+
+from calibre.db.category_index import CategoryIndex
+from calibre.db.columnar import ColumnMap, LinkColumn
+from calibre.db.composite_cache import CompositeCache
+from calibre.db.locking import LockingError
+from calibre.db.sort_index import SortKeyIndex
+
+# Read API methods that use only the in-memory tables, and so can be run
+# against a snapshot
+SNAPSHOT_READ_APIS = frozenset((
+    'field_for', 'fast_field_for', 'all_field_for', 'composite_for', 'field_ids_for', 'books_for_field',
+    'all_book_ids', 'all_field_ids', 'all_field_names', 'get_usage_count_by_id', 'get_id_map',
+    'get_item_name', 'get_item_id', 'get_item_ids', 'get_item_name_map', 'author_data', 'has_id', 'pref',
+    'lookup_by_uuid', 'author_sort_strings_for_books', 'get_proxy_metadata', 'get_next_series_num_for',
+    'multisort', 'search', 'books_in_virtual_library', 'number_of_books_in_virtual_library',
+))
+
+# Write API methods that do not change any of the in-memory tables. Writes by
+# any other method not handled in tables_changed_by() copy all tables.
+TABLE_FREE_WRITE_APIS = frozenset((
+    'set_pref', 'commit_dirty_cache', 'check_dirtied_annotations', 'clear_dirtied', 'write_backup',
+    'set_last_read_position', 'set_annotations_for_book', 'merge_annotations_for_book',
+    'update_annotations', 'delete_annotations', 'set_conversion_options', 'delete_conversion_options',
+    'add_custom_book_data', 'delete_custom_book_data', 'commit_fts_result', 'commit_fts_results',
+    'queue_next_fts_job', 'fts_unindex', 'clear_caches', 'clear_search_caches', 'clear_composite_caches',
+    'clear_extra_files_cache', 'clear_link_map_cache', 'initialize_template_cache',
+))
+
+
+def tables_changed_by(cache, name, args, kwargs):
+    '''
+    Return the names of the fields whose tables the write API method name can
+    change when called with args and kwargs, or None if all tables can change.
+    '''
+    if name in TABLE_FREE_WRITE_APIS:
+        return frozenset()
+    if name in ('mark_as_dirty', 'update_last_modified'):
+        return frozenset(('last_modified',))
+    if name == 'set_field':
+        field_name = args[0] if args else kwargs.get('name')
+        field = cache.fields.get(field_name)
+        if field is None:
+            return None
+        ans = {field_name, 'last_modified'}
+        if field.metadata['datatype'] == 'series':
+            ans.add(field_name + '_index')
+        if field_name == 'title':
+            ans |= {'sort', 'path', 'formats'}
+        elif field_name == 'authors':
+            ans |= {'author_sort', 'path', 'formats'}
+        return frozenset(ans)
+
+
+def copy_map(m):
+    if isinstance(m, LinkColumn):
+        return LinkColumn(m.copy(), as_sets=m.as_sets)
+    if isinstance(m, ColumnMap):
+        return type(m)(m.copy())
+    ans = m.copy()  # preserves defaultdict
+    for k, v in ans.items():
+        if isinstance(v, (set, dict)):
+            ans[k] = v.copy()
+    return ans
+
+
+def copy_table(table):
+    ans = copy.copy(table)
+    for name, val in vars(table).items():
+        if isinstance(val, (dict, ColumnMap)):
+            setattr(ans, name, copy_map(val))
+    return ans
+
+
+def copy_tables(cache, names=None):
+    '''
+    Return a mapping of id(table) to a copy of the table for the tables of
+    the fields in names, or of all fields if names is None.
+    '''
+    ans = {}
+    for name, field in cache.fields.items():
+        table = getattr(field, 'table', None)
+        if table is not None and (names is None or name in names):
+            ans[id(table)] = copy_table(table)
+    return ans
+
+
+class ActiveReaders:
+
+    ''' Counts the readers using a snapshot, so that a writer can wait for them
+    to finish before changing a table they may be reading. '''
+
+    def __init__(self):
+        self.count = 0
+        self.changed = Condition(Lock())
+
+    def __enter__(self):
+        with self.changed:
+            self.count += 1
+
+    def __exit__(self, *a):
+        with self.changed:
+            self.count -= 1
+            if not self.count:
+                self.changed.notify_all()
+
+    def wait(self):
+        with self.changed:
+            while self.count:
+                self.changed.wait()
+
+
+def unshare_tables(cache, table_copies):
+    '''
+    Give the snapshots that are still in use copies of the live tables they
+    share that are about to be changed. Returns the readers of these snapshots
+    that may still be reading the live tables, which must be waited for
+    before changing them.
+    '''
+    ans = []
+    for snap in tuple(cache.live_snapshots):
+        unshared = False
+        for name, field in snap.fields.items():
+            table = getattr(field, 'table', None)
+            if table is not None and id(table) in table_copies:
+                field.table = table_copies[id(table)]
+                unshared = True
+        if unshared:
+            # Readers starting from now use the copies
+            ans.append(snap.active_readers)
+            snap.active_readers = ActiveReaders()
+    return ans
+
+
+def prepare_snapshot(cache, changed_tables=None):
+    '''
+    Must be called with the write lock held, before any changes are made.
+    Publishes a snapshot of the data as it is now for readers to use while
+    the write is in progress, copying only the tables of the fields in
+    changed_tables, or all tables if it is None.
+    '''
+    cache.snapshot = None
+    if not cache.fields:
+        return
+    table_copies = copy_tables(cache, changed_tables)
+    readers = unshare_tables(cache, table_copies)
+    cache.snapshot = create_snapshot(cache, table_copies)
+    for r in readers:
+        r.wait()
+
+
+class NoOpLock:
+
+    def acquire(self, *a):
+        return True
+
+    def release(self, *a):
+        pass
+
+    def owns_lock(self):
+        return True
+
+    __enter__ = acquire
+    __exit__ = release
+
+
+class ReadOnlyLock(NoOpLock):
+
+    def acquire(self, *a):
+        raise LockingError('Cannot change the database using a read-only snapshot')
+
+
+def read_only_api(*a, **kw):
+    raise LockingError('Cannot change the database using a read-only snapshot')
+
+
+class SnapshotBackend:
+
+    ''' Stands in for the database backend in a snapshot, only the attributes
+    that do not need the database are available. '''
+
+    def __init__(self, backend):
+        self.library_id = backend.library_id
+        self.library_path = backend.library_path
+        self.dbpath = backend.dbpath
+        self.is_fat_filesystem = backend.is_fat_filesystem
+        prefs = self.prefs = dict.__new__(type(backend.prefs))
+        dict.update(prefs, backend.prefs)
+        prefs.defaults = backend.prefs.defaults.copy()
+        prefs.db, prefs.disable_setting = self, True
+
+    def __getattr__(self, name):
+        raise LockingError(f'A snapshot has no access to the database, cannot use: {name}')
+
+
+snapshot_classes = {}
+
+
+def snapshot_class(cls):
+    ans = snapshot_classes.get(cls)
+    if ans is None:
+        class Snapshot(cls):
+
+            def __del__(self):
+                pass  # dont close the database, it belongs to the Cache
+
+        ans = snapshot_classes[cls] = Snapshot
+    return ans
+
+
+def snapshot_read_api(snapref, func):
+    # Bound to the snapshot weakly, so that it is freed as soon as it is no
+    # longer used
+
+    @wraps(func)
+    def call_func_as_reader(*args, **kwargs):
+        snap = snapref()
+        with snap.active_readers:
+            return func(snap, *args, **kwargs)
+    return call_func_as_reader
+
+
+def create_snapshot(cache, table_copies=None):
+    '''
+    Must be called with the write lock held, or with no writers active. The
+    snapshot uses the tables in table_copies, as returned by
+    :func:`copy_tables`, and shares all other tables with the live Cache. If
+    table_copies is None, all tables are copied.
+    '''
+    # Tables not yet read must be read now, reading them later from the
+    # snapshot could see changes from the write in progress
+    cache.backend.load_all_tables()
+    if table_copies is None:
+        table_copies = copy_tables(cache)
+    snap = object.__new__(snapshot_class(type(cache)))
+    snap.__dict__.update(cache.__dict__)
+    snap.is_snapshot = True
+    snap.snapshot = None
+    snap.active_readers = ActiveReaders()
+    snap.backend = SnapshotBackend(cache.backend)
+    # Bind the API methods to the snapshot, without locking
+    snapref = weakref.ref(snap)
+    for name in dir(type(cache)):
+        func = getattr(type(cache), name)
+        ira = getattr(func, 'is_read_api', None)
+        if ira is not None:
+            bound = snapshot_read_api(snapref, func) if ira else read_only_api
+            setattr(snap, name, bound)
+            setattr(snap, '_' + name, bound)
+    get_proxy_metadata = snap._get_proxy_metadata
+
+    def get_proxy_metadata_for_snapshot(book_id):
+        # ProxyMetadata refers to its database weakly, keep the snapshot
+        # alive for as long as the returned object is used
+        ans = get_proxy_metadata(book_id)
+        object.__setattr__(ans, '_snapshot', snapref())
+        return ans
+    snap.get_proxy_metadata = snap._get_proxy_metadata = get_proxy_metadata_for_snapshot
+    snap.read_lock, snap.write_lock = NoOpLock(), ReadOnlyLock()
+
+    fields = {}
+    for name, field in cache.fields.items():
+        f = fields[name] = copy.copy(field)
+        table = getattr(field, 'table', None)
+        if table is not None:
+            f.table = table_copies.get(id(table), table)
+        if f.is_composite:
+            f._render_cache, f._lock = {}, Lock()
+            f.persistent_cache = f.last_modified_table = None
+        elif name == 'ondevice':
+            f.cache, f._lock = {}, Lock()
+    for f in fields.values():
+        for attr in ('series_field', 'author_sort_field'):
+            other = getattr(f, attr, None)
+            if other is not None:
+                setattr(f, attr, fields[other.name])
+    snap.fields = fields
+    snap.composites = {name: fields[name] for name in cache.composites}
+
+    # The caches that readers fill in
+    snap.format_metadata_cache = defaultdict(dict)
+    snap.formatter_template_cache = {}
+    snap.dirtied_cache = cache.dirtied_cache.copy()
+    snap.link_maps_cache = {}
+    snap.extra_files_cache = {}
+    snap.vls_for_books_cache = None
+    snap.sort_key_index = SortKeyIndex()
+    snap.category_index = CategoryIndex()
+    snap.composite_cache = CompositeCache()
+    search = snap._search_api = copy.copy(cache._search_api)
+    search.cache, search.parse_cache = type(search.cache)(), type(search.parse_cache)(limit=100)
+    search.all_book_ids_cache = None
+    cache.live_snapshots.add(snap)
+    return snap
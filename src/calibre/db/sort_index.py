@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Sort keys for books, computed once per field and book and then updated only
+for the books that change, so that sorting a large library does not need to
+re-create all the sort keys every time. The index is saved next to
+metadata.db when the library is closed and reused when it is next opened,
+provided metadata.db has not been changed in the meantime.
+'''
+
+import os
+import time
+
+from calibre.constants import __version__
+from calibre.db.constants import CACHE_DIR_NAME
+
+SORT_KEYS_FILE_NAME = 'sort-keys.msgpack'
+
+
+def global_signature():
+    ' Everything other than field metadata that the sort keys depend on '
+    from calibre.utils.config_base import tweaks
+    from calibre.utils.icu import collator
+    from calibre.utils.localization import get_lang
+    collator()  # ensure the sort locale is initialized
+    from calibre.utils.icu import _locale
+    return repr((__version__, _locale, get_lang(), time.timezone, time.altzone, time.tzname, sorted(tweaks.items())))
+
+
+class SortKeyIndex:
+
+    VERSION = 1
+
+    def __init__(self, dbpath=None):
+        # If dbpath is None the index is not persisted
+        self.path = None if dbpath is None else os.path.join(os.path.dirname(dbpath), CACHE_DIR_NAME, SORT_KEYS_FILE_NAME)
+        self.dbpath = dbpath
+        self.maps = {}
+        self.field_signatures = {}
+        self._signature = None
+
+    @property
+    def signature(self):
+        if self._signature is None:
+            self._signature = global_signature()
+        return self._signature
+
+    def db_state(self):
+        try:
+            st = os.stat(self.dbpath)
+        except (OSError, TypeError):
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def key_func(self, name, field_signature, create_key_func):
+        '''
+        Return a function that maps book ids to sort keys for the field name.
+        create_key_func() must return the function used to calculate sort keys
+        for books not already in the index, it is called only if there are
+        such books. field_signature must change whenever the way sort keys
+        are calculated for this field changes.
+        '''
+        smap = self.maps.get(name)
+        if smap is None or self.field_signatures.get(name) != field_signature:
+            smap = self.maps[name] = {}
+            self.field_signatures[name] = field_signature
+        compute = []
+
+        def key(book_id):
+            try:
+                return smap[book_id]
+            except KeyError:
+                if not compute:
+                    compute.append(create_key_func())
+                ans = smap[book_id] = compute[0](book_id)
+                return ans
+        return key
+
+    def invalidate(self, book_ids=None):
+        if book_ids is None:
+            self.maps.clear()
+        else:
+            for smap in self.maps.values():
+                for book_id in book_ids:
+                    smap.pop(book_id, None)
+
+    def load(self):
+        if self.path is None:
+            return
+        from calibre.utils.serialize import msgpack_loads
+        try:
+            with open(self.path, 'rb') as f:
+                data = msgpack_loads(f.read(), use_list=False)
+        except FileNotFoundError:
+            return
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return
+        try:
+            if (data['version'] != self.VERSION or data['signature'] != self.signature or
+                    data['db_state'] != self.db_state()):
+                return
+            self.maps = {name: dict(smap) for name, smap in data['maps'].items()}
+            self.field_signatures = dict(data['field_signatures'])
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            self.maps, self.field_signatures = {}, {}
+
+    def save(self):
+        ' Must be called after the last change to metadata.db '
+        if self.path is None or not any(self.maps.values()):
+            return
+        from calibre.utils.serialize import msgpack_dumps
+        db_state = self.db_state()
+        if db_state is None:
+            return
+        try:
+            data = msgpack_dumps({
+                'version': self.VERSION, 'signature': self.signature, 'db_state': db_state,
+                'maps': self.maps, 'field_signatures': self.field_signatures})
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f'{self.path}.{os.getpid()}.tmp'  # several processes can save at the same time
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass  # read-only library
@@ -9,6 +9,7 @@
 from collections import defaultdict
 from datetime import datetime, timedelta
 
+from calibre.db.columnar import IdColumn, LinkColumn, ValueColumn
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.date import UNDEFINED_DATE, parse_date, utc_tz
 from calibre.utils.icu import lower as icu_lower
@@ -72,9 +73,28 @@ def __init__(self, name, metadata, link_table=None):
         if self.supports_notes and dt == 'rating':  # custom ratings table
             self.supports_notes = False
 
+    def __getattr__(self, name):
+        # Only called for attributes that are not set, which for a table
+        # whose reading was deferred by DB.read_tables() means its data
+        loader = self.__dict__.get('lazy_loader')
+        if loader is None or name.startswith('__'):
+            raise AttributeError(f'{type(self).__name__!r} object has no attribute {name!r}')
+        loader(self)
+        return object.__getattribute__(self, name)
+
+    @property
+    def is_loaded(self):
+        return 'lazy_loader' not in self.__dict__
+
     def remove_books(self, book_ids, db):
         return set()
 
+    def use_columnar_storage(self):
+        ''' Replace the in-memory maps of this table with their compact, array
+        based equivalents from :mod:`calibre.db.columnar`. Must be called after
+        :meth:`read`. '''
+        pass
+
     def fix_link_table(self, db):
         pass
 
@@ -125,6 +145,9 @@ def read(self, db):
             us = self.unserialize
             self.book_col_map = {book_id:us(val) for book_id, val in query}
 
+    def use_columnar_storage(self):
+        self.book_col_map = ValueColumn(self.book_col_map)
+
     def remove_books(self, book_ids, db):
         clean = set()
         for book_id in book_ids:
@@ -189,6 +212,9 @@ def read(self, db):
         self.composite_sort = d.get('composite_sort', False)
         self.use_decorations = d.get('use_decorations', False)
 
+    def use_columnar_storage(self):
+        pass
+
     def remove_books(self, book_ids, db):
         return set()
 
@@ -230,6 +256,10 @@ def read_maps(self, db):
             cbm[item_id].add(book)
             bcm[book] = item_id
 
+    def use_columnar_storage(self):
+        self.book_col_map = IdColumn(self.book_col_map)
+        self.col_book_map = LinkColumn(self.col_book_map, as_sets=True)
+
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_id in itervalues(self.book_col_map)}
         extra_item_ids = linked_item_ids - set(self.id_map)
@@ -402,6 +432,10 @@ def read_maps(self, db):
 
         self.book_col_map = {k:tuple(v) for k, v in iteritems(bcm)}
 
+    def use_columnar_storage(self):
+        self.book_col_map = LinkColumn(self.book_col_map)
+        self.col_book_map = LinkColumn(self.col_book_map, as_sets=True)
+
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_ids in itervalues(self.book_col_map) for item_id in item_ids}
         extra_item_ids = linked_item_ids - set(self.id_map)
@@ -608,6 +642,10 @@ class FormatsTable(ManyToManyTable):
     def read_id_maps(self, db):
         pass
 
+    def use_columnar_storage(self):
+        # Keyed by format name, not by integer ids
+        pass
+
     def fix_case_duplicates(self, db):
         pass
 
@@ -694,6 +732,10 @@ class IdentifiersTable(ManyToManyTable):
     def read_id_maps(self, db):
         pass
 
+    def use_columnar_storage(self):
+        # Keyed by identifier type, not by integer ids
+        pass
+
     def fix_case_duplicates(self, db):
         pass
 
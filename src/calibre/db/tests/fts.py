@@ -259,6 +259,7 @@ def test_pdftotext(self):
                 f.write(pdf_data)
             from calibre.db.fts.text import pdftotext
             self.assertEqual(pdftotext(pdf).strip(), 'Hello World')
+            self.assertEqual(pdftotext(pdf, max_text_size=5), 'Hello')
 
 
 def find_tests():
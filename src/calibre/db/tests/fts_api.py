@@ -111,19 +111,32 @@ def check(**kw):
         self.wait_for_fts_to_finish(fts)
         check(id=1, book=1, format='TXTZ', searchable_text='a test text')
 
+        # check worker processes are re-used and recycled after max_jobs_per_process
+        self.assertTrue([w for w in fts.pool.workers if w.process is not None])
+        for w in fts.pool.workers:
+            w.stop_process()
+            w.max_jobs_per_process = 1
+        cache.add_format(1, 'TXTZ', self.make_txtz(b'a recycled worker'))
+        self.wait_for_fts_to_finish(fts)
+        check(id=2, book=1, format='TXTZ', searchable_text='a recycled worker')
+        self.assertFalse([w for w in fts.pool.workers if w.process is not None])
+        for w in fts.pool.workers:
+            w.max_jobs_per_process = w.__class__.max_jobs_per_process
+
         # check max_duration
         for w in fts.pool.workers:
             w.max_duration = -1
         with patch('sys.stderr', new_callable=StringIO):
             cache.add_format(1, 'TXTZ', self.make_txtz(b'a timed out text'))
             self.wait_for_fts_to_finish(fts)
-            check(id=2, book=1, format='TXTZ', err_msg='Extracting text from the TXTZ file of size 132 B took too long')
+            check(id=3, book=1, format='TXTZ', err_msg='Extracting text from the TXTZ file of size 132 B took too long')
         for w in fts.pool.workers:
             w.max_duration = w.__class__.max_duration
 
         # check shutdown when workers have hung
         for w in fts.pool.workers:
             w.code_to_exec = 'import time; time.sleep(100)'
+            w.stop_process()
         cache.add_format(1, 'TXTZ', self.make_txtz(b'hung worker'))
         workers = list(fts.pool.workers)
         cache.close()
@@ -149,6 +162,17 @@ def test_fts_search(self):
         self.ae({x['text'] for x in cache.fts_search('also', highlight_start='[', highlight_end=']', snippet_size=3)}, {
             '…will [also] help…'})
         self.ae({x['text'] for x in cache.fts_search('also', return_text=False)}, {''})
+        # pagination
+        ranked = [x['id'] for x in cache.fts_search('help')]
+        self.ae([x['id'] for x in cache.fts_search('help', limit=1)], ranked[:1])
+        self.ae([x['id'] for x in cache.fts_search('help', offset=1)], ranked[1:])
+        self.ae([x['id'] for x in cache.fts_search('help', offset=1, limit=1, return_text=False)], ranked[1:])
+        self.ae([x['text'] for x in cache.fts_search('also', highlight_start='[', highlight_end=']', snippet_size=3, limit=1)], ['…will [also] help…'])
+        self.ae(cache.fts_search('help', offset=2, limit=1), ())
+        self.ae(cache.fts_count('help'), 2)
+        self.ae(cache.fts_count('help', restrict_to_book_ids=(1, 3)), 1)
+        self.ae(cache.fts_count('help', restrict_to_book_ids=()), 0)
+        self.ae(cache.fts_count('nomatch'), 0)
         fts = cache.reindex_fts()
         self.assertTrue(fts.pool.initialized)
         self.wait_for_fts_to_finish(fts)
@@ -158,6 +182,25 @@ def test_fts_search(self):
         self.ae({x['id'] for x in cache.fts_search('help')}, {2})
         cache.close()
 
+    def test_fts_chapters(self):
+        from calibre.db.fts import CHAPTER_SEPARATOR
+        cache = self.init_cache()
+        cache.queue_next_fts_job = lambda *a: None
+        self.assertTrue(cache.set_fts_index_chapters(True))
+        self.assertFalse(cache.set_fts_index_chapters(True))
+        fts = cache.enable_fts(start_pool=False)
+        fts.add_text(1, 'FMT1', CHAPTER_SEPARATOR.join(('a cat', '', 'a dog', 'cat and cat')))
+        fts.add_text(2, 'FMT1', 'a cat and a dog')
+        self.ae(len(self.text_records(fts)), 4)
+        self.ae({(x['book_id'], x['spine_index']) for x in cache.fts_search('cat', highlight_start='[', highlight_end=']')}, {(1, 0), (1, 3), (2, 0)})
+        self.ae(sorted((x['book_id'], x['format']) for x in cache.fts_search('cat', return_text=False)), [(1, 'FMT1'), (2, 'FMT1')])
+        self.ae(cache.fts_count('cat'), 2)
+        self.ae(cache.fts_count('dog', restrict_to_book_ids=(1,)), 1)
+        # re-indexing a book replaces all its chapters
+        fts.add_text(1, 'FMT1', 'a mouse')
+        self.ae([(r['book'], r['spine_index']) for r in self.text_records(fts)], [(2, 0), (1, 0)])
+        cache.close()
+
     def test_fts_triggers(self):
         cache = self.init_cache()
         # the cache fts jobs will clear dirtied flag so disable it
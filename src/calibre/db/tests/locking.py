@@ -4,9 +4,10 @@
 __license__ = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
+import os
 import random
 import time
-from threading import Thread
+from threading import Event, Thread
 
 from calibre.db.locking import LockingError, RWLockWrapper, SHLock
 from calibre.db.tests.base import BaseTest
@@ -158,6 +159,11 @@ def get_lock(shared):
         lock.release()
         self.assertFalse(lock.is_shared)
         self.assertFalse(lock.is_exclusive)
+        waits = lock.wait_stats()
+        self.assertEqual(waits['shared'][0], 1)
+        self.assertEqual(waits['exclusive'][0], 1)
+        self.assertGreater(waits['shared'][1], 0.5)
+        self.assertGreater(waits['exclusive'][1], 0.5)
 
     def test_contention(self):
         lock = SHLock()
@@ -192,6 +198,163 @@ def lots_of_acquires():
         self.assertFalse(lock.is_shared)
         self.assertFalse(lock.is_exclusive)
 
+    def create_cache(self, snapshot_reads):
+        orig = os.environ.get('CALIBRE_SNAPSHOT_READS')
+        os.environ['CALIBRE_SNAPSHOT_READS'] = '1' if snapshot_reads else '0'
+        try:
+            return self.init_cache()
+        finally:
+            if orig is None:
+                del os.environ['CALIBRE_SNAPSHOT_READS']
+            else:
+                os.environ['CALIBRE_SNAPSHOT_READS'] = orig
+
+    def test_snapshot_reads(self):
+        ' Test that readers use the snapshot instead of waiting for writers '
+        cache = self.create_cache(True)
+        writing, written, done = Event(), Event(), Event()
+
+        def writer():
+            with cache.write_lock:
+                writing.set()
+                cache._set_field('title', {1:'changed'})
+                written.set()
+                done.wait(10)
+
+        t = Thread(target=writer, daemon=True)
+        t.start()
+        self.assertTrue(written.wait(10))
+        try:
+            # The snapshot was taken before the change
+            self.assertEqual(cache.field_for('title', 1), 'Title Two')
+            self.assertEqual(cache.search('title:"=Title Two"'), {1})
+            during_write = cache.multisort([('title', True)])
+            self.assertRaises(LockingError, cache.snapshot.set_field, 'title', {1:'x'})
+        finally:
+            done.set()
+            t.join(10)
+        self.assertIsNone(cache.snapshot)
+        self.assertEqual(cache.field_for('title', 1), 'changed')
+        self.assertEqual(cache.search('title:"=Title Two"'), set())
+        # Caches filled in from the snapshot must not be used by the live data
+        self.assertEqual(cache.multisort([('title', True)]), self.init_cache().multisort([('title', True)]))
+        self.assertNotEqual(cache.multisort([('title', True)]), during_write)
+
+    def test_snapshot_lifetime(self):
+        ' Test that snapshots exist only while writing and cannot use the database '
+        cache = self.create_cache(True)
+        self.assertIsNone(cache.snapshot)
+        writing, done, read = Event(), Event(), Event()
+        results = []
+
+        def writer():
+            with cache.write_lock:
+                with cache.write_lock:
+                    pass
+                # Releasing a nested write lock must not free the snapshot
+                results.append(cache.snapshot)
+                cache._set_pref('test_snapshot_pref', 1)
+                writing.set()
+                done.wait(10)
+
+        def reader():
+            results.append((cache.field_for('title', 1), cache.pref('test_snapshot_pref')))
+            read.set()
+
+        t = Thread(target=writer, daemon=True)
+        t.start()
+        try:
+            self.assertTrue(writing.wait(10))
+            snap = results[0]
+            self.assertIs(snap, cache.snapshot)
+            # Readers do not wait for the writer and see neither its
+            # changes nor anything else the database has not committed
+            Thread(target=reader, daemon=True).start()
+            self.assertTrue(read.wait(10))
+            self.assertEqual(results[1], ('Title Two', None))
+            self.assertRaises(LockingError, getattr, snap.backend, 'conn')
+            self.assertRaises(LockingError, snap.backend.prefs.__delitem__, 'test_snapshot_pref')
+        finally:
+            done.set()
+            t.join(10)
+        self.assertIsNone(cache.snapshot)
+        self.assertEqual(cache.pref('test_snapshot_pref'), 1)
+
+    def test_snapshot_copy_on_write(self):
+        ' Test that writes copy only the tables they change into snapshots '
+        from calibre.db.snapshot import create_snapshot, prepare_snapshot, tables_changed_by
+        cache = self.create_cache(True)
+        self.assertEqual(tables_changed_by(cache, 'set_pref', ('x', 1), {}), frozenset())
+        self.assertEqual(tables_changed_by(cache, 'set_field', ('title', {}), {}), {'title', 'sort', 'path', 'formats', 'last_modified'})
+        self.assertIn('series_index', tables_changed_by(cache, 'set_field', (), {'name': 'series', 'book_id_to_val_map': {}}))
+        self.assertIsNone(tables_changed_by(cache, 'remove_books', ((1,),), {}))
+        prepare_snapshot(cache, frozenset())
+        self.assertIs(cache.snapshot.fields['title'].table, cache.fields['title'].table)
+        prepare_snapshot(cache, frozenset(('title',)))
+        self.assertIsNot(cache.snapshot.fields['title'].table, cache.fields['title'].table)
+        self.assertIs(cache.snapshot.fields['tags'].table, cache.fields['tags'].table)
+        cache.snapshot = None
+
+        # A snapshot still in use gets its own copy of the tables a write changes
+        snap = create_snapshot(cache, {})
+        cache.set_field('title', {1: 'changed'})
+        self.assertIsNot(snap.fields['title'].table, cache.fields['title'].table)
+        self.assertIs(snap.fields['tags'].table, cache.fields['tags'].table)
+        self.assertEqual(snap.field_for('title', 1), 'Title Two')
+        self.assertEqual(cache.field_for('title', 1), 'changed')
+
+        # and the write waits for the readers of that snapshot
+        snap = create_snapshot(cache, {})
+        with snap.active_readers:
+            t = Thread(target=cache.set_field, args=('title', {1: 'again'}), daemon=True)
+            t.start()
+            t.join(0.1)
+            self.assertTrue(t.is_alive())
+            self.assertEqual(cache.fields['title'].table.book_col_map[1], 'changed')
+        t.join(10)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(snap.field_for('title', 1), 'changed')
+        self.assertEqual(cache.field_for('title', 1), 'again')
+
+def reader_latencies(cache, duration=2, write_hold=0.05, num_readers=4):
+    '''
+    Return the sorted latencies of read API calls made while another thread
+    continuously changes the database, holding the write lock for
+    write_hold seconds at a time, as for a long running set_metadata()
+    '''
+    stop = Event()
+    book_ids = tuple(cache.all_book_ids())
+    latencies = []
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            with cache.write_lock:
+                cache._set_field('title', {book_id:f'title {i}' for book_id in book_ids})
+                wait_for(write_hold)
+            time.sleep(0.001)
+
+    def reader():
+        while not stop.is_set():
+            st = time.perf_counter()
+            cache.search('title:title')
+            cache.field_for('title', random.choice(book_ids))
+            latencies.append(time.perf_counter() - st)
+
+    threads = [Thread(target=writer, daemon=True)] + [Thread(target=reader, daemon=True) for i in range(num_readers)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join(5)
+    return sorted(latencies)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
 
 def find_tests():
     import unittest
@@ -201,3 +364,18 @@ def find_tests():
 def run_tests():
     from calibre.utils.run_tests import run_tests
     run_tests(find_tests)
+
+
+def benchmark(library_path, duration=10):
+    ' Print reader latencies during sustained writes to the library at library_path, with and without snapshots '
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    for snapshot_reads in (False, True):
+        os.environ['CALIBRE_SNAPSHOT_READS'] = '1' if snapshot_reads else '0'
+        cache = Cache(DB(os.path.expanduser(library_path)))
+        cache.init()
+        latencies = reader_latencies(cache, duration=float(duration))
+        cache.close()
+        print('{:>10}: {} reads p50: {:.1f}ms p99: {:.1f}ms max: {:.1f}ms'.format(
+            'snapshots' if snapshot_reads else 'locking', len(latencies), percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, latencies[-1] * 1000))
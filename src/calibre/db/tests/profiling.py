@@ -5,7 +5,11 @@
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import cProfile
+import gc
 import os
+import sys
+import time
+import tracemalloc
 from tempfile import gettempdir
 
 from calibre.db.legacy import LibraryDatabase
@@ -40,5 +44,190 @@ def main():
     print('Stats saved to', stats)
 
 
+def table_memory(path, columnar=False):
+    ' Return the memory used by the in-memory tables and the time taken to read every field of every book '
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    backend = DB(os.path.expanduser(path))
+    backend.columnar_tables = columnar
+    backend.lazy_tables = False
+    gc.collect()
+    tracemalloc.start()
+    try:
+        backend.read_tables()
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    cache = Cache(backend)
+    cache.init()
+    book_ids = cache.all_book_ids()
+    st = time.monotonic()
+    for field in cache.fields.values():
+        if not field.is_composite and field.name != 'ondevice':
+            for book_id in book_ids:
+                field.for_book(book_id)
+    read_time = time.monotonic() - st
+    st = time.monotonic()
+    cache.search('tags:"=Tag One" or series:true')
+    search_time = time.monotonic() - st
+    cache.close()
+    return used, read_time, search_time
+
+
+def memory_benchmark(path='~/test library'):
+    ' Compare the memory used by dict based and columnar in-memory tables '
+    for columnar in (False, True):
+        used, read_time, search_time = table_memory(path, columnar)
+        print('{:>8}: {:.1f} MB  read all fields: {:.2f}s  search: {:.2f}s'.format(
+            'columnar' if columnar else 'dicts', used / 1024**2, read_time, search_time))
+
+
+def table_load_times(path='~/test library', fields=('title', 'formats')):
+    ' Time opening a library and reading the specified fields, with and without lazy table loading '
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    for lazy in (False, True):
+        st = time.monotonic()
+        backend = DB(os.path.expanduser(path))
+        backend.lazy_tables = lazy
+        cache = Cache(backend)
+        cache.init()
+        opened = time.monotonic() - st
+        for book_id in cache.all_book_ids():
+            for field in fields:
+                cache.field_for(field, book_id)
+        total = time.monotonic() - st
+        print('{:>6}: open: {:.2f}s  open and read {}: {:.2f}s'.format('lazy' if lazy else 'eager', opened, ', '.join(fields), total))
+        for name, t in sorted(backend.table_load_times.items(), key=lambda x: -x[1])[:10]:
+            print('    {:<20} {:.3f}s'.format(name, t))
+        cache.close()
+
+
+BENCHMARK_TEMPLATE = '''program:
+    t = field('title');
+    if $$series then
+        s = strcat($series, ' [', format_number($series_index, '{:04.1f}'), ']')
+    else
+        s = ''
+    fi;
+    for a in $authors:
+        ans = list_union(ans, sublist(a, 0, 1, ' '), ',')
+    rof;
+    if t == '' || strlen(t) ># 20 then t = substr(t, 0, 20) fi;
+    strcat(s, ' - ', t, ' (', ans, ')')
+'''
+
+
+def template_benchmark(path='~/test library', template=BENCHMARK_TEMPLATE, repeat=5):
+    ' Compare evaluating a template for every book with the compiled closures and the tree walking interpreter '
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    from calibre.ebooks.metadata.book.formatter import SafeFormat
+    cache = Cache(DB(os.path.expanduser(path)))
+    cache.init()
+    mis = [cache.get_proxy_metadata(book_id) for book_id in cache.all_book_ids()]
+    formatter = SafeFormat()
+    results = {}
+    for compiled in (False, True):
+        formatter.compile_templates = compiled
+        template_cache = {}
+        st = time.monotonic()
+        for i in range(repeat):
+            results[compiled] = [formatter.safe_format(
+                template, mi, 'TEMPLATE ERROR', mi, column_name='benchmark', template_cache=template_cache) for mi in mis]
+        print('{:>12}: {:.2f}s for {} evaluations'.format(
+            'compiled' if compiled else 'interpreted', time.monotonic() - st, repeat * len(mis)))
+    cache.close()
+    if results[False] != results[True]:
+        raise SystemExit('The compiled template gave different results')
+
+
+BENCHMARK_QUERIES = ('tags:=fiction', 'not tags:=fiction', 'author:a or title:the', 'rating:>2 and not series:true', 'formats:epub')
+
+
+def search_benchmark(path='~/test library', queries=BENCHMARK_QUERIES, repeat=20):
+    ' Time searches with and without the results cache and measure the memory used by the cache, for each type of cached result '
+    from calibre.db.backend import DB
+    from calibre.db.bitmap import BookIdSet
+    from calibre.db.cache import Cache
+    cache = Cache(DB(os.path.expanduser(path)))
+    cache.init()
+    search = cache._search_api
+    try:
+        for cached_result_type in (BookIdSet, frozenset):
+            search.cached_result_type = cached_result_type
+            uncached, cached = [], []
+            for i in range(repeat):
+                for query in queries:
+                    search.clear_caches()
+                    st = time.perf_counter()
+                    cache.search(query)
+                    uncached.append(time.perf_counter() - st)
+                    st = time.perf_counter()
+                    cache.search(query)
+                    cached.append(time.perf_counter() - st)
+            search.clear_caches()
+            gc.collect()
+            tracemalloc.start()
+            for query in queries:
+                cache.search(query)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            uncached.sort(), cached.sort()
+            print('{:>10}: uncached median: {:.2f}ms cached median: {:.2f}ms memory per cached result: {:.1f}KB'.format(
+                cached_result_type.__name__, 1000 * uncached[len(uncached) // 2], 1000 * cached[len(cached) // 2],
+                size / len(queries) / 1024))
+    finally:
+        del search.cached_result_type
+        cache.close()
+
+
+def fts_benchmark(path='~/test library', max_jobs_per_process=(1, 100), timeout=60):
+    ''' Re-index all formats in the library and report the books per minute for
+    each value of Worker.max_jobs_per_process. With a value of 1 every book is
+    extracted by a newly started process, as before the workers were made long
+    lived. The full text index of the library is rebuilt, so use a copy. '''
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    from calibre.db.fts.pool import Worker
+    orig = Worker.max_jobs_per_process
+    try:
+        for num in max_jobs_per_process:
+            Worker.max_jobs_per_process = int(num)
+            cache = Cache(DB(os.path.expanduser(path)))
+            cache.init()
+            try:
+                cache.enable_fts()
+                cache.set_fts_speed(slow=False)
+                cache.fts_indexing_sleep_time = 0
+                cache.reindex_fts()
+                with cache.read_lock:
+                    left = total = cache.backend.fts.number_dirtied()
+                st = time.monotonic()
+                while left and time.monotonic() - st < timeout * 60:
+                    time.sleep(0.1)
+                    with cache.read_lock:
+                        left = cache.backend.fts.number_dirtied()
+                elapsed = time.monotonic() - st
+                print('{:>4} jobs per process: indexed {} of {} formats in {:.1f}s: {:.1f} books per minute'.format(
+                    num, total - left, total, elapsed, 60 * (total - left) / elapsed))
+            finally:
+                cache.close()
+    finally:
+        Worker.max_jobs_per_process = orig
+
+
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['memory']:
+        memory_benchmark(*sys.argv[2:])
+    elif sys.argv[1:2] == ['tables']:
+        table_load_times(*sys.argv[2:3])
+    elif sys.argv[1:2] == ['templates']:
+        template_benchmark(*sys.argv[2:])
+    elif sys.argv[1:2] == ['search']:
+        search_benchmark(*sys.argv[2:3])
+    elif sys.argv[1:2] == ['fts']:
+        fts_benchmark(*sys.argv[2:3])
+    else:
+        main()
@@ -130,6 +130,74 @@ def test_read(self):  # {{{
                             book_id, field, expected_val, val))
         # }}}
 
+    def test_columnar_tables(self):  # {{{
+        'Test that columnar in-memory tables behave the same as the dict based ones'
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        from calibre.db.columnar import LinkColumn, ValueColumn
+
+        def init(columnar):
+            backend = DB(self.cloned_library)
+            backend.columnar_tables = columnar
+            cache = Cache(backend)
+            cache.init()
+            return cache
+
+        def fields(cache):
+            for name, field in iteritems(cache.fields):
+                if name != 'ondevice' and not field.is_composite:
+                    yield name, field
+
+        def compare(a, b):
+            self.assertEqual(a.all_book_ids(), b.all_book_ids())
+            for name, field in fields(a):
+                other = b.fields[name]
+                for book_id in a.all_book_ids():
+                    self.assertEqual(a.field_for(name, book_id), b.field_for(name, book_id), f'{name} for {book_id}')
+                    self.assertEqual(a.field_ids_for(name, book_id), b.field_ids_for(name, book_id), name)
+                for item_id in field:
+                    self.assertEqual(field.books_for(item_id), other.books_for(item_id), f'{name} books for {item_id}')
+                self.assertEqual(
+                    sorted((repr(k), sorted(v)) for k, v in field.iter_searchable_values(a._get_proxy_metadata, a.all_book_ids())),
+                    sorted((repr(k), sorted(v)) for k, v in other.iter_searchable_values(b._get_proxy_metadata, b.all_book_ids())), name)
+            for q in ('tags:"=Tag One"', 'series:true', 'authors:one', '#tags:true', 'rating:>2', 'title:~title'):
+                self.assertEqual(a.search(q), b.search(q), q)
+            self.assertEqual(a.get_usage_count_by_id('tags'), b.get_usage_count_by_id('tags'))
+
+        dc, cc = init(False), init(True)
+        self.assertIsInstance(cc.fields['title'].table.book_col_map, ValueColumn)
+        self.assertIsInstance(cc.fields['tags'].table.col_book_map, LinkColumn)
+        compare(dc, cc)
+        for c in (dc, cc):
+            c.set_field('tags', {1:('a', 'b'), 2:(), 3:('Tag One',)})
+            c.set_field('series', {1:'x', 2:None, 3:'x'})
+            c.set_field('authors', {1:('Author One', 'new author'), 3:('Author Two',)})
+            c.set_field('title', {2:'changed', 3:'changed'})
+            c.set_field('#yesno', {1:True, 3:False})
+            c.rename_items('tags', {c.get_item_id('tags', 'a'):'Tag Two'})
+            c.remove_items('publisher', c.all_field_ids('publisher'))
+        compare(dc, cc)
+        for c in (dc, cc):
+            c.remove_books((2,))
+        compare(dc, cc)
+        for c in (dc, cc):
+            c.close()
+
+        # Exercise compaction of the overlay
+        col = LinkColumn({1:{1, 2}}, as_sets=True)
+        for i in range(10000):
+            col[i].add(i)
+        self.assertEqual(col[1], {1, 2})
+        self.assertEqual(len(col), 10000)
+        self.assertEqual(col.get(9999), {9999})
+        vc = ValueColumn({1:'a'})
+        for i in range(20000):
+            vc[1] = str(i)
+        self.assertEqual(vc[1], '19999')
+        self.assertLess(len(vc.pool), 10000)
+        self.assertEqual(len(vc), 1)
+        # }}}
+
     def test_sorting(self):  # {{{
         'Test sorting'
         cache = self.init_cache()
@@ -221,6 +289,44 @@ def test_sorting(self):  # {{{
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
     # }}}
 
+    def test_sort_key_index(self):  # {{{
+        'Test the persistent sort key index'
+        path = self.cloned_library
+        cache = self.init_cache(path)
+        ae = self.assertEqual
+        index = cache.sort_key_index
+        ae(cache.multisort([('title', True)]), [2, 1, 3])
+        ae(set(index.maps['title']), {1, 2, 3})
+        ae(cache.multisort([('series', True), ('title', False)]), [3, 2, 1])
+        ae(set(index.maps['series']), {1, 2, 3})
+        self.assertNotIn('size', index.maps)
+        # Only changed books are removed from the index
+        cache.set_field('title', {3: 'AAA'})
+        ae(set(index.maps['title']), {1, 2})
+        ae(cache.multisort([('title', True)]), [3, 2, 1])
+        cache.rename_items('series', {cache.get_item_id('series', 'A Series One'): 'ZZZ'})
+        ae(set(index.maps['series']), {3})
+        ae(cache.multisort([('series', True)]), [3, 2, 1])
+        ae(cache.multisort([('series', False)]), [1, 2, 3])
+        cache.remove_books((2,))
+        self.assertNotIn(2, index.maps['title'])
+        ae(cache.multisort([('title', True)]), [3, 1])
+        # The index is re-used after a restart
+        cache.close()
+        cache = self.init_cache(path)
+        index = cache.sort_key_index
+        ae(set(index.maps['title']), {1, 3})
+        ae(cache.multisort([('title', True)]), [3, 1])
+        ae(cache.multisort([('title', True)], ids_to_sort=(1, 3)), [3, 1])
+        # But not if metadata.db was changed by something else
+        cache.close()
+        dbpath = os.path.join(path, 'metadata.db')
+        os.utime(dbpath, ns=(os.stat(dbpath).st_atime_ns, os.stat(dbpath).st_mtime_ns + 10**9))
+        cache = self.init_cache(path)
+        ae(cache.sort_key_index.maps, {})
+        ae(cache.multisort([('title', True)]), [3, 1])
+    # }}}
+
     def test_get_metadata(self):  # {{{
         'Test get_metadata() returns the same data for both backends'
         from calibre.library.database2 import LibraryDatabase2
@@ -607,6 +713,84 @@ def test(hit, result, *args, **kw):
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
     # }}}
 
+    def test_book_id_set(self):  # {{{
+        ' Test the bitmap sets used for search results '
+        import random
+
+        from calibre.db.bitmap import BookIdSet
+        ae = self.assertEqual
+        for i in range(100):
+            a = {random.randrange(1000) for x in range(random.randrange(200))}
+            b = {random.randrange(1200) for x in range(random.randrange(200))}
+            ba, bb = BookIdSet(a), BookIdSet(b)
+            ae(ba, a), ae(len(ba), len(a)), ae(set(ba), a)
+            ae(bool(ba), bool(a))
+            for x in (bb, b):
+                ae(ba & x, a & b), ae(ba | x, a | b), ae(ba - x, a - b), ae(ba ^ x, a ^ b)
+                ae(ba <= x, a <= b), ae(ba >= x, a >= b), ae(ba.isdisjoint(x), a.isdisjoint(b))
+            ae(a & bb, a & b), ae(a | bb, a | b), ae(a - bb, a - b)
+            ae(ba.intersection(list(b)), a & b), ae(ba.union(list(b)), a | b), ae(ba.difference(list(b)), a - b)
+            for x in range(1100):
+                ae(x in ba, x in a)
+        self.assertNotIn(-1, ba), self.assertNotIn('x', ba)
+        # equal sets must hash equal, so that they can be used as keys interchangeably
+        ae(hash(ba), hash(frozenset(a))), ae(hash(BookIdSet()), hash(frozenset()))
+        ae({frozenset(a): 1}[ba], 1)
+        # in place operations on plain sets must keep them plain sets
+        s = set(a)
+        s -= bb
+        self.assertIs(type(s), set), ae(s, a - b)
+        s |= bb
+        self.assertIs(type(s), set), ae(s, a | b)
+        s &= bb
+        self.assertIs(type(s), set), ae(s, b)
+        s ^= ba
+        self.assertIs(type(s), set), ae(s, a ^ b)
+        self.assertIsInstance(frozenset(a) - bb, BookIdSet)
+
+        cache = self.init_cache()
+        c = cache._search_api.cache
+        ans = cache.search('title:"=Title One" or title:"=Title Two"')
+        ae(ans, {1, 2})
+        self.assertIs(type(ans), set)
+        self.assertIsInstance(c.item_map['title:"=Title One" or title:"=Title Two"'], BookIdSet)
+        ans.add(3)  # Modifying the result must not change the cached value
+        ae(cache.search('title:"=Title One" or title:"=Title Two"'), {1, 2})
+        ae(cache.search('title:"=Title One" or title:"=Title Two"', book_ids={1, 3}), {1})
+        ae(cache.search('not title:"=Title One"'), set(cache.all_book_ids()) - {2})
+        cache.set_field('title', {3: 'Title Two'})
+        ae(cache.search('title:"=Title One" or title:"=Title Two"'), {1, 2, 3})
+        cache.remove_books((2,))
+        ae(cache.search('title:"=Title One" or title:"=Title Two"'), {1, 3})
+        ae(cache.search(''), set(cache.all_book_ids()))
+    # }}}
+
+    def test_search_planner(self):  # {{{
+        ' Test the ordering of the terms of an and by estimated cost '
+        cache = self.init_cache()
+        ae = self.assertEqual
+
+        def terms(plan):
+            return [term for depth, term, cost, candidates, matches, elapsed in plan if depth > 0]
+
+        q = 'template:"{#formats}#@#:t:fmt1" and comments:~two and identifiers:=test:two and formats:true'
+        matches, plan = cache.explain_search(q)
+        ae(matches, {1}), ae(cache.search(q), {1})
+        ae(plan[0][1], 'and')
+        ae(terms(plan), ['identifiers:=test:two', 'formats:true', 'comments:~two', 'template:{#formats}#@#:t:fmt1'])
+        ae([row[3] for row in plan[1:]], [3, 1, 1, 1])
+        # Evaluation stops as soon as there are no candidates
+        for q in ('template:"{#formats}#@#:t:fmt1" and title:=nomatch', 'title:=nomatch template:"{#formats}#@#:t:fmt1"'):
+            matches, plan = cache.explain_search(q)
+            ae(matches, set()), ae(terms(plan), ['title:=nomatch'])
+        # Terms inside or and not are planned too
+        matches, plan = cache.explain_search('not (template:"{#formats}#@#:t:fmt1" and title:"=Title One") or id:3')
+        ae(matches, {1, 3}), ae(cache.search('not (template:"{#formats}#@#:t:fmt1" and title:"=Title One") or id:3'), {1, 3})
+        ae(terms(plan)[:3], ['not', 'and', 'title:=Title One'])
+        matches, plan = cache.explain_search('title:one', restriction='tags:"=Tag One"')
+        ae(matches, {2})
+    # }}}
+
     def test_proxy_metadata(self):  # {{{
         ' Test the ProxyMetadata object used for composite columns '
         from calibre.ebooks.metadata.book.base import STANDARD_METADATA_FIELDS
@@ -774,6 +958,58 @@ def test_composites(self):  # {{{
         self.assertEqual('FMT2', cache.field_for('#ccf', 1))
     # }}}
 
+    def test_composite_cache(self):  # {{{
+        ' Test the on-disk cache of composite column values '
+        path = self.cloned_library
+        cache = self.init_cache(path)
+        cache.create_custom_column('ccp', 'CC1', 'composite', False, display={'composite_template': '{publisher}'})
+        cache.create_custom_column('cct', 'CC2', 'composite', False, display={'composite_template': "{:'today()'}"})
+        # Columns that refer to other composite columns are only persisted if
+        # those columns are
+        cache.create_custom_column('ccr', 'CC3', 'composite', False, display={'composite_template': '{#cct}'})
+        cache.create_custom_column('ccs', 'CC4', 'composite', False, display={'composite_template': "program: field('#ccp')"})
+        cache.close()
+        ae = self.assertEqual
+
+        cache = self.init_cache(path)
+        self.assertIsNone(cache.fields['#cct'].persistent_cache)
+        self.assertIsNone(cache.fields['#ccr'].persistent_cache)
+        self.assertIsNotNone(cache.fields['#ccs'].persistent_cache)
+        ae(cache.multisort([('#ccp', True)]), [3, 2, 1])
+        cache.set_field('publisher', {1: 'AAA'})
+        ae(cache.field_for('#ccp', 1), 'AAA')
+        cache.close()
+
+        # Values are loaded from disk rather than rendered
+        cache = self.init_cache(path)
+        ccp = cache.fields['#ccp']
+        self.assertIsNotNone(ccp.persistent_cache)
+        ae({book_id: ccp._cached_value(book_id) for book_id in (1, 2, 3)}, {1: 'AAA', 2: 'Publisher One', 3: ''})
+        # Values for books that changed in some other way are not used
+        cache.backend.execute("UPDATE publishers SET name='Changed' WHERE name='Publisher One'")
+        cache.backend.execute("UPDATE books SET last_modified='2020-01-01 00:00:00+00:00' WHERE id=2")
+        cache.close()
+        cache = self.init_cache(path)
+        ae(cache.field_for('#ccp', 2), 'Changed')
+        ae(cache.field_for('#ccp', 1), 'AAA')
+        cache.set_field('publisher', {1: 'BBB'})
+        ae(cache.field_for('#ccp', 1), 'BBB')
+
+        # The warm-up thread renders all values
+        cache.clear_composite_caches()
+        cache.start_composite_cache_warmup().join()
+        ae(cache.fields['#ccp']._render_cache, {1: 'BBB', 2: 'Changed', 3: ''})
+        self.assertEqual(len(cache.fields['#cct']._render_cache), 3)
+        cache.close()
+        # Closing joins the warm-up thread and the values database is not
+        # re-opened by it
+        cache = self.init_cache(path)
+        t = cache.start_composite_cache_warmup()
+        cache.close()
+        self.assertFalse(t.is_alive())
+        self.assertIsNone(cache.composite_cache.conn)
+    # }}}
+
     def test_find_identical_books(self):  # {{{
         ' Test find_identical_books '
         from calibre.db.utils import find_identical_books
@@ -959,3 +1195,101 @@ def evaluate(book, ctx):
         unload_user_template_functions('aaaaa')
         self.assertEqual(set(v.split(',')), {'Tag One', 'News', 'Tag Two', 'one argument'})
     # }}}
+
+    def test_lazy_tables(self):  # {{{
+        ' Test that tables are read from the db only when first used '
+        def init_lazy_cache(library_path):
+            os.environ['CALIBRE_LAZY_TABLES'] = '1'
+            try:
+                return self.init_cache(library_path)
+            finally:
+                del os.environ['CALIBRE_LAZY_TABLES']
+
+        cache = init_lazy_cache(self.cloned_library)
+        tables = cache.backend.tables
+        self.assertTrue(tables['uuid'].is_loaded)
+        self.assertFalse(tables['tags'].is_loaded)
+        self.assertNotIn('tags', cache.backend.table_load_times)
+        self.assertEqual(set(cache.field_for('tags', 1)), {'Tag One', 'News'})
+        self.assertTrue(tables['tags'].is_loaded)
+        self.assertIn('tags', cache.backend.table_load_times)
+        self.assertFalse(tables['series'].is_loaded)
+        self.assertEqual(cache.search('series:"=A Series One"'), {1, 2})
+        self.assertTrue(tables['series'].is_loaded)
+        self.assertFalse(tables['publisher'].is_loaded)
+        # Changes to tables that have not been read are not lost, all tables
+        # are read before the first change
+        cache.set_field('publisher', {1: 'Changed'})
+        self.assertTrue(all(t.is_loaded for t in tables.values()))
+        self.assertEqual(cache.field_for('publisher', 1), 'Changed')
+        cache.reload_from_db()
+        self.assertEqual(cache.field_for('publisher', 1), 'Changed')
+        self.assertRaises(AttributeError, getattr, tables['title'], 'no_such_attribute')
+
+        # Items used only by removed books are removed, even if their tables
+        # had not been read when the books were removed
+        library_path = self.cloned_library
+        cache = init_lazy_cache(library_path)
+        tables = cache.backend.tables
+        self.assertFalse(tables['#series'].is_loaded)
+        cache.remove_books((1,))
+        self.assertNotIn('My Series Two', set(tables['#series'].id_map.values()))
+        self.assertNotIn(1, tables['#series'].book_col_map)
+        cache = init_lazy_cache(library_path)
+        self.assertNotIn('My Series Two', set(cache.get_id_map('#series').values()))
+
+        # Compare with reading all tables at once
+        eager = self.init_cache(self.library_path)
+        self.assertTrue(all(t.is_loaded for t in eager.backend.tables.values()))
+        cache = init_lazy_cache(self.library_path)
+        for field in ('title', 'authors', 'tags', 'formats', 'identifiers', 'rating', '#series', '#tags'):
+            self.assertEqual(cache.all_field_for(field, cache.all_book_ids()), eager.all_field_for(field, eager.all_book_ids()), field)
+    # }}}
+
+    def test_compiled_templates(self):  # {{{
+        'Test that compiled templates give the same results as the interpreter'
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        formatter = SafeFormat()
+        db = self.init_legacy(self.library_path)
+        mi = db.get_metadata(1)
+        templates = (
+            'program: a = 3; b = 4; if a <# b then "less" elif a ==# b then "same" else "more" fi',
+            'program: for x in "a,b,c": if x == "b" then break fi; y = x rof',
+            'program: for i in range(1, 5): if i ==# 3 then continue fi; r = strcat(r, i) rof; r',
+            'program: r = ""; for t in $tags: r = r & uppercase(t) rof; r',
+            'program: strcat($title, " - ", field("publisher")) & $$series_index',
+            'program: first_non_empty($comments, "", $identifiers)',
+            'program: switch($title, "one", "1", "two", "2", "other")',
+            'program: switch_if($#missing, "x", "1", "yes", "default")',
+            'program: contains($title, "two", "y", "n")',
+            'program: 1 + 2 * 3 - 4 / 8 + -$series_index',
+            'program: "a" in "xaz" && !("b" in "c") || ""',
+            'program: def f(a, b): a & b fed; f($title, "y")',
+            'program: return "ret"; "not reached"',
+            'program: character("newline") & character("tab")',
+            'program: undefined_identifier',
+            'program: 1 + "not a number"',
+            'program: character("xxx")',
+            'program: field("no_such_field")',
+            'program: break',
+        )
+        for template in templates:
+            results = []
+            for compiled in (False, True):
+                formatter.compile_templates = compiled
+                results.append(formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi, column_name='x', template_cache={}))
+            self.assertEqual(results[0], results[1], template)
+        # The cache is keyed by column name and template text
+        template_cache = {}
+        for template, expected in (('program: "a"', 'a'), ('program: "b"', 'b')):
+            self.assertEqual(formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi, column_name='x', template_cache=template_cache), expected)
+            self.assertEqual(formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi, template_cache=template_cache), expected)
+        self.assertEqual(set(template_cache), {'x', 'program:'})
+        self.assertEqual(set(template_cache['program:']), {' "a"', ' "b"'})
+        # Templates without a column name are kept in a size limited cache
+        from calibre.utils.formatter import MAX_CACHED_TEMPLATES_WITHOUT_COLUMN
+        for i in range(MAX_CACHED_TEMPLATES_WITHOUT_COLUMN + 10):
+            self.assertEqual(formatter.safe_format(f'program: "{i}"', mi, 'TEMPLATE ERROR', mi, template_cache=template_cache), str(i))
+        self.assertEqual(len(template_cache['program:']), MAX_CACHED_TEMPLATES_WITHOUT_COLUMN)
+        self.assertIn(f' "{i}"', template_cache['program:'])
+    # }}}
@@ -80,4 +80,18 @@ def test_thumbnail_cache(self):  # {{{
         self.assertIsNone(c[1][0])
         self.assertEqual(len(c), 0)
         self.assertEqual(tuple(walk(c.location)), (os.path.join(c.location, 'version'),))
+
+        # Thumbnails added by another process are found with rescan()
+        c, other = self.init_tc(), self.init_tc()
+        self.basic_fill(c, num=1)
+        self.assertIsNone(c[7][0])
+        self.assertFalse(c.rescan(7))
+        other.insert(7, 7, b'7')
+        self.assertIsNone(c[7][0])
+        self.assertTrue(c.rescan(7))
+        self.assertEqual(c[7], (b'7', 7))
+        other.insert(7, 8, b'8')
+        self.assertTrue(c.rescan(7))
+        self.assertEqual(c[7], (b'8', 8))
+        self.assertEqual(c.current_size, 1000 + 1)
     # }}}
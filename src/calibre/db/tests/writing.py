@@ -506,6 +506,31 @@ def test_set_metadata(self):  # {{{
 
     # }}}
 
+    def test_set_metadata_many(self):  # {{{
+        ' Test setting metadata for many books at once '
+        cache = self.init_cache(self.cloned_library)
+        mis = {book_id: cache.get_metadata(book_id, get_cover=True, cover_as_data=True) for book_id in cache.all_book_ids()}
+        changes = {1: mis[3], 2: mis[1], 3: mis[2]}
+        changes[1].title, changes[1].authors = 'New Title', ['New Author', 'Other Author']
+        changes[2].tags, changes[2].identifiers = ['t1', 't2'], {'isbn': '1234'}
+        changes[3].author_sort = None
+        for force_changes in (False, True):
+            expected = self.init_cache(self.cloned_library)
+            for book_id, mi in changes.items():
+                expected.set_metadata(book_id, mi.deepcopy(), force_changes=force_changes)
+            cache = self.init_cache(self.cloned_library)
+            dirtied = cache.set_metadata_many({k: mi.deepcopy() for k, mi in changes.items()}, force_changes=force_changes)
+            self.assertEqual(dirtied, set(changes))
+            for book_id in changes:
+                emi, nmi = expected.get_metadata(book_id, get_cover=True, cover_as_data=True), cache.get_metadata(book_id, get_cover=True, cover_as_data=True)
+                self.assertEqual(emi.cover_data, nmi.cover_data)
+                self.compare_metadata(nmi, emi, exclude={'last_modified', 'format_metadata'})
+                self.assertEqual(expected.field_for('path', book_id), cache.field_for('path', book_id))
+            self.assertEqual(cache.field_for('path', 1), 'New Author/New Title (1)')
+            self.assertTrue(cache.has_format(1, 'FMT1'))
+
+    # }}}
+
     def test_conversion_options(self):  # {{{
         ' Test saving of conversion options '
         cache = self.init_cache()
@@ -707,6 +732,42 @@ def test_invalidate():
         test_invalidate()
     # }}}
 
+    def test_category_index(self):  # {{{
+        ' Test that the Tag browser data is properly updated on writes '
+        cache = self.init_cache()
+        cache.get_categories()
+        vl = {1, 2}
+
+        def as_tuples(categories):
+            return {k:[(t.name, t.id, t.count, t.sort, t.avg_rating, set(t.id_set)) for t in v] for k, v in categories.items()}
+
+        def test_invalidate():
+            c = self.init_cache()
+            self.assertEqual(as_tuples(cache.get_categories()), as_tuples(c.get_categories()))
+            self.assertEqual(as_tuples(cache.get_categories(book_ids=vl)), as_tuples(c.get_categories(book_ids=vl)))
+
+        test_invalidate()
+        self.assertTrue(cache.category_index.aggregates['tags'])
+        cache.set_field('rating', {1:2, 2:10})
+        test_invalidate()
+        cache.set_field('tags', {1:('Tag One', 'New Tag'), 3:('Tag Two',)})
+        test_invalidate()
+        cache.set_field('series', {2:'A Series One', 3:'Another Series'})
+        test_invalidate()
+        cache.set_field('languages', {1:('fra',)})
+        test_invalidate()
+        cache.rename_items('tags', {cache.get_item_id('tags', 'Tag One'):'xxx'})
+        test_invalidate()
+        cache.remove_items('tags', (cache.get_item_id('tags', 'xxx'),))
+        test_invalidate()
+        cache.set_sort_for_authors({cache.get_item_id('authors', 'Author One'):'meow'})
+        test_invalidate()
+        cache.add_books([(Metadata('new book', ['Author One']), {})])
+        test_invalidate()
+        cache.remove_books((1,))
+        test_invalidate()
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         ' Test roundtripping the db through SQL '
         import warnings
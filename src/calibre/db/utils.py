@@ -106,6 +106,11 @@ class CacheError(Exception):
     pass
 
 
+def parse_thumbnail_name(name):
+    book_id, timestamp, size, thumbnail_size = name.split('-')
+    return int(book_id), float(timestamp), int(size), tuple(map(int, thumbnail_size.partition('x')[0::2]))
+
+
 class ThumbnailCache:
 
     ' This is a persistent disk cache to speed up loading and resizing of covers '
@@ -211,9 +216,7 @@ def record(line):
             for entry in entries:
                 try:
                     uuid, name = entry.split('/')[0::2]
-                    book_id, timestamp, size, thumbnail_size = name.split('-')
-                    book_id, timestamp, size = int(book_id), float(timestamp), int(size)
-                    thumbnail_size = tuple(map(int, thumbnail_size.partition('x')[0::2]))
+                    book_id, timestamp, size, thumbnail_size = parse_thumbnail_name(name)
                 except (ValueError, TypeError, IndexError, KeyError, AttributeError):
                     continue
                 key = (uuid, book_id)
@@ -365,6 +368,40 @@ def __getitem__(self, book_id):
                 return None, None
             return data, entry.timestamp
 
+    def rescan(self, book_id):
+        '''
+        Look for the newest thumbnail of the current size for book_id on disk
+        and use it instead of the one in the index, if any. The index is only
+        read once, so this is needed to find the thumbnails added by other
+        processes that use the same cache. Returns True if a thumbnail was
+        found.
+        '''
+        with self.lock:
+            if not hasattr(self, 'total_size'):
+                self._load_index()
+            self._invalidate_sizes()
+            key = (self.group_id, book_id)
+            base = os.path.join(self.location, self.group_id, str(book_id % 100))
+            found = None
+            try:
+                names = os.listdir(base)
+            except OSError:
+                names = ()
+            for name in names:
+                try:
+                    bid, timestamp, size, thumbnail_size = parse_thumbnail_name(name)
+                except (ValueError, TypeError):
+                    continue
+                if bid == book_id and thumbnail_size == self.thumbnail_size and (found is None or timestamp > found.timestamp):
+                    found = Entry(os.path.join(base, name), size, timestamp, thumbnail_size)
+            if found is None:
+                return False
+            e = self.items.pop(key, None)
+            self.total_size -= getattr(e, 'size', 0)
+            self.items[key] = found
+            self.total_size += found.size
+            return True
+
     def invalidate(self, book_ids):
         with self.lock:
             if hasattr(self, 'total_size'):
@@ -505,6 +542,17 @@ def complete(self):
     def almost_complete(self):
         return self.complete or (self.left / self.total) < 0.1
 
+    @property
+    def books_per_minute(self):
+        if self.indexing_rate is not None:
+            return self.indexing_rate * 60
+
+    @property
+    def throughput(self):
+        if self.books_per_minute is None:
+            return _('measuring speed')
+        return _('{:.1f} books per minute').format(self.books_per_minute)
+
     @property
     def time_left(self):
         if self.left < 0:
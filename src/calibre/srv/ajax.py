@@ -197,39 +197,42 @@ def books(ctx, rd, library_id):
     If id_is_uuid is true then the book_id is assumed to be a book uuid instead.
     '''
     db = get_db(ctx, rd, library_id)
-    with db.safe_read_lock:
-        id_is_uuid = rd.query.get('id_is_uuid', 'false')
-        ids = rd.query.get('ids')
-        if ids is None or ids == 'all':
-            ids = db.all_book_ids()
-        else:
-            ids = ids.split(',')
-            if id_is_uuid == 'true':
-                ids = {db.lookup_by_uuid(x) for x in ids}
-                ids.discard(None)
+    id_is_uuid = rd.query.get('id_is_uuid', 'false')
+    ids = rd.query.get('ids')
+    category_urls = rd.query.get('category_urls', 'true').lower() == 'true'
+    device_compatible = rd.query.get('device_compatible', 'false').lower() == 'true'
+    device_for_template = rd.query.get('device_for_template', None)
+
+    def generate():
+        with db.safe_read_lock:
+            if ids is None or ids == 'all':
+                book_ids = db.all_book_ids()
             else:
-                try:
-                    ids = {int(x) for x in ids}
-                except Exception:
-                    raise HTTPNotFound('ids must a comma separated list of integers')
-        last_modified = None
-        category_urls = rd.query.get('category_urls', 'true').lower() == 'true'
-        device_compatible = rd.query.get('device_compatible', 'false').lower() == 'true'
-        device_for_template = rd.query.get('device_for_template', None)
-        ans = {}
-        allowed_book_ids = ctx.allowed_book_ids(rd, db)
-        for book_id in ids:
-            if book_id not in allowed_book_ids:
-                ans[book_id] = None
-                continue
-            data, lm = book_to_json(
-                ctx, rd, db, book_id, get_category_urls=category_urls,
-                device_compatible=device_compatible, device_for_template=device_for_template)
-            last_modified = lm if last_modified is None else max(lm, last_modified)
-            ans[book_id] = data
-    if last_modified is not None:
-        rd.outheaders['Last-Modified'] = http_date(timestampfromdt(last_modified))
-    return ans
+                book_ids = ids.split(',')
+                if id_is_uuid == 'true':
+                    book_ids = {db.lookup_by_uuid(x) for x in book_ids}
+                    book_ids.discard(None)
+                else:
+                    try:
+                        book_ids = {int(x) for x in book_ids}
+                    except Exception:
+                        raise HTTPNotFound('ids must a comma separated list of integers')
+            last_modified = None
+            allowed_book_ids = ctx.allowed_book_ids(rd, db)
+            # The books are serialized one at a time, as they are generated
+            for book_id in book_ids:
+                if book_id not in allowed_book_ids:
+                    yield book_id, None
+                    continue
+                data, lm = book_to_json(
+                    ctx, rd, db, book_id, get_category_urls=category_urls,
+                    device_compatible=device_compatible, device_for_template=device_for_template)
+                last_modified = lm if last_modified is None else max(lm, last_modified)
+                yield book_id, data
+        if last_modified is not None:
+            rd.outheaders['Last-Modified'] = http_date(timestampfromdt(last_modified))
+
+    return ctx.cached_response(rd, db, ('books', ids or 'all', id_is_uuid == 'true', category_urls, device_compatible, device_for_template), generate)
 
 # }}}
 
@@ -250,9 +253,14 @@ def categories(ctx, rd, library_id):
 
     '''
     db = get_db(ctx, rd, library_id)
+    vl = rd.query.get('vl') or ''
+    return ctx.cached_response(rd, db, ('categories', vl), partial(categories_as_list, ctx, rd, db, vl))
+
+
+def categories_as_list(ctx, rd, db, vl):
     with db.safe_read_lock:
         ans = {}
-        categories = ctx.get_categories(rd, db, vl=rd.query.get('vl') or '')
+        categories = ctx.get_categories(rd, db, vl=vl)
         category_meta = db.field_metadata
         library_id = db.server_library_id
 
@@ -570,8 +578,12 @@ def search(ctx, rd, library_id):
     db = get_db(ctx, rd, library_id)
     query = rd.query.get('query')
     num, offset = get_pagination(rd.query)
-    with db.safe_read_lock:
-        return search_result(ctx, rd, db, query, num, offset, rd.query.get('sort', 'title'), rd.query.get('sort_order', 'asc'), rd.query.get('vl') or '')
+    sort, sort_order, vl = rd.query.get('sort', 'title'), rd.query.get('sort_order', 'asc'), rd.query.get('vl') or ''
+
+    def generate():
+        with db.safe_read_lock:
+            return search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl)
+    return ctx.cached_response(rd, db, ('search', query, num, offset, sort, sort_order, vl), generate)
 
 # }}}
 
@@ -7,9 +7,10 @@
 import os
 import tempfile
 import time
+from contextlib import suppress
 from functools import partial
 from hashlib import sha1
-from threading import Lock, RLock
+from threading import Event, Lock, RLock
 
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
@@ -18,6 +19,7 @@
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json
 from calibre.srv.render_book import RENDER_VERSION
+from calibre.srv.render_cache import RenderCache, content_hash
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_library_data
 from calibre.utils.filenames import rmtree
@@ -73,47 +75,72 @@ def safe_remove(x, is_file=None):
         pass
 
 
+_render_cache = None
+
+
+def render_cache():
+    global _render_cache
+    with cache_lock:
+        if _render_cache is None:
+            _render_cache = RenderCache(books_cache_dir())
+        return _render_cache
+
+
+def rendered_books_cache_stats():
+    ' The statistics of the cache of rendered books, None if it has not been used '
+    with cache_lock:
+        rc = _render_cache
+    if rc is not None:
+        return rc.stats()
+
+
+def load_manifest(bhash):
+    mpath = render_cache().manifest_path(bhash)
+    if mpath is not None:
+        try:
+            with open(mpath, 'rb') as f:
+                return jsonlib.load(f)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            render_cache().remove(bhash)
+
+
 def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
     global staging_cleaned
     tdir = os.path.join(books_cache_dir(), 's')
     if not staging_cleaned:
         staging_cleaned = True
+        # Other server processes may be rendering books, so only remove files
+        # left over from earlier runs
+        limit = time.time() - 24 * 60 * 60
         for x in os.listdir(tdir):
-            safe_remove(os.path.join(tdir, x))
+            x = os.path.join(tdir, x)
+            with suppress(OSError):
+                if os.path.getmtime(x) < limit:
+                    safe_remove(x)
     fd, pathtoebook = tempfile.mkstemp(prefix='', suffix=('.' + fmt.lower()), dir=tdir)
     with os.fdopen(fd, 'wb') as f:
         copy_format_to(f)
+    chash = content_hash(pathtoebook, fmt)
+    if render_cache().link(bhash, chash):
+        # The same book file has already been rendered, for example, from
+        # another library
+        safe_remove(pathtoebook)
+        manifest = load_manifest(bhash)
+        if manifest is not None:
+            return manifest, None
     tdir = tempfile.mkdtemp('', '', tdir)
     job_id = ctx.start_job(f'Render book {book_id} ({fmt})', 'calibre.srv.render_book', 'render', args=(
         pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
-        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
+        job_done_callback=job_done, job_data=(bhash, chash, pathtoebook, tdir, int(ctx.opts.max_render_cache_size * 1024 * 1024)))
     queued_jobs[bhash] = job_id
-    return job_id
-
-
-last_final_clean_time = 0
-
-
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
-    now = time.time()
-    if now - last_final_clean_time < interval:
-        return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
-        try:
-            tm = os.path.getmtime(os.path.join(fdir, x,  'calibre-book-manifest.json'))
-        except OSError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+    return None, job_id
 
 
 def job_done(job):
     with cache_lock:
-        bhash, pathtoebook, tdir = job.data
+        bhash, chash, pathtoebook, tdir, max_size = job.data
         queued_jobs.pop(bhash, None)
         safe_remove(pathtoebook)
         if job.failed:
@@ -121,51 +148,94 @@ def job_done(job):
             safe_remove(tdir, False)
         else:
             try:
-                clean_final()
-                dest = os.path.join(books_cache_dir(), 'f', bhash)
-                safe_remove(dest, False)
-                os.rename(tdir, dest)
+                render_cache().add(bhash, chash, tdir, max_size)
             except Exception:
                 import traceback
                 failed_jobs[bhash] = (False, traceback.format_exc())
 
 
-@endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
-def book_manifest(ctx, rd, book_id, fmt):
-    db, library_id = get_library_data(ctx, rd)[:2]
-    force_reload = rd.query.get('force_reload') == '1'
-    if plugin_for_input_format(fmt) is None:
-        raise HTTPNotFound('The format %s cannot be viewed' % fmt.upper())
-    if not ctx.has_id(rd, db, book_id):
-        raise BookNotFound(book_id, db)
+def manifest_or_job(ctx, db, book_id, fmt, force_reload=False):
+    ''' Return the manifest of the rendered book, if it is in the cache.
+    Otherwise start a job to render it. Returns (book hash data, manifest, job
+    id, failure), where failure is (was_aborted, traceback) if the last
+    attempt to render the book failed. '''
     with db.safe_read_lock:
         fm = db.format_metadata(book_id, fmt, allow_cache=False)
         if not fm:
-            raise HTTPNotFound(f'No {fmt} format for the book (id:{book_id}) in the library: {library_id}')
+            raise HTTPNotFound(f'No {fmt} format for the book (id:{book_id}) in the library: {db.server_library_id}')
         size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
         bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
+        hash_data = {'size': size, 'mtime': mtime, 'hash': bhash}
         with cache_lock:
-            mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
             if force_reload:
-                safe_remove(mpath, True)
-            try:
-                os.utime(mpath, None)
-                with open(mpath, 'rb') as f:
-                    ans = jsonlib.load(f)
-                ans['metadata'] = book_as_json(db, book_id)
-                user = rd.username or None
-                ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
-                ans['annotations_map'] = db.annotations_map_for_book(book_id, fmt, user_type='web', user=user or '*')
-                return ans
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise
+                render_cache().remove(bhash)
+            manifest = load_manifest(bhash)
+            if manifest is not None:
+                return hash_data, manifest, None, None
             x = failed_jobs.pop(bhash, None)
             if x is not None:
-                return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
+                return hash_data, None, None, x
             job_id = queued_jobs.get(bhash)
             if job_id is None:
-                job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+                manifest, job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+            return hash_data, manifest, job_id, None
+
+
+class Prerenderer:
+
+    ''' A server plugin that renders the books read by the most users, so that
+    they are already in the render cache when they are next opened '''
+
+    def __init__(self, ctx, num_books):
+        self.ctx, self.num_books = ctx, num_books
+        self.started, self.shutdown = Event(), Event()
+        self.job_ids = []
+
+    def start(self, loop):
+        self.log = loop.log
+        self.shutdown.clear()
+        self.started.set()
+        for library_id, book_id, fmt in last_read_cache().most_read(self.num_books):
+            if self.shutdown.is_set():
+                break
+            try:
+                self.prerender(library_id, book_id, fmt)
+            except Exception:
+                self.log.exception(f'Failed to pre-render book {book_id} ({fmt}) from library: {library_id}')
+
+    def stop(self):
+        self.shutdown.set()
+
+    def prerender(self, library_id, book_id, fmt):
+        if library_id not in self.ctx.library_broker.library_map or plugin_for_input_format(fmt) is None:
+            return
+        db = self.ctx.library_broker.get(library_id)
+        if db is None or not db.has_format(book_id, fmt):
+            return
+        job_id = manifest_or_job(self.ctx, db, book_id, fmt)[2]
+        if job_id is not None:
+            self.job_ids.append(job_id)
+
+
+@endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int}, lane='slow')
+def book_manifest(ctx, rd, book_id, fmt):
+    db = get_library_data(ctx, rd)[0]
+    force_reload = rd.query.get('force_reload') == '1'
+    if plugin_for_input_format(fmt) is None:
+        raise HTTPNotFound('The format %s cannot be viewed' % fmt.upper())
+    if not ctx.has_id(rd, db, book_id):
+        raise BookNotFound(book_id, db)
+    hash_data, ans, job_id, failure = manifest_or_job(ctx, db, book_id, fmt, force_reload)
+    if ans is not None:
+        # The rendered book can be shared with other libraries
+        ans['book_hash'] = hash_data
+        ans['metadata'] = book_as_json(db, book_id)
+        user = rd.username or None
+        ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
+        ans['annotations_map'] = db.annotations_map_for_book(book_id, fmt, user_type='web', user=user or '*')
+        return ans
+    if failure is not None:
+        return {'aborted':failure[0], 'traceback':failure[1], 'job_status':'finished'}
     status, result, tb, aborted = ctx.job_status(job_id)
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
 
@@ -177,9 +247,10 @@ def book_file(ctx, rd, book_id, fmt, size, mtime, name):
         raise BookNotFound(book_id, db)
     bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
     base = abspath(os.path.join(books_cache_dir(), 'f'))
-    mpath = abspath(os.path.join(base, bhash, name))
-    if not mpath.startswith(base):
+    mpath = render_cache().file_path(bhash, name)
+    if mpath is None or not abspath(mpath).startswith(base):
         raise HTTPNotFound(f'No book file with hash: {bhash} and name: {name}')
+    mpath = abspath(mpath)
     try:
         return rd.filesystem_file_with_custom_etag(open(mpath, 'rb'), bhash, name)
     except OSError as e:
@@ -42,10 +42,11 @@ def index(ctx, rd):
         if not p.path.endswith(b'/'):
             p = p._replace(path=p.path + b'/')
             raise HTTPRedirect(urlunparse(p).decode('utf-8'))
-    ans_file = open(P('content-server/index-generated.html'), 'rb')
+    path = P('content-server/index-generated.html')
     if not in_develop_mode:
-        return ans_file
-    return ans_file.read().replace(b'__IN_DEVELOP_MODE__', b'1')
+        return rd.precompressed_file(path) or open(path, 'rb')
+    with open(path, 'rb') as f:
+        return f.read().replace(b'__IN_DEVELOP_MODE__', b'1')
 
 
 @endpoint('/robots.txt', auth_required=False)
@@ -254,15 +255,22 @@ def books(ctx, rd):
     Optional: ?num=50&sort=timestamp.desc&library_id=<default library>
               &search=''&extra_books=''&vl=''
     '''
-    ans = {}
     try:
         num = int(rd.query.get('num', rd.opts.num_per_page))
     except Exception:
         raise HTTPNotFound('Invalid number of books: %r' % rd.query.get('num'))
     library_id, db, sorts, orders, vl = get_basic_query_data(ctx, rd)
-    ans = get_library_init_data(ctx, rd, db, num, sorts, orders, vl)
-    ans['library_id'] = library_id
-    return ans
+
+    def generate():
+        ans = get_library_init_data(ctx, rd, db, num, sorts, orders, vl)
+        ans['library_id'] = library_id
+        return ans
+    key = 'books-init', library_id, num, sorts, orders, vl, rd.query.get('search', ''), rd.query.get('extra_books', '')
+    # Changing these does not change the last modified time of the db
+    key += (
+        db.pref('book_display_fields', ()), db.pref('bools_are_tristate', True),
+        db.pref('book_details_vertical_categories', ()), db.is_fts_enabled())
+    return ctx.cached_response(rd, db, key, generate)
 
 
 @endpoint('/interface-data/init', postprocess=json)
@@ -8,7 +8,9 @@
 import errno
 import os
 import re
-from contextlib import suppress
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
 from functools import partial
 from io import BytesIO
 from json import load as load_json_file
@@ -25,8 +27,8 @@
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
 from calibre.srv.routes import endpoint, json
+from calibre.srv.thumbnails import cached_thumbnail, scale_thumbnail, store_thumbnail
 from calibre.srv.utils import get_db, get_use_roman, http_date
-from calibre.utils.config_base import tweaks
 from calibre.utils.date import timestampfromdt
 from calibre.utils.filenames import ascii_filename, atomic_rename, make_long_path_useable
 from calibre.utils.img import image_from_data, scale_image
@@ -47,8 +49,107 @@
 rename_counter = 0
 
 
+class FileCopyCache:
+
+    '''
+    Keeps track of the files copied out of the library into the fcache folder.
+    Each file has its own lock, so that a slow copy of a large book file does
+    not block requests for other files, and the least recently used files are
+    deleted when the total size of the folder exceeds the limit. Files that
+    are being written or served are never deleted.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        # Map of file name to size, least recently used first
+        self.entries = OrderedDict()
+        # Map of file name to [lock, number of threads using the lock]
+        self.file_locks = {}
+        # Map of file name to the number of open file objects serving it
+        self.readers = {}
+        self.total_size = self.hits = self.misses = self.evictions = 0
+
+    @contextmanager
+    def locked(self, fname):
+        with self.lock:
+            fl = self.file_locks.get(fname)
+            if fl is None:
+                fl = self.file_locks[fname] = [Lock(), 0]
+            fl[1] += 1
+        try:
+            with fl[0]:
+                yield
+        finally:
+            with self.lock:
+                fl[1] -= 1
+                if not fl[1]:
+                    del self.file_locks[fname]
+
+    def used(self, fname):
+        with self.lock:
+            self.hits += 1
+            if fname in self.entries:
+                self.entries.move_to_end(fname)
+
+    def serving(self, fname, f):
+        ' Protect fname from eviction until the file object f, used to serve it, is garbage collected '
+        with self.lock:
+            self.readers[fname] = self.readers.get(fname, 0) + 1
+        weakref.finalize(f, self.served, fname)
+        return f
+
+    def served(self, fname):
+        with self.lock:
+            if self.readers[fname] > 1:
+                self.readers[fname] -= 1
+            else:
+                del self.readers[fname]
+
+    def stored(self, fname, size, max_size):
+        ' Must be called with the lock for fname held. max_size is in bytes, zero for no limit. '
+        with self.lock:
+            self.misses += 1
+            self.total_size += size - self.entries.pop(fname, 0)
+            self.entries[fname] = size
+            remove = []
+            if max_size > 0 and self.total_size > max_size:
+                for q, qsize in self.entries.items():
+                    if self.total_size <= max_size:
+                        break
+                    if q != fname and q not in self.file_locks and q not in self.readers:
+                        remove.append(q)
+                        self.total_size -= qsize
+                for q in remove:
+                    del self.entries[q]
+                self.evictions += len(remove)
+        for q in remove:
+            # On Windows this works even if the file is open, as files are
+            # opened with share_open()
+            with suppress(OSError):
+                os.remove(q)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'files': len(self.entries), 'size': self.total_size,
+            }
+
+
+file_copy_caches = {}
+
+
+def file_copy_cache(tdir):
+    with lock:
+        ans = file_copy_caches.get(tdir)
+        if ans is None:
+            ans = file_copy_caches[tdir] = FileCopyCache()
+        return ans
+
+
 def reset_caches():
-    pass
+    with lock:
+        file_copy_caches.clear()
 
 
 def open_for_write(fname):
@@ -86,7 +187,16 @@ def safe_mtime():
             return os.path.getmtime(fname)
 
     mt = mtime if isinstance(mtime, (int, float)) else timestampfromdt(mtime)
-    with lock:
+    fcache = file_copy_cache(rd.tdir)
+
+    def copy():
+        ans = open_for_write(fname)
+        copy_func(ans)
+        ans.seek(0)
+        fcache.stored(fname, os.fstat(ans.fileno()).st_size, int(ctx.opts.max_file_cache_size * 1024 * 1024))
+        return ans
+
+    with fcache.locked(fname):
         previous_mtime = safe_mtime()
         if previous_mtime is None or previous_mtime < mt:
             if previous_mtime is not None:
@@ -102,19 +212,17 @@ def safe_mtime():
                     os.remove(dname)
                 else:
                     os.remove(fname)
-            ans = open_for_write(fname)
-            copy_func(ans)
-            ans.seek(0)
+            ans = copy()
         else:
             try:
                 ans = share_open(fname, 'rb')
                 used_cache = 'yes'
+                fcache.used(fname)
             except OSError as err:
                 if err.errno != errno.ENOENT:
                     raise
-                ans = open_for_write(fname)
-                copy_func(ans)
-                ans.seek(0)
+                ans = copy()
+        fcache.serving(fname, ans)
         if ctx.testing:
             rd.outheaders['Used-Cache'] = used_cache
             rd.outheaders['Tempfile'] = as_hex_unicode(fname)
@@ -155,10 +263,13 @@ def copy_func(dest):
         prefix += f'-{width}x{height}'
 
         def copy_func(dest):
-            buf = BytesIO()
-            db.copy_cover_to(book_id, buf)
-            quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
-            data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
+            mt = timestampfromdt(mtime)
+            data = cached_thumbnail(ctx.opts, library_id, book_id, width, height, mt)
+            if data is None:
+                buf = BytesIO()
+                db.copy_cover_to(book_id, buf)
+                data = scale_thumbnail(buf.getvalue(), width, height)
+                store_thumbnail(ctx.opts, library_id, book_id, width, height, mt, data)
             dest.write(data)
     return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, copy_func)
 
@@ -238,7 +349,7 @@ def static(ctx, rd, what):
     path = os.path.relpath(path, base).replace(os.sep, '/')
     path = P('content-server/' + path)
     try:
-        return share_open(path, 'rb')
+        return rd.precompressed_file(path) or share_open(path, 'rb')
     except OSError:
         raise HTTPNotFound()
 
@@ -280,8 +391,8 @@ def icon(ctx, rd, which):
             return share_open(path, 'rb')
         except OSError:
             raise HTTPNotFound()
-    with lock:
-        cached = os.path.join(rd.tdir, 'icons', '%d-%s.png' % (sz, which))
+    cached = os.path.join(rd.tdir, 'icons', '%d-%s.png' % (sz, which))
+    with file_copy_cache(rd.tdir).locked(cached):
         try:
             return share_open(cached, 'rb')
         except OSError:
@@ -154,7 +154,7 @@ def queue_job(ctx, rd, library_id, db, fmt, book_id, conversion_data):
     return job_id
 
 
-@endpoint('/conversion/start/{book_id}', postprocess=json, needs_db_write=True, types={'book_id': int}, methods=receive_data_methods)
+@endpoint('/conversion/start/{book_id}', postprocess=json, needs_db_write=True, types={'book_id': int}, methods=receive_data_methods, lane='slow')
 def start_conversion(ctx, rd, book_id):
     db, library_id = get_library_data(ctx, rd)[:2]
     if not ctx.has_id(rd, db, book_id):
@@ -11,10 +11,12 @@
 from calibre import as_unicode
 from calibre.constants import cache_dir, config_dir, is_running_from_develop
 from calibre.srv.bonjour import BonJour
+from calibre.srv.books import Prerenderer
 from calibre.srv.handler import Handler
 from calibre.srv.http_response import create_http_handler
 from calibre.srv.loop import ServerLoop
 from calibre.srv.opts import server_config
+from calibre.srv.thumbnails import ThumbnailPregenerator
 from calibre.srv.utils import RotatingLog
 
 
@@ -68,6 +70,10 @@ def __init__(self, library_broker, notify_changes):
         plugins = self.plugins = []
         if opts.use_bonjour:
             plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
+        if opts.pregenerate_thumbnails:
+            plugins.append(ThumbnailPregenerator(self.handler.router.ctx.library_broker))
+        if opts.prerender_books > 0:
+            plugins.append(Prerenderer(self.handler.router.ctx, opts.prerender_books))
         self.opts = opts
         self.log, self.access_log = log, access_log
         self.handler.set_log(self.log)
@@ -86,7 +92,7 @@ def start(self):
         if self.current_thread is None:
             try:
                 self.loop = ServerLoop(
-                    create_http_handler(self.handler.dispatch),
+                    create_http_handler(self.handler.dispatch, lane_for=self.handler.lane_for),
                     opts=self.opts,
                     log=self.log,
                     access_log=self.access_log,
@@ -4,17 +4,22 @@
 import re
 
 from calibre.ebooks.metadata import authors_to_string
+from calibre.srv.ajax import get_pagination
 from calibre.srv.errors import HTTPBadRequest, HTTPPreconditionRequired, HTTPUnprocessableEntity
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data
 
 
-@endpoint('/fts/search', postprocess=json)
+@endpoint('/fts/search', postprocess=json, lane='slow')
 def fts_search(ctx, rd):
     '''
     Perform the specified full text query.
 
     Optional: ?query=<search query>&library_id=<default library>&use_stemming=<y or n>&query_id=arbitrary&restriction=arbitrary
+    &num=25&offset=0
+
+    When num is specified, only num results, starting at offset, are returned,
+    and total_num is the total number of results.
     '''
 
     db = get_library_data(ctx, rd)[0]
@@ -44,11 +49,19 @@ def add_metadata(result):
                 metadata_cache[bid] = {'title': db._field_for('title', bid), 'authors': authors_to_string(db._field_for('authors', bid))}
         return result
 
+    offset, limit = 0, None
+    if 'num' in rd.query:
+        limit, offset = get_pagination(rd.query)
+        ans['offset'] = offset
+
     from calibre.db import FTSQueryError
     try:
         ans['results'] = tuple(db.fts_search(
             query, use_stemming=use_stemming, return_text=False, process_each_result=add_metadata, restrict_to_book_ids=book_ids,
+            offset=offset, limit=limit,
         ))
+        if limit is not None:
+            ans['total_num'] = db.fts_count(query, use_stemming=use_stemming, restrict_to_book_ids=book_ids)
     except FTSQueryError as e:
         raise HTTPUnprocessableEntity(str(e))
     return ans
@@ -94,10 +107,12 @@ def fts_indexing(ctx, rd):
     return ''
 
 
-@endpoint('/fts/snippets/{book_ids}', postprocess=json)
+@endpoint('/fts/snippets/{book_ids}', postprocess=json, lane='slow')
 def fts_snippets(ctx, rd, book_ids):
     '''
     Perform the specified full text query and return the results with snippets restricted to the specified book ids.
+    The chapters of every snippet are the formats and spine indices where it occurs. When the library indexes
+    chapters separately, there are snippets for every matching chapter.
 
     Optional: ?query=<search query>&library_id=<default library>&use_stemming=<y or n>
     &query_id=arbitrary&snippet_size=32&highlight_start=\x1c&highlight_end=\x1e
@@ -133,7 +148,9 @@ def fts_snippets(ctx, rd, book_ids):
         ):
             r = snippets[x['book_id']]
             q = sanitize_pat.sub('', x['text'])
-            r.setdefault(q, {'formats': [], 'text': x['text'],})['formats'].append(x['format'])
+            s = r.setdefault(q, {'formats': [], 'text': x['text'], 'chapters': []})
+            s['formats'].append(x['format'])
+            s['chapters'].append({'format': x['format'], 'spine_index': x['spine_index']})
     except FTSQueryError as e:
         raise HTTPUnprocessableEntity(str(e))
     ans['snippets'] = {bid: tuple(v.values()) for bid, v in snippets.items()}
@@ -2,18 +2,25 @@
 # License: GPLv3 Copyright: 2015, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import hashlib
 import json
 from functools import partial
 from importlib import import_module
 from threading import Lock
 
 from calibre.srv.auth import AuthController
-from calibre.srv.errors import HTTPForbidden
+from calibre.srv.errors import HTTPForbidden, HTTPSimpleResponse
+from calibre.srv.http_response import ETaggedDynamicOutput, StaticOutput, parse_if_none_match
 from calibre.srv.library_broker import LibraryBroker, path_for_db
+from calibre.srv.metrics import metrics
 from calibre.srv.routes import Router
 from calibre.srv.users import UserManager
+from calibre.srv.utils import iterjson, spooled_output
 from calibre.utils.date import utcnow
+from calibre.utils.monotonic import monotonic
 from calibre.utils.search_query_parser import ParseException
+from calibre.utils.serialize import json_dumps
+from polyglot import http_client
 from polyglot.builtins import itervalues
 
 
@@ -24,6 +31,7 @@ class Context:
     jobs_manager = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
+    RESPONSE_CACHE_SIZE = 50
 
     def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.opts = opts
@@ -188,8 +196,47 @@ def search(self, request_data, db, query, vl='', report_restriction_errors=False
                 return old[1], None
             return old[1]
 
+    def cached_response(self, request_data, db, key, func):
+        ''' Return the output of func(), which must be JSON serializable,
+        cached by the state of db, the restriction of the current user and
+        key, which must identify the request. The ETag of the response is
+        derived from these, so conditional requests for unchanged data are
+        answered with 304 Not Modified without running func() or even
+        looking in the cache. func() can return a generator, see
+        :func:`iterjson`, which is serialized as it runs. Responses that are
+        too large to keep in memory are sent from a temporary file and not
+        cached. '''
+        restriction = self.restriction_for(request_data, db)
+        state = db.last_modified(), db.clear_search_cache_count
+        digest = hashlib.sha1(json_dumps([state[0].isoformat(), state[1], restriction, key])).hexdigest()
+        for etag in parse_if_none_match(request_data.inheaders.get('If-None-Match', '')):
+            # Compressed responses have the encoding appended to the ETag
+            if etag.strip('"').partition('-')[0] == digest:
+                return ETaggedDynamicOutput(lambda: b''.join(iterjson(func())), etag)
+        with self.lock:
+            cache = self.library_broker.response_caches[db.server_library_id]
+            old = cache.pop(digest, None)
+            if old is not None:
+                cache[digest] = old
+        metrics.inc('response_cache_misses' if old is None else 'response_cache_hits')
+        if old is None:
+            output = spooled_output(lambda f: f.writelines(iterjson(func())))
+            if not isinstance(output, bytes):
+                return request_data.filesystem_file_with_constant_etag(output, digest)
+            output = StaticOutput(output, digest=digest)
+            old = state, output, request_data.outheaders.get('Last-Modified')
+            with self.lock:
+                for k in tuple(k for k, v in cache.items() if v[0] != state):
+                    del cache[k]
+                cache[digest] = old
+                while len(cache) > self.RESPONSE_CACHE_SIZE:
+                    cache.popitem(last=False)
+        elif old[2]:
+            request_data.outheaders.set('Last-Modified', old[2], replace_all=True)
+        return old[1]
+
 
-SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert', 'fts')
+SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert', 'fts', 'metrics_api')
 
 
 class Handler:
@@ -208,7 +255,25 @@ def __init__(self, libraries, opts, testing=False, notify_changes=None):
             self.router.load_routes(itervalues(vars(module)))
         self.router.finalize()
         self.router.ctx.url_for = self.router.url_for
-        self.dispatch = self.router.dispatch
+
+    def lane_for(self, data):
+        try:
+            endpoint_, args = self.router.find_route(data.path)
+        except Exception:
+            return
+        return endpoint_.lane
+
+    def dispatch(self, data):
+        start, code = monotonic(), http_client.INTERNAL_SERVER_ERROR
+        try:
+            ans = self.router.dispatch(data)
+            code = data.status_code
+            return ans
+        except HTTPSimpleResponse as e:
+            code = e.http_code
+            raise
+        finally:
+            metrics.observe_request(data.route or 'unknown', code, monotonic() - start)
 
     def set_log(self, log):
         self.router.ctx.log = log
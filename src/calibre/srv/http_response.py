@@ -11,10 +11,11 @@
 import time
 import uuid
 from collections import namedtuple
-from functools import wraps
+from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
 from itertools import chain, repeat
 from operator import itemgetter
+from threading import Lock
 
 from calibre import force_unicode, guess_type
 from calibre.constants import __version__
@@ -32,6 +33,11 @@
 if isinstance(MULTIPART_SEPARATOR, bytes):
     MULTIPART_SEPARATOR = MULTIPART_SEPARATOR.decode('ascii')
 COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'application/oebps-package+xml'}
+# Files larger than this are not kept in the in memory cache of precompressed files
+MAX_PRECOMPRESSED_FILE_SIZE = 16 * 1024 * 1024
+# The number of seconds after which clients are asked to retry requests that
+# were refused because the server was busy
+BUSY_RETRY_AFTER = 5
 import zlib
 from itertools import zip_longest
 
@@ -100,6 +106,31 @@ def acceptable_encoding(val, allowed=frozenset({'gzip'})):  # {{{
 # }}}
 
 
+def precompressed_encoding(val, allowed):  # {{{
+    ' Like acceptable_encoding() except that zstd is preferred when the client accepts it '
+    accepted = tuple(x.lower() for x in sort_q_values(val))
+    if 'zstd' in allowed and 'zstd' in accepted:
+        return 'zstd'
+    for x in accepted:
+        if x in allowed:
+            return x
+# }}}
+
+
+def is_compressible_type(ct):
+    ct = (ct or '').partition(';')[0]
+    return not ct or ct.startswith('text/') or ct.startswith('image/svg') or ct in COMPRESSIBLE_TYPES
+
+
+def content_type_for_name(name):
+    mt = guess_type(name)[0]
+    if mt:
+        if mt in {'text/plain', 'text/html', 'application/javascript', 'text/css'}:
+            mt += '; charset=UTF-8'
+        return mt
+    return 'application/octet-stream'
+
+
 def preferred_lang(val, get_translator_for_lang):  # {{{
     for x in sort_q_values(val):
         x = x.lower()
@@ -188,6 +219,35 @@ def compress_readable_output(src_file, compress_level=6):
             data = gzip_prefix() + data
         yield data
     yield zobj.flush() + struct.pack(b"<L", crc & 0xffffffff) + struct.pack(b"<L", size)
+
+
+def zstd_compressor():
+    # zstd is in the stdlib only in python >= 3.14, otherwise use the
+    # zstandard package, if it is available
+    ans = getattr(zstd_compressor, 'ans', False)
+    if ans is False:
+        ans = None
+        try:
+            from compression import zstd
+            ans = partial(zstd.compress, level=19)
+        except ImportError:
+            try:
+                import zstandard
+                ans = zstandard.ZstdCompressor(level=19).compress
+            except ImportError:
+                pass
+        zstd_compressor.ans = ans
+    return ans
+
+
+def precompressed_encodings():
+    return frozenset({'gzip', 'zstd'}) if zstd_compressor() is not None else frozenset({'gzip'})
+
+
+def compress_data(data, encoding):
+    if encoding == 'zstd':
+        return zstd_compressor()(data)
+    return b''.join(compress_readable_output(ReadOnlyFileBuffer(data), compress_level=9))
 # }}}
 
 
@@ -217,6 +277,8 @@ class RequestData:  # {{{
 
     cookies = {}
     username = None
+    # The route of the endpoint handling the request
+    route = None
 
     def __init__(self, method, path, query, inheaders, request_body_file, outheaders, response_protocol,
                  static_cache, opts, remote_addr, remote_port, is_trusted_ip, translator_cache,
@@ -247,6 +309,15 @@ def generate_static_output(self, name, generator, content_type='text/html; chars
             self.outheaders.set('Content-Type', content_type, replace_all=True)
         return ans
 
+    def precompressed_file(self, path):
+        ''' Return the file at path from the in memory cache of precompressed
+        files or None if the file is not suitable for precompression. Raises
+        OSError if the file cannot be read. '''
+        ans = precompressed_files(path)
+        if ans is not None and not self.outheaders.get('Content-Type'):
+            self.outheaders.set('Content-Type', content_type_for_name(path), replace_all=True)
+        return ans
+
     def filesystem_file_with_custom_etag(self, output, *etag_parts):
         etag = hashlib.sha1()
         for i in etag_parts:
@@ -360,17 +431,80 @@ def __init__(self, output, etag=None):
 
 class StaticOutput:
 
-    def __init__(self, data):
+    ''' Data that does not change. It is compressed, at most once per
+    encoding, the first time a client that accepts that encoding requests it.
+    Every encoding has its own strong ETag. '''
+
+    def __init__(self, data, digest=None):
         if isinstance(data, str):
             data = data.encode('utf-8')
         self.data = data
-        self.etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        self.digest = digest or hashlib.sha1(data).hexdigest()
+        self.etag = '"%s"' % self.digest
         self.content_length = len(data)
+        self.compressed = {}
+        self.lock = Lock()
+
+    def encoded(self, encoding):
+        with self.lock:
+            ans = self.compressed.get(encoding)
+            if ans is None:
+                ans = self.compressed[encoding] = compress_data(self.data, encoding)
+        return ans
+
+    def encoded_etag(self, encoding):
+        return f'"{self.digest}-{encoding}"'
+
+
+class PrecompressedFiles:
+
+    ''' An in memory cache of StaticOutput objects for files that do not
+    change often, such as the static resources of the content server. Files
+    with identical contents share a single StaticOutput, so they are
+    compressed only once. '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.files = {}
+        self.by_hash = {}
+
+    def __call__(self, path):
+        ' Return a StaticOutput for the file at path or None if it is too large or not compressible '
+        st = os.stat(path)
+        if st.st_size > MAX_PRECOMPRESSED_FILE_SIZE or not is_compressible_type(guess_type(path)[0]):
+            return
+        key = st.st_mtime_ns, st.st_size
+        with self.lock:
+            q = self.files.get(path)
+            if q is not None and q[0] == key:
+                return self.by_hash[q[1]]
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            q = self.files.get(path)
+            self.files[path] = key, digest
+            if q is not None and q[1] != digest and not any(x[1] == q[1] for x in itervalues(self.files)):
+                del self.by_hash[q[1]]
+            ans = self.by_hash.get(digest)
+            if ans is None:
+                ans = self.by_hash[digest] = StaticOutput(data)
+            return ans
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+            self.by_hash.clear()
+
+
+precompressed_files = PrecompressedFiles()
 
 
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
+    # Returns the lane of worker threads for a request, see ThreadPool
+    lane_for = None
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -448,7 +582,7 @@ def prepare_response(self, inheaders, request_body_file):
             self.remote_addr, self.remote_port, self.is_trusted_ip,
             self.translator_cache, self.tdir, self.forwarded_for, self.request_original_uri
         )
-        self.queue_job(self.run_request_handler, data)
+        self.queue_job(self.run_request_handler, data, lane=None if self.lane_for is None else self.lane_for(data))
 
     def run_request_handler(self, data):
         result = self.request_handler(data)
@@ -480,7 +614,7 @@ def send_not_modified(self, etag=None):
         self.response_ready(response_data)
 
     def report_busy(self):
-        self.simple_response(http_client.SERVICE_UNAVAILABLE)
+        self.simple_response(http_client.SERVICE_UNAVAILABLE, extra_headers={'Retry-After': '%d' % BUSY_RETRY_AFTER})
 
     def job_done(self, ok, result):
         if not ok:
@@ -652,6 +786,7 @@ def finalize_output(self, output, request, is_http1):
 
         opts = self.opts
         outheaders = request.outheaders
+        precompressed = None
         stat_result = file_metadata(output)
         if stat_result is not None:
             output = filesystem_file_output(output, outheaders, stat_result)
@@ -659,27 +794,27 @@ def finalize_output(self, output, request, is_http1):
                 output_name = output.name
                 if not isinstance(output_name, string_or_bytes):
                     output_name = str(output_name)
-                mt = guess_type(output_name)[0]
-                if mt:
-                    if mt in {'text/plain', 'text/html', 'application/javascript', 'text/css'}:
-                        mt += '; charset=UTF-8'
-                    outheaders['Content-Type'] = mt
-                else:
-                    outheaders['Content-Type'] = 'application/octet-stream'
+                outheaders['Content-Type'] = content_type_for_name(output_name)
         elif isinstance(output, string_or_bytes):
             output = dynamic_output(output, outheaders)
         elif hasattr(output, 'read'):
             output = ReadableOutput(output)
         elif isinstance(output, StaticOutput):
-            output = ReadableOutput(ReadOnlyFileBuffer(output.data), etag=output.etag, content_length=output.content_length)
+            if (is_compressible_type(outheaders.get('Content-Type')) and request.status_code == http_client.OK and
+                    -1 < opts.compress_min_size <= output.content_length and not is_http1):
+                precompressed = precompressed_encoding(request.inheaders.get('Accept-Encoding', ''), precompressed_encodings())
+            if precompressed:
+                uncompressed_length = output.content_length
+                data = output.encoded(precompressed)
+                output = ReadableOutput(ReadOnlyFileBuffer(data), etag=output.encoded_etag(precompressed), content_length=len(data))
+                output.accept_ranges = False
+            else:
+                output = ReadableOutput(ReadOnlyFileBuffer(output.data), etag=output.etag, content_length=output.content_length)
         elif isinstance(output, ETaggedDynamicOutput):
             output = dynamic_output(output(), outheaders, etag=output.etag)
         else:
             output = GeneratedOutput(output)
-        ct = outheaders.get('Content-Type', '').partition(';')[0]
-        compressible = (not ct or ct.startswith('text/') or ct.startswith('image/svg') or
-                        ct.partition(';')[0] in COMPRESSIBLE_TYPES)
-        compressible = (compressible and request.status_code == http_client.OK and
+        compressible = (not precompressed and is_compressible_type(outheaders.get('Content-Type')) and request.status_code == http_client.OK and
                         (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
                         acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == http_client.OK and
@@ -708,6 +843,10 @@ def finalize_output(self, output, request, is_http1):
             outheaders.set('ETag', output.etag, replace_all=True)
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
+        if precompressed:
+            outheaders.set('Content-Encoding', precompressed, replace_all=True)
+            outheaders.set('Calibre-Uncompressed-Length', '%d' % uncompressed_length)
+            outheaders.set('Vary', 'Accept-Encoding', replace_all=True)
         if compressible and not ranges:
             outheaders.set('Content-Encoding', 'gzip', replace_all=True)
             if getattr(output, 'content_length', None):
@@ -735,7 +874,7 @@ def finalize_output(self, output, request, is_http1):
         return output
 
 
-def create_http_handler(handler=None, websocket_handler=None):
+def create_http_handler(handler=None, websocket_handler=None, lane_for=None):
     from calibre.srv.web_socket import WebSocketConnection
     static_cache = {}
     translator_cache = {}
@@ -748,6 +887,7 @@ def dummy_http_handler(data):
     def wrapper(*args, **kwargs):
         ans = WebSocketConnection(*args, **kwargs)
         ans.request_handler = handler
+        ans.lane_for = lane_for
         ans.websocket_handler = websocket_handler
         ans.static_cache = static_cache
         ans.translator_cache = translator_cache
@@ -74,6 +74,13 @@ def get_recently_read(self, user):
                 })
             return ans
 
+    def most_read(self, limit):
+        ' Return (library_id, book_id, fmt) for the books read by the most users, most recently read first among equals '
+        with lock:
+            return tuple(self.execute(
+                'SELECT library_id,book,format FROM last_read_positions GROUP BY library_id,book,format'
+                ' ORDER BY COUNT(*) DESC, MAX(epoch) DESC LIMIT ?', (limit,)))
+
 
 path_cache = {}
 
@@ -118,26 +118,51 @@ def __init__(self, libraries):
             self.library_name_map[library_id] = basename(corrected_path)
             self.original_path_map[path] = original_path
         self.loaded_dbs = {}
-        self.category_caches, self.search_caches, self.tag_browser_caches = (
+        # Set when other processes may change the libraries, such as when
+        # the server runs in more than one process
+        self.check_for_external_changes = False
+        self.data_versions = {}
+        self.category_caches, self.search_caches, self.tag_browser_caches, self.response_caches = (
             defaultdict(OrderedDict), defaultdict(OrderedDict),
-            defaultdict(OrderedDict))
+            defaultdict(OrderedDict), defaultdict(OrderedDict))
 
     def get(self, library_id=None):
         with self:
             library_id = library_id or self.default_library
             if library_id in self.loaded_dbs:
-                return self.loaded_dbs[library_id]
-            path = self.lmap.get(library_id)
-            if path is None:
+                ans = self.loaded_dbs[library_id]
+            else:
+                path = self.lmap.get(library_id)
+                if path is None:
+                    return
+                try:
+                    self.loaded_dbs[library_id] = ans = self.init_library(
+                        path, library_id == self.default_library)
+                    ans.new_api.server_library_id = library_id
+                except Exception:
+                    self.loaded_dbs[library_id] = None
+                    raise
+        if self.check_for_external_changes and ans is not None:
+            self.reload_if_changed(library_id, ans.new_api)
+        return ans
+
+    def reload_if_changed(self, library_id, db):
+        ''' Re-read the in-memory data of db if another process has changed
+        books, their metadata or the preferences. data_version changes on
+        every commit by any process, including for things like last read
+        positions, so it is only used to decide when to check the much more
+        expensive metadata signature. '''
+        dv = db.data_version()
+        with self:
+            known = self.data_versions.get(library_id)
+            if known is not None and known[0] == dv:
                 return
-            try:
-                self.loaded_dbs[library_id] = ans = self.init_library(
-                    path, library_id == self.default_library)
-                ans.new_api.server_library_id = library_id
-            except Exception:
-                self.loaded_dbs[library_id] = None
-                raise
-            return ans
+        sig = db.metadata_signature()
+        with self:
+            known = self.data_versions.get(library_id)
+            self.data_versions[library_id] = dv, sig
+        if known is not None and known[1] != sig:
+            db.reload_from_db()
 
     def init_library(self, library_path, is_default_library):
         library_path = self.original_path_map.get(library_path, library_path)
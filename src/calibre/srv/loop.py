@@ -6,7 +6,7 @@
 
 import ipaddress
 import os
-import select
+import selectors
 import socket
 import ssl
 import traceback
@@ -20,6 +20,7 @@
 from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.errors import JobQueueFull
 from calibre.srv.jobs import JobsManager
+from calibre.srv.metrics import metrics
 from calibre.srv.opts import Options
 from calibre.srv.pool import PluginPool, ThreadPool
 from calibre.srv.utils import (
@@ -42,6 +43,9 @@
 from polyglot.queue import Empty, Full
 
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
+SELECTOR_EVENTS = {
+    READ: selectors.EVENT_READ, WRITE: selectors.EVENT_WRITE,
+    RDWR: selectors.EVENT_READ | selectors.EVENT_WRITE, WAIT: 0}
 WAKEUP, JOB_DONE = b'\0', b'\x01'
 IPPROTO_IPV6 = getattr(socket, "IPPROTO_IPV6", 41)
 
@@ -173,6 +177,13 @@ def is_local_address(addr: Union[ipaddress.IPv4Address, ipaddress.IPv6Address, N
 
 class Connection:  # {{{
 
+    _wait_for = None
+    # Set by the ServerLoop, called whenever wait_for changes, so that the
+    # loop can update the events the socket is registered for
+    wait_for_changed = None
+    # The events the socket is currently registered for with the loop's selector
+    registered_events = 0
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -220,6 +231,17 @@ def end_send_optimization(self):
         if self.send_bufsize != self.orig_send_bufsize:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.orig_send_bufsize)
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        if val is not self._wait_for:
+            self._wait_for = val
+            if self.wait_for_changed is not None:
+                self.wait_for_changed()
+
     def set_state(self, wait_for, func, *args, **kwargs):
         self.wait_for = wait_for
         if args or kwargs:
@@ -353,11 +375,11 @@ def close(self):
         except OSError:
             pass
 
-    def queue_job(self, func, *args):
+    def queue_job(self, func, *args, lane=None):
         if args:
             func = partial(func, *args)
         try:
-            self.pool.put_nowait(self.socket.fileno(), func)
+            self.pool.put_nowait(self.socket.fileno(), func, lane=lane)
         except Full:
             raise JobQueueFull()
         self.set_state(WAIT, self._job_done)
@@ -438,8 +460,10 @@ def __init__(
                 self.bind_address = self.pre_activated_socket.getsockname()
 
         self.create_control_connection()
-        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count)
+        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count, lanes={
+            'slow': (self.opts.slow_worker_count, self.opts.slow_queue_size)})
         self.plugin_pool = PluginPool(self, plugins)
+        metrics.server_loops.add(self)
 
     def on_ssl_servername(self, socket, server_name, ssl_context):
         c = self.connection_map.get(socket.fileno())
@@ -529,6 +553,13 @@ def serve(self):
         from calibre.utils.network import format_addr_for_url
 
         self.connection_map = {}
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket.fileno(), selectors.EVENT_READ)
+        self.selector.register(self.control_out.fileno(), selectors.EVENT_READ)
+        # Connections whose wait_for has changed or that have handled an
+        # event since the last tick
+        self.interest_changed = set()
+        self.last_timeout_check = monotonic()
         if not self.socket_was_preactivated:
             self.socket.listen(min(socket.SOMAXCONN, 128))
         self.bound_address = ba = self.socket.getsockname()
@@ -563,6 +594,10 @@ def serve_forever(self):
 
     def setup_socket(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.opts.worker_processes > 1 and hasattr(socket, 'SO_REUSEPORT'):
+            # Let the kernel distribute connections between the sockets of all
+            # the server processes
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
@@ -586,61 +621,64 @@ def bind(self, family, atype, proto=0):
 
     def tick(self):
         now = monotonic()
-        read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
+        readable, close_needed = [], []
         has_ssl = self.ssl_context is not None
-        for s, conn in iteritems(self.connection_map):
-            if now - conn.last_activity > self.opts.timeout:
-                if conn.handle_timeout():
-                    conn.last_activity = now
-                else:
-                    remove.append((s, conn))
-                    continue
+        if now - self.last_timeout_check >= self.opts.timeout / 2:
+            self.last_timeout_check = now
+            remove = []
+            for s, conn in iteritems(self.connection_map):
+                if now - conn.last_activity > self.opts.timeout:
+                    if conn.handle_timeout():
+                        conn.last_activity = now
+                    else:
+                        remove.append((s, conn))
+            for s, conn in remove:
+                self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
+                self.close(s, conn)
+
+        # Update the registrations of only those connections whose state has
+        # changed, checking them for data that has already been read from
+        # the socket, which the selector cannot know about
+        while self.interest_changed:
+            s = self.interest_changed.pop()
+            conn = self.connection_map.get(s)
+            if conn is None:
+                continue
+            self.update_registration(s, conn)
             wf = conn.wait_for
             if wf is READ or wf is RDWR:
-                if wf is RDWR:
-                    write_needed.append(s)
                 if conn.read_buffer.has_data:
                     readable.append(s)
-                else:
-                    if has_ssl:
-                        conn.drain_ssl_buffer()
-                        if conn.ready:
-                            (readable if conn.read_buffer.has_data else read_needed).append(s)
-                        else:
-                            close_needed.append((s, conn))
-                    else:
-                        read_needed.append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-
-        for s, conn in remove:
-            self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
+                elif has_ssl:
+                    conn.drain_ssl_buffer()
+                    if not conn.ready:
+                        close_needed.append((s, conn))
+                    elif conn.read_buffer.has_data:
+                        readable.append(s)
+
+        for s, conn in close_needed:
             self.close(s, conn)
 
-        for x, conn in close_needed:
-            self.close(s, conn)
-
-        if readable:
-            writable = []
-        else:
-            try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
-            except ValueError:  # self.socket.fileno() == -1
-                self.ready = False
-                self.log.error('Listening socket was unexpectedly terminated')
-                return
-            except OSError as e:
-                # select.error has no errno attribute. errno is instead
-                # e.args[0]
-                if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
-                    return
-                for s, conn in tuple(iteritems(self.connection_map)):
-                    try:
-                        select.select([s], [], [], 0)
-                    except OSError as e:
-                        if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
-                            self.close(s, conn)  # Bad socket, discard
+        if self.socket is None or self.socket.fileno() < 0:
+            self.ready = False
+            self.log.error('Listening socket was unexpectedly terminated')
+            return
+        writable = []
+        try:
+            # Dont block if there is already data to process
+            events = self.selector.select(0 if readable else self.opts.timeout / 2)
+        except OSError as e:
+            if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                 return
+            for s, conn in tuple(iteritems(self.connection_map)):
+                if conn.socket.fileno() < 0:
+                    self.close(s, conn)  # Bad socket, discard
+            return
+        for key, mask in events:
+            if mask & selectors.EVENT_READ and key.fd not in readable:
+                readable.append(key.fd)
+            if mask & selectors.EVENT_WRITE:
+                writable.append(key.fd)
 
         if not self.ready:
             return
@@ -649,11 +687,13 @@ def tick(self):
         for s, conn, event in self.get_actions(readable, writable):
             if s in ignore:
                 continue
+            self.interest_changed.add(s)
             try:
                 conn.handle_event(event)
                 if not conn.ready:
                     self.close(s, conn)
             except JobQueueFull:
+                metrics.inc('busy')
                 self.log.exception('Server busy handling request: %s' % conn.state_description)
                 if conn.ready:
                     if conn.response_started:
@@ -706,8 +746,31 @@ def dispatch_job_results(self):
             if conn is not None:
                 yield s, conn, (ok, result)
 
+    def update_registration(self, s, conn):
+        events = SELECTOR_EVENTS[conn.wait_for]
+        if events == conn.registered_events:
+            return
+        try:
+            if not conn.registered_events:
+                self.selector.register(s, events)
+            elif events:
+                self.selector.modify(s, events)
+            else:
+                self.selector.unregister(s)
+        except (KeyError, ValueError, OSError):
+            # The socket has been closed
+            conn.ready = False
+            self.interest_changed.discard(s)
+            self.close(s, conn)
+        else:
+            conn.registered_events = events
+
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        if conn.registered_events:
+            conn.registered_events = 0
+            with suppress(KeyError, ValueError, OSError):
+                self.selector.unregister(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -721,6 +784,8 @@ def get_actions(self, readable, writable):
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        conn.wait_for_changed = partial(self.interest_changed.add, s)
+                        self.update_registration(s, conn)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -755,6 +820,7 @@ def accept(self):
         try:
             sock, addr = self.socket.accept()
             set_socket_inherit(sock, False), sock.setblocking(False)
+            metrics.inc('connections')
             return sock, addr
         except OSError:
             return None, None
@@ -771,6 +837,8 @@ def shutdown(self):
                 self.socket = None
         for s, conn in tuple(iteritems(self.connection_map)):
             self.close(s, conn)
+        with suppress(Exception):
+            self.selector.close()
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
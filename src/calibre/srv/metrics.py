@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Lightweight instrumentation of the content server: the time taken to handle
+requests for every route, the time requests wait for a worker thread, the
+state of the worker threads and of the caches. The measurements are exposed
+in the Prometheus text format by the /metrics endpoint. When the server runs
+in several processes, every process has its own measurements.
+'''
+
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from threading import Lock
+from weakref import WeakSet
+
+# The upper bounds, in seconds, of the buckets of the histograms
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+
+    def __init__(self):
+        # The last count is for values larger than all buckets
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.
+
+    def observe(self, val):
+        self.counts[bisect_left(BUCKETS, val)] += 1
+        self.total += val
+
+    def lines(self, name, labels=''):
+        sep = ',' if labels else ''
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}'
+        labels = '{%s}' % labels if labels else ''
+        yield f'{name}_sum{labels} {self.total}'
+        yield f'{name}_count{labels} {cumulative}'
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = defaultdict(Histogram)
+        self.responses = Counter()
+        self.queue_wait = Histogram()
+        self.counters = Counter()
+        # The server loops of this process, for the state of their worker threads
+        self.server_loops = WeakSet()
+
+    def observe_request(self, route, code, duration):
+        with self.lock:
+            self.requests[route].observe(duration)
+            self.responses[(route, code)] += 1
+
+    def observe_queue_wait(self, duration):
+        with self.lock:
+            self.queue_wait.observe(duration)
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear(), self.responses.clear(), self.counters.clear()
+            self.queue_wait = Histogram()
+
+
+metrics = Metrics()
+
+
+def escape_label(val):
+    return str(val).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def metric(name, mtype, help_text, samples):
+    ' Render a metric, samples is a list of (labels, value) where labels is a dict '
+    yield f'# HELP {name} {help_text}'
+    yield f'# TYPE {name} {mtype}'
+    for labels, val in samples:
+        labels = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+        yield f'{name}{{{labels}}} {val}' if labels else f'{name} {val}'
+
+
+def lock_wait_samples(library_broker):
+    with library_broker:
+        dbs = [(library_id, getattr(db, 'new_api', db)) for library_id, db in library_broker.loaded_dbs.items() if db is not None]
+    for library_id, db in dbs:
+        for mode, (count, total) in db.read_lock.wait_stats().items():
+            yield {'library_id': library_id, 'mode': mode}, count, total
+
+
+def render_metrics(library_broker):
+    ' Return the current measurements in the Prometheus text format '
+    from calibre.srv.books import rendered_books_cache_stats
+    from calibre.srv.content import file_copy_caches
+    from calibre.srv.content import lock as file_copy_lock
+    ans = []
+    w = ans.extend
+    prefix = 'calibre_server_'
+    with metrics.lock:
+        w(metric(prefix + 'requests_total', 'counter', 'The number of responses, by route and HTTP status code', (
+            ({'route': route, 'code': code}, num) for (route, code), num in sorted(metrics.responses.items(), key=str))))
+        w((f'# HELP {prefix}request_duration_seconds The time taken to handle requests, by route',
+           f'# TYPE {prefix}request_duration_seconds histogram'))
+        for route, h in sorted(metrics.requests.items()):
+            w(h.lines(prefix + 'request_duration_seconds', f'route="{escape_label(route)}"'))
+        w((f'# HELP {prefix}queue_wait_seconds The time requests wait for a worker thread',
+           f'# TYPE {prefix}queue_wait_seconds histogram'))
+        w(metrics.queue_wait.lines(prefix + 'queue_wait_seconds'))
+        counters = metrics.counters.copy()
+
+    pools = [loop.pool for loop in tuple(metrics.server_loops)]
+    w(metric(prefix + 'workers', 'gauge', 'The number of worker threads', (({}, sum(len(p.all_workers) for p in pools)),)))
+    w(metric(prefix + 'workers_busy', 'gauge', 'The number of worker threads handling a request', (({}, sum(p.busy for p in pools)),)))
+    w(metric(prefix + 'queue_depth', 'gauge', 'The number of requests waiting for a worker thread', (({}, sum(p.queue_depth for p in pools)),)))
+    w(metric(prefix + 'connections', 'gauge', 'The number of open connections', (
+        ({}, sum(loop.num_active_connections for loop in tuple(metrics.server_loops))),)))
+    w(metric(prefix + 'connections_total', 'counter', 'The number of accepted connections', (({}, counters['connections']),)))
+    w(metric(prefix + 'busy_responses_total', 'counter', 'The number of requests rejected because too many requests were waiting for worker threads', (
+        ({}, counters['busy']),)))
+
+    waits = tuple(lock_wait_samples(library_broker))
+    w(metric(prefix + 'db_lock_waits_total', 'counter', 'The number of times a thread had to wait for a database lock', (
+        (labels, count) for labels, count, total in waits)))
+    w(metric(prefix + 'db_lock_wait_seconds_total', 'counter', 'The time threads have spent waiting for database locks', (
+        (labels, total) for labels, count, total in waits)))
+
+    cache_stats = defaultdict(Counter)
+    for name in ('response', 'thumbnail'):
+        for event in ('hits', 'misses'):
+            cache_stats[name][event] = counters[f'{name}_cache_{event}']
+    with file_copy_lock:
+        fcaches = tuple(file_copy_caches.values())
+    for fc in fcaches:
+        cache_stats['file_copy'].update(fc.stats())
+    rstats = rendered_books_cache_stats()
+    if rstats is not None:
+        cache_stats['rendered_books'].update(rstats)
+    for event in ('hits', 'misses', 'evictions'):
+        w(metric(f'{prefix}cache_{event}_total', 'counter', f'The number of cache {event}, by cache', (
+            ({'cache': name}, s[event]) for name, s in sorted(cache_stats.items()) if event in s)))
+    w(metric(prefix + 'cache_size_bytes', 'gauge', 'The size of on disk caches', (
+        ({'cache': name}, s['size']) for name, s in sorted(cache_stats.items()) if 'size' in s)))
+    return '\n'.join(ans) + '\n'
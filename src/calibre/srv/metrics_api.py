@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+
+from calibre.srv.errors import HTTPForbidden
+from calibre.srv.metrics import CONTENT_TYPE, render_metrics
+from calibre.srv.routes import endpoint
+
+
+@endpoint('/metrics', cache_control='no-cache')
+def server_metrics(ctx, rd):
+    '''
+    Return the performance metrics of the server in the Prometheus text
+    format. Only users that can make changes and, without authentication,
+    clients from trusted IP addresses, can access them.
+    '''
+    if rd.username:
+        if ctx.user_manager.is_readonly(rd.username):
+            raise HTTPForbidden(f'The user {rd.username} is not allowed to access the server metrics')
+    elif not rd.is_trusted_ip:
+        raise HTTPForbidden('Anonymous users are not allowed to access the server metrics')
+    rd.outheaders.set('Content-Type', CONTENT_TYPE, replace_all=True)
+    return render_metrics(ctx.library_broker)
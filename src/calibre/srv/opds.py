@@ -22,7 +22,7 @@
 from calibre.srv.errors import HTTPInternalServerError, HTTPNotFound
 from calibre.srv.http_request import parse_uri
 from calibre.srv.routes import endpoint
-from calibre.srv.utils import Offsets, get_library_data, http_date
+from calibre.srv.utils import Offsets, get_library_data, http_date, spooled_output
 from calibre.utils.config import prefs
 from calibre.utils.date import as_utc, is_date_undefined, timestampfromdt
 from calibre.utils.icu import sort_key
@@ -41,6 +41,8 @@ def atom(ctx, rd, endpoint, output):
         ans = output  # Assume output is already UTF-8 XML
     elif isinstance(output, str):
         ans = output.encode('utf-8')
+    elif isinstance(output, Feed):
+        ans = spooled_output(output.write)
     else:
         ans = etree.tostring(output, encoding='utf-8', xml_declaration=True, pretty_print=True)
     return ans
@@ -63,6 +65,8 @@ def format_tag_string(tags, sep, joinval=', '):
                      'dc'   : DC_NS,
                      'opds' : 'http://opds-spec.org/2010/catalog',
                      })
+# The namespace declarations of an element made with E, as serialized
+NAMESPACE_DECLARATIONS = etree.tostring(E.entry())[len(b'<entry'):-len(b'/>')]
 
 
 FEED    = E.feed
@@ -248,6 +252,9 @@ def ACQUISITION_ENTRY(book_id, updated, request_context):
 
 class Feed:  # {{{
 
+    # The entries are generated only as the feed is written
+    entries = ()
+
     def __init__(self, id_, updated, request_context, subtitle=None,
             title=None,
             up_link=None, first_link=None, last_link=None,
@@ -277,6 +284,15 @@ def __init__(self, id_, updated, request_context, subtitle=None,
         if subtitle:
             self.root.insert(1, SUBTITLE(subtitle))
 
+    def write(self, dest):
+        ' Write the feed as XML to the file dest, serializing one entry at a time '
+        head, sep, tail = etree.tostring(self.root, encoding='utf-8', xml_declaration=True, pretty_print=True).rpartition(b'</')
+        dest.write(head)
+        for entry in self.entries:
+            # The namespaces are already declared by the feed element
+            dest.write(etree.tostring(entry, encoding='utf-8', pretty_print=True).replace(NAMESPACE_DECLARATIONS, b'', 1))
+        dest.write(sep + tail)
+
     # }}}
 
 
@@ -330,8 +346,12 @@ class AcquisitionFeed(NavFeed):
 
     def __init__(self, id_, updated, request_context, items, offsets, page_url, up_url, title=None):
         NavFeed.__init__(self, id_, updated, request_context, offsets, page_url, up_url, title=title)
-        for book_id in items:
-            self.root.append(ACQUISITION_ENTRY(book_id, updated, request_context))
+        self.entries = self.iterentries(items, updated, request_context)
+
+    def iterentries(self, items, updated, request_context):
+        with request_context.db.safe_read_lock:
+            for book_id in items:
+                yield ACQUISITION_ENTRY(book_id, updated, request_context)
 
 
 class CategoryFeed(NavFeed):
@@ -341,17 +361,15 @@ def __init__(self, items, which, id_, updated, request_context, offsets, page_ur
         ignore_count = False
         if which == 'search':
             ignore_count = True
-        for item in items:
-            self.root.append(CATALOG_ENTRY(
-                item, item.category, request_context, updated, which, ignore_count=ignore_count, add_kind=which != item.category))
+        self.entries = (CATALOG_ENTRY(
+            item, item.category, request_context, updated, which, ignore_count=ignore_count, add_kind=which != item.category) for item in items)
 
 
 class CategoryGroupFeed(NavFeed):
 
     def __init__(self, items, which, id_, updated, request_context, offsets, page_url, up_url, title=None):
         NavFeed.__init__(self, id_, updated, request_context, offsets, page_url, up_url, title=title)
-        for item in items:
-            self.root.append(CATALOG_GROUP_ENTRY(item, which, request_context, updated))
+        self.entries = (CATALOG_GROUP_ENTRY(item, which, request_context, updated) for item in items)
 
 
 class RequestContext:
@@ -401,7 +419,7 @@ def get_acquisition_feed(rc, ids, offset, page_url, up_url, id_,
         items = items[offsets.offset:offsets.offset+max_items]
         lm = rc.last_modified()
         rc.outheaders['Last-Modified'] = http_date(timestampfromdt(lm))
-        return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title).root
+        return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title)
 
 
 def get_all_books(rc, which, page_url, up_url, offset=0):
@@ -464,7 +482,7 @@ def get_navcatalog(request_context, which, page_url, up_url, offset=0):
 
     request_context.outheaders['Last-Modified'] = http_date(timestampfromdt(updated))
 
-    return ans.root
+    return ans
 
 
 @endpoint('/opds', postprocess=atom)
@@ -502,7 +520,7 @@ def getter(x):
         cats.append((meta['name'], meta['name'], 'N'+category))
     last_modified = db.last_modified()
     rd.outheaders['Last-Modified'] = http_date(timestampfromdt(last_modified))
-    return TopLevel(last_modified, cats, rc).root
+    return TopLevel(last_modified, cats, rc)
 
 
 @endpoint('/opds/navcatalog/{which}', postprocess=atom)
@@ -617,7 +635,7 @@ def belongs(x, which):
 
     rc.outheaders['Last-Modified'] = http_date(timestampfromdt(updated))
 
-    return CategoryFeed(items, category, id_, updated, rc, offsets, page_url, up_url, title=feed_title).root
+    return CategoryFeed(items, category, id_, updated, rc, offsets, page_url, up_url, title=feed_title)
 
 
 @endpoint('/opds/search/{query=""}', postprocess=atom)
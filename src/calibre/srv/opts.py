@@ -62,6 +62,12 @@ def __new__(cls, *args):
     'max_request_body_size', 500.0,
     None,
 
+    _('Max. size of the cache of book files and covers (in MB)'),
+    'max_file_cache_size', 500.0,
+    _('Book files and covers sent by the server are first copied out of the library'
+    ' into a cache. When the cache is larger than this size, the least recently used'
+    ' files are deleted from it. Set to zero for no limit.'),
+
     _('Minimum size for which responses use data compression (in bytes)'),
     'compress_min_size', 1024,
     None,
@@ -70,6 +76,27 @@ def __new__(cls, *args):
     'worker_count', 10,
     None,
 
+    _('Number of worker threads used to process slow requests'),
+    'slow_worker_count', 3,
+    _('Requests that can take a long time, such as starting conversions, preparing books'
+      ' for the in-browser viewer and full text searches, are processed by their own, separate,'
+      ' worker threads, so that they cannot hold up other requests. Set to zero to process'
+      ' them with the other worker threads.'),
+
+    _('Maximum number of waiting slow requests'),
+    'slow_queue_size', 20,
+    _('When this many slow requests are waiting for a worker thread, further slow'
+      ' requests are refused with a "Service Unavailable" response, asking the client'
+      ' to retry later.'),
+
+    _('Number of server processes'),
+    'worker_processes', 1,
+    _('Run this many server processes, all listening on the same port, so that requests'
+      ' can be processed on more than one CPU core. Every process opens the libraries itself'
+      ' and changes made in one process are picked up by the others. Only works on operating'
+      ' systems that support SO_REUSEPORT, such as Linux. The server embedded in the calibre'
+      ' program always runs in a single process.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -121,6 +148,29 @@ def __new__(cls, *args):
     ' the listen_on option, then it will try to detect an interface that connects'
     ' to the outside world and bind to that.'),
 
+    _('Maximum size of the cache of books rendered for the in-browser viewer (in MB)'),
+    'max_render_cache_size', 2000.0,
+    _('Books are rendered for the in-browser viewer when they are first opened and the'
+    ' results are kept in a cache on disk. When the cache grows larger than this, the books'
+    ' that have been read the least, recently, are removed from it. Zero means no limit.'),
+
+    _('Number of the most read books to render when the server starts'),
+    'prerender_books', 0,
+    _('Render this many of the books read by the most users, according to their last read'
+    ' positions, for the in-browser viewer when the server starts, so that they open'
+    ' without waiting.'),
+
+    _('Generate thumbnails of covers in the background'),
+    'pregenerate_thumbnails', False,
+    _('Scale the covers of all books to the sizes in the thumbnail_sizes option in'
+    ' background worker processes, and keep the thumbnails in a cache on disk, so that'
+    ' browsing the book list does not have to wait for covers to be scaled.'),
+
+    _('Sizes of the thumbnails to generate in the background'),
+    'thumbnail_sizes', '300x400,600x800',
+    _('A comma separated list of thumbnail sizes, in pixels, as widthxheight, for example:'
+    ' 60x80,200x300. Used only if the pregenerate_thumbnails option is enabled.'),
+
     _('Zero copy file transfers for increased performance'),
     'use_sendfile', True,
     _('This will use zero-copy in-kernel transfers when sending files over the network,'
@@ -7,6 +7,7 @@
 import sys
 from threading import Thread
 
+from calibre.srv.metrics import metrics
 from calibre.utils.monotonic import monotonic
 from polyglot.queue import Full, Queue
 
@@ -15,19 +16,20 @@ class Worker(Thread):
 
     daemon = True
 
-    def __init__(self, log, notify_server, num, request_queue, result_queue):
+    def __init__(self, log, notify_server, num, request_queue, result_queue, lane=None):
         self.request_queue, self.result_queue = request_queue, result_queue
         self.notify_server = notify_server
         self.log = log
         self.working = False
-        Thread.__init__(self, name='ServerWorker%d' % num)
+        Thread.__init__(self, name='ServerWorker%s%d' % (lane.capitalize() if lane else '', num))
 
     def run(self):
         while True:
             x = self.request_queue.get()
             if x is None:
                 break
-            job_id, func = x
+            job_id, func, queued_at = x
+            metrics.observe_queue_wait(monotonic() - queued_at)
             self.working = True
             try:
                 result = func()
@@ -48,40 +50,63 @@ def handle_error(self, job_id):
 
 class ThreadPool:
 
-    def __init__(self, log, notify_server, count=10, queue_size=1000):
+    ''' A pool of worker threads. Besides the default lane of workers, lanes
+    maps the names of other lanes to (count, queue_size). Every lane has its
+    own workers and its own queue of waiting jobs, so jobs in one lane never
+    wait for workers busy with jobs from another lane. Jobs for lanes that
+    have no workers are run in the default lane. '''
+
+    def __init__(self, log, notify_server, count=10, queue_size=1000, lanes=None):
         self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
         self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in range(count)]
+        self.lane_queues = {}
+        self.lane_workers = []
+        for lane, (lcount, lqueue_size) in (lanes or {}).items():
+            if lcount > 0:
+                q = self.lane_queues[lane] = Queue(max(1, lqueue_size))
+                self.lane_workers.extend(Worker(log, notify_server, i, q, self.result_queue, lane=lane) for i in range(lcount))
+
+    @property
+    def all_workers(self):
+        return self.workers + self.lane_workers
 
     def start(self):
-        for w in self.workers:
+        for w in self.all_workers:
             w.start()
 
-    def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+    def put_nowait(self, job_id, func, lane=None):
+        q = self.lane_queues.get(lane, self.request_queue)
+        q.put_nowait((job_id, func, monotonic()))
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
 
     def stop(self, wait_till):
-        for w in self.workers:
+        workers = self.all_workers
+        for w in workers:
             try:
-                self.request_queue.put_nowait(None)
+                w.request_queue.put_nowait(None)
             except Full:
-                break
-        for w in self.workers:
+                pass
+        for w in workers:
             now = monotonic()
             if now >= wait_till:
                 break
             w.join(wait_till - now)
-        self.workers = [w for w in self.workers if w.is_alive()]
+        self.workers = [w for w in workers if w.is_alive()]
+        self.lane_workers = []
 
     @property
     def busy(self):
-        return sum(int(w.working) for w in self.workers)
+        return sum(int(w.working) for w in self.all_workers)
 
     @property
     def idle(self):
-        return sum(int(not w.working) for w in self.workers)
+        return sum(int(not w.working) for w in self.all_workers)
+
+    @property
+    def queue_depth(self):
+        return self.request_queue.qsize() + sum(q.qsize() for q in self.lane_queues.values())
 
 
 class PluginPool:
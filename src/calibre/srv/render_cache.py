@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+The on disk cache of books rendered for the in-browser reader. A rendered
+book is stored once for every distinct book file, identified by the hash of
+its contents, so the same book in more than one library is rendered only
+once. An index, kept in the cache directory, maps the per library book hashes
+used in URLs to these content hashes and records the size and usage of every
+rendered book. When the cache grows beyond its budget, the rendered books
+that are read the least, with reads decaying in weight as they age, are
+removed.
+
+The cache can be shared by several server processes. All changes to the index
+and to the rendered books are made while holding a lock on a file in the
+cache directory, after re-reading the index if another process has changed
+it.
+'''
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from hashlib import sha1
+from threading import RLock
+
+from calibre.srv.render_book import RENDER_VERSION
+from calibre.utils.filenames import atomic_rename, rmtree
+from calibre.utils.lock import ExclusiveFile
+from polyglot.builtins import itervalues
+
+MANIFEST_NAME = 'calibre-book-manifest.json'
+# The weight of a read halves every week
+HALF_LIFE = 7 * 24 * 60 * 60
+# The index is written at most this often for changes in the usage statistics
+SAVE_INTERVAL = 60
+
+
+def content_hash(path, fmt):
+    h = sha1(f'{RENDER_VERSION}:{fmt.upper()}:'.encode())
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(64 * 1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def dir_size(path):
+    ans = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                ans += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return ans
+
+
+class RenderCache:
+
+    def __init__(self, base):
+        self.base = base
+        self.final_dir = os.path.join(base, 'f')
+        self.index_path = os.path.join(base, 'index.json')
+        self.lock_path = os.path.join(base, 'index.lock')
+        self.lock = RLock()
+        # Map of book hash to content hash
+        self.links = {}
+        # Map of content hash to {'size':, 'reads':, 'last_read':}
+        self.entries = {}
+        # Map of content hash to [reads, last_read] for the reads not yet
+        # saved in the index
+        self.pending_reads = {}
+        # The state of the index file when it was last read or written
+        self.index_state = None
+        self.index_locked = False
+        self.hits = self.misses = self.renders = self.dedup_hits = self.evictions = 0
+        self.dirty = False
+        self.last_saved = 0
+        self.load()
+
+    def current_index_state(self):
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    @contextmanager
+    def locked_index(self):
+        ''' Lock the index against changes by other processes, re-reading it if
+        they have changed it. Saves the index on exit, if it was changed. '''
+        with self.lock:
+            if self.index_locked:
+                yield
+                return
+            with ExclusiveFile(self.lock_path, timeout=60):
+                self.index_locked = True
+                try:
+                    if self.current_index_state() != self.index_state:
+                        self.read_index()
+                    yield
+                    if self.dirty:
+                        self.write_index()
+                finally:
+                    self.index_locked = False
+
+    def read_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = json.load(f)
+            self.links, self.entries = data['links'], data['entries']
+        except Exception:
+            self.links, self.entries = {}, {}
+        self.index_state = self.current_index_state()
+        for chash, (reads, last_read) in self.pending_reads.items():
+            entry = self.entries.get(chash)
+            if entry is not None:
+                entry['reads'] += reads
+                entry['last_read'] = max(entry['last_read'], last_read)
+                self.dirty = True
+
+    def write_index(self):
+        data = json.dumps({'links': self.links, 'entries': self.entries}).encode('utf-8')
+        tpath = self.index_path + '.tmp'
+        try:
+            with open(tpath, 'wb') as f:
+                f.write(data)
+            atomic_rename(tpath, self.index_path)
+        except OSError:
+            import traceback
+            traceback.print_exc()
+            return
+        self.index_state = self.current_index_state()
+        self.pending_reads.clear()
+        self.dirty = False
+        self.last_saved = time.monotonic()
+
+    def load(self):
+        with self.locked_index():
+            try:
+                present = set(os.listdir(self.final_dir))
+            except OSError:
+                present = set()
+            # Books are moved into final_dir with the lock held, so
+            # directories not in the index are not being added by another
+            # process
+            for chash in present - set(self.entries):
+                # Left over from an interrupted rename or from an older version
+                # of the cache, that was keyed by book hash
+                self.delete_dir(chash)
+            for chash in set(self.entries) - present:
+                del self.entries[chash]
+                self.dirty = True
+            links = {k: v for k, v in self.links.items() if v in self.entries}
+            if len(links) != len(self.links):
+                self.links, self.dirty = links, True
+
+    def refresh(self):
+        ''' Re-read the index if another process has changed it, returns True
+        if it was re-read '''
+        with self.lock:
+            if self.current_index_state() == self.index_state:
+                return False
+            with self.locked_index():
+                pass
+            return True
+
+    def save(self, force=True):
+        with self.lock:
+            if not force and (not self.dirty or time.monotonic() - self.last_saved < SAVE_INTERVAL):
+                return
+            with self.locked_index():
+                self.dirty = True
+
+    def delete_dir(self, chash):
+        rmtree(os.path.join(self.final_dir, chash), ignore_errors=True)
+
+    def manifest_path(self, book_hash):
+        ' Return the path to the manifest of the rendered book, if it is in the cache, recording the read '
+        with self.lock:
+            chash = self.links.get(book_hash)
+            entry = self.entries.get(chash)
+            if entry is None and self.refresh():
+                # Rendered by another process
+                chash = self.links.get(book_hash)
+                entry = self.entries.get(chash)
+            if entry is None:
+                self.misses += 1
+                return
+            self.hits += 1
+            now = time.time()
+            entry['reads'] += 1
+            entry['last_read'] = now
+            pr = self.pending_reads.setdefault(chash, [0, now])
+            pr[0] += 1
+            pr[1] = now
+            self.dirty = True
+            self.save(force=False)
+            return os.path.join(self.final_dir, chash, MANIFEST_NAME)
+
+    def file_path(self, book_hash, name):
+        with self.lock:
+            chash = self.links.get(book_hash)
+            if chash is None and self.refresh():
+                chash = self.links.get(book_hash)
+        if chash is not None:
+            return os.path.abspath(os.path.join(self.final_dir, chash, name))
+
+    def link(self, book_hash, chash):
+        ' Use an existing rendering of a book file with identical contents, if any, for book_hash '
+        with self.locked_index():
+            if chash not in self.entries:
+                return False
+            self.links[book_hash] = chash
+            self.dedup_hits += 1
+            self.dirty = True
+            return True
+
+    def add(self, book_hash, chash, rendered_dir, max_size=0):
+        ''' Move a freshly rendered book into the cache, then remove the
+        least valuable books if the cache is larger than max_size bytes '''
+        with self.locked_index():
+            if chash in self.entries:
+                # Rendered concurrently for another library or by another process
+                rmtree(rendered_dir, ignore_errors=True)
+            else:
+                dest = os.path.join(self.final_dir, chash)
+                rmtree(dest, ignore_errors=True)
+                os.rename(rendered_dir, dest)
+                self.entries[chash] = {'size': dir_size(dest), 'reads': 0, 'last_read': time.time()}
+                self.renders += 1
+            self.links[book_hash] = chash
+            self.dirty = True
+            if max_size > 0:
+                self.evict(max_size, keep=chash)
+
+    def remove(self, book_hash):
+        ' Remove the rendered book, for all libraries that share it '
+        with self.locked_index():
+            chash = self.links.pop(book_hash, None)
+            if chash is not None:
+                self.dirty = True
+                if self.entries.pop(chash, None) is not None:
+                    self.unlink(chash)
+                    self.delete_dir(chash)
+
+    def unlink(self, chash):
+        for k in tuple(k for k, v in self.links.items() if v == chash):
+            del self.links[k]
+
+    def score(self, entry, now):
+        # Combines frequency (the number of reads) and recency (the decay
+        # of the weight of the reads with the time since the last one)
+        return (entry['reads'] + 1) * 0.5 ** (max(0, now - entry['last_read']) / HALF_LIFE)
+
+    def evict(self, max_size, keep=None):
+        with self.locked_index():
+            total = sum(e['size'] for e in itervalues(self.entries))
+            if total <= max_size:
+                return
+            now = time.time()
+            for chash in sorted((k for k in self.entries if k != keep), key=lambda k: self.score(self.entries[k], now)):
+                total -= self.entries.pop(chash)['size']
+                self.unlink(chash)
+                self.delete_dir(chash)
+                self.evictions += 1
+                if total <= max_size:
+                    break
+            self.dirty = True
+
+    def stats(self):
+        with self.lock:
+            return {
+                'books': len(self.entries), 'links': len(self.links),
+                'size': sum(e['size'] for e in itervalues(self.entries)),
+                'hits': self.hits, 'misses': self.misses, 'renders': self.renders,
+                'dedup_hits': self.dedup_hits, 'evictions': self.evictions,
+            }
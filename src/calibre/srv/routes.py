@@ -14,6 +14,7 @@
 from operator import attrgetter
 
 from calibre.srv.errors import HTTPNotFound, HTTPSimpleResponse, RouteError
+from calibre.srv.http_response import ETaggedDynamicOutput, StaticOutput
 from calibre.srv.utils import http_date
 from calibre.utils.serialize import MSGPACK_MIME, json_dumps, msgpack_dumps
 from polyglot import http_client
@@ -25,7 +26,7 @@
 
 def json(ctx, rd, endpoint, output):
     rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
-    if isinstance(output, bytes) or hasattr(output, 'fileno'):
+    if isinstance(output, (bytes, StaticOutput, ETaggedDynamicOutput)) or hasattr(output, 'fileno'):
         ans = output  # Assume output is already UTF-8 encoded json
     else:
         ans = json_dumps(output)
@@ -74,7 +75,12 @@ def endpoint(route,
              postprocess=None,
 
              # Needs write access to the calibre database
-             needs_db_write=False
+             needs_db_write=False,
+
+             # The lane of worker threads that handles requests, None for the
+             # default lane or 'slow' for requests that can take a long time,
+             # which are handled by a separate, smaller, set of threads
+             lane=None
 
 ):
     from calibre.srv.handler import Context
@@ -92,6 +98,7 @@ def annotate(f):
         f.ok_code = ok_code
         f.is_endpoint = True
         f.needs_db_write = needs_db_write
+        f.lane = lane
         argspec = inspect.getfullargspec(f)
         if len(argspec.args) < 2:
             raise TypeError('The endpoint %r must take at least two arguments' % f.route)
@@ -301,6 +308,7 @@ def read_cookies(self, data):
 
     def dispatch(self, data):
         endpoint_, args = self.find_route(data.path)
+        data.route = endpoint_.route
         if data.method not in endpoint_.methods:
             raise HTTPSimpleResponse(http_client.METHOD_NOT_ALLOWED)
 
@@ -5,23 +5,28 @@
 import json
 import os
 import signal
+import socket
 import sys
+from contextlib import suppress
 
 from calibre import as_unicode
 from calibre.constants import is_running_from_develop, ismacos, iswindows
 from calibre.db.legacy import LibraryDatabase
 from calibre.srv.bonjour import BonJour
+from calibre.srv.books import Prerenderer
 from calibre.srv.handler import Handler
 from calibre.srv.http_response import create_http_handler
 from calibre.srv.library_broker import load_gui_libraries
 from calibre.srv.loop import BadIPSpec, ServerLoop
 from calibre.srv.manage_users_cli import manage_users_cli
 from calibre.srv.opts import opts_to_parser
+from calibre.srv.thumbnails import ThumbnailPregenerator
 from calibre.srv.users import connect
 from calibre.srv.utils import HandleInterrupt, RotatingLog
 from calibre.utils.config import prefs
 from calibre.utils.localization import _, localize_user_manual_link
 from calibre.utils.lock import singleinstance
+from calibre.utils.monotonic import monotonic
 from calibre_extensions import speedup
 from polyglot.builtins import error_message
 
@@ -58,7 +63,8 @@ def daemonize():  # {{{
 
 class Server:
 
-    def __init__(self, libraries, opts):
+    def __init__(self, libraries, opts, run_services=True):
+        # run_services is False in all but the first of several server processes
         log = access_log = None
         log_size = opts.max_log_size * 1024 * 1024
         if opts.log:
@@ -73,10 +79,15 @@ def __init__(self, libraries, opts):
             with open(os.path.expanduser(opts.search_the_net_urls), 'rb') as f:
                 self.handler.router.ctx.search_the_net_urls = json.load(f)
         plugins = []
-        if opts.use_bonjour:
-            plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
+        if run_services:
+            if opts.use_bonjour:
+                plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
+            if opts.pregenerate_thumbnails:
+                plugins.append(ThumbnailPregenerator(self.handler.router.ctx.library_broker))
+            if opts.prerender_books > 0:
+                plugins.append(Prerenderer(self.handler.router.ctx, opts.prerender_books))
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, lane_for=self.handler.lane_for),
             opts=opts,
             log=log,
             access_log=access_log,
@@ -222,19 +233,31 @@ def main(args=sys.argv):
         raise SystemExit('The --log option must point to a file, not a directory')
     if opts.access_log and os.path.isdir(opts.access_log):
         raise SystemExit('The --access-log option must point to a file, not a directory')
+    if getattr(opts, 'daemonize', False) and not opts.log and not iswindows:
+        raise SystemExit(
+            'In order to daemonize you must specify a log file, you can use /dev/stdout to log to screen even as a daemon'
+        )
+    if opts.worker_processes > 1:
+        if iswindows or not hasattr(socket, 'SO_REUSEPORT'):
+            raise SystemExit(_('The --worker-processes option is not supported on this operating system'))
+        return run_worker_processes(libraries, opts)
     try:
         server = Server(libraries, opts)
     except BadIPSpec as e:
         raise SystemExit(f'{e}')
     if getattr(opts, 'daemonize', False):
-        if not opts.log and not iswindows:
-            raise SystemExit(
-                'In order to daemonize you must specify a log file, you can use /dev/stdout to log to screen even as a daemon'
-            )
         daemonize()
+    write_pidfile(opts)
+    run_server(server, opts)
+
+
+def write_pidfile(opts):
     if opts.pidfile:
         with open(opts.pidfile, 'wb') as f:
             f.write(str(os.getpid()).encode('ascii'))
+
+
+def run_server(server, opts):
     signal.signal(signal.SIGTERM, lambda s, f: server.stop())
     if not getattr(opts, 'daemonize', False) and not iswindows:
         signal.signal(signal.SIGHUP, lambda s, f: server.stop())
@@ -243,3 +266,84 @@ def main(args=sys.argv):
     ensure_app(), load_builtin_fonts()
     with HandleInterrupt(server.stop):
         server.serve_forever()
+
+
+# Multiple server processes {{{
+
+def run_worker_process(libraries, opts, worker_num):
+    ' Run in a forked child process, never returns '
+    code = 0
+    try:
+        # Services such as thumbnail generation run only in the first process,
+        # the other processes still use the thumbnails it generates
+        server = Server(libraries, opts, run_services=worker_num == 0)
+        # The libraries are changed by the other processes as well, so
+        # re-read them when that happens
+        server.handler.router.ctx.library_broker.check_for_external_changes = True
+        run_server(server, opts)
+    except BadIPSpec as e:
+        print(e, file=sys.stderr)
+        code = 1
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+        if e.code is not None and not isinstance(e.code, int):
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush(), sys.stderr.flush()
+        os._exit(code)
+
+
+def run_worker_processes(libraries, opts):
+    ''' Fork opts.worker_processes server processes, that all bind to the same
+    port with SO_REUSEPORT, and restart any that exit unexpectedly. Changes
+    made to the libraries are coordinated through SQLite, every process
+    noticing changes made by the others via PRAGMA data_version. '''
+    if getattr(opts, 'daemonize', False):
+        daemonize()
+    write_pidfile(opts)
+    workers = {}
+    shutting_down = False
+
+    def start_worker(worker_num):
+        pid = os.fork()
+        if pid == 0:
+            for sig in (signal.SIGTERM, signal.SIGHUP, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            run_worker_process(libraries, opts, worker_num)
+        workers[pid] = worker_num, monotonic()
+
+    def stop(*a):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in tuple(workers):
+            with suppress(OSError):
+                os.kill(pid, signal.SIGTERM)
+
+    for sig in (signal.SIGTERM, signal.SIGHUP, signal.SIGINT):
+        signal.signal(sig, stop)
+    for i in range(opts.worker_processes):
+        start_worker(i)
+    exit_code = 0
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_num, started_at = workers.pop(pid, (None, 0))
+        if worker_num is None or shutting_down:
+            continue
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        if code != 0 and monotonic() - started_at < 5:
+            # Failing at startup, for example, because the port is in use
+            print(f'Server process {worker_num} failed to start, shutting down', file=sys.stderr)
+            exit_code = code if code > 0 else 1
+            stop()
+            continue
+        print(f'Server process {worker_num} exited with code: {code}, restarting it', file=sys.stderr)
+        start_worker(worker_num)
+    raise SystemExit(exit_code)
+# }}}
@@ -85,6 +85,42 @@ def test_ajax_categories(self):  # {{{
             self.ae(set(data['book_ids']), {2})
     # }}}
 
+    def test_ajax_response_cache(self):  # {{{
+        'Test caching of responses and conditional requests for /ajax/search'
+        from polyglot.http_client import NOT_MODIFIED
+        with self.create_server() as server:
+            ctx = server.handler.router.ctx
+            db = ctx.library_broker.get(None)
+            cache = ctx.library_broker.response_caches[db.server_library_id]
+            conn = server.connect()
+            request = partial(make_request, conn)
+
+            r, data = request('/search?query=id:1', headers={})
+            self.ae(r.status, OK), self.ae(data['book_ids'], [1])
+            etag = r.getheader('ETag')
+            self.ae(len(cache), 1)
+            r, xdata = request('/search?query=id:1', headers={})
+            self.ae(xdata, data), self.ae(r.getheader('ETag'), etag), self.ae(len(cache), 1)
+            r, xdata = request('/search?query=id:1', headers={'If-None-Match': etag})
+            self.ae(r.status, NOT_MODIFIED), self.ae(xdata, b'')
+            r, zdata = request('/search?query=id:1', headers={'Accept-Encoding': 'gzip'})
+            self.ae(r.getheader('Content-Encoding'), 'gzip')
+            self.ae(json.loads(zlib.decompress(zdata, 16+zlib.MAX_WBITS)), data)
+            r, xdata = request('/search?query=id:1', headers={'Accept-Encoding': 'gzip', 'If-None-Match': r.getheader('ETag')})
+            self.ae(r.status, NOT_MODIFIED)
+            request('/search?query=id:2', headers={})
+            self.ae(len(cache), 2)
+
+            db.set_field('title', {1: 'Changed title'})
+            r, xdata = request('/search?query=id:1', headers={'If-None-Match': etag})
+            self.ae(r.status, OK), self.ae(xdata, data)
+            self.assertNotEqual(r.getheader('ETag'), etag)
+            self.ae(len(cache), 1)
+            for i in range(ctx.RESPONSE_CACHE_SIZE + 10):
+                request('/search?query=id:1&num=%d' % (i + 1), headers={})
+            self.ae(len(cache), ctx.RESPONSE_CACHE_SIZE)
+    # }}}
+
     def test_srv_restrictions(self):  # {{{
         ' Test that virtual lib. + search restriction works on all end points'
         with self.create_server(auth=True, auth_mode='basic') as server:
@@ -230,6 +230,161 @@ def change_cover(count, book_id=2):
 
     # }}}
 
+    def test_thumbnail_pregeneration(self):  # {{{
+        'Test generating thumbnails in the background'
+        from calibre.db.utils import ThumbnailCache
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv import thumbnails
+        from calibre.utils.date import timestampfromdt
+        self.ae(thumbnails.parse_thumbnail_sizes(' 60x80, 10x, 60x80,100x150'), ((60, 80), (100, 150)))
+        with TemporaryDirectory() as tdir:
+            caches = {}
+
+            def thumbnail_store(library_id, width, height):
+                key = library_id, width, height
+                if key not in caches:
+                    caches[key] = ThumbnailCache(name=f'{width}x{height}', location=tdir, thumbnail_size=(width, height), test_mode=True)
+                return caches[key]
+
+            orig, thumbnails.thumbnail_store = thumbnails.thumbnail_store, thumbnail_store
+            pregen = thumbnails.ThumbnailPregenerator(None, max_workers=1)
+            try:
+                server = self.create_server(plugins=(pregen,), pregenerate_thumbnails=True, thumbnail_sizes='60x80')
+                pregen.library_broker = server.handler.router.ctx.library_broker
+                with server:
+                    db = pregen.library_broker.get(None)
+                    library_id = db.server_library_id
+                    self.assertTrue(pregen.idle.wait(60))
+                    store = thumbnail_store(library_id, 60, 80)
+                    books_with_covers = {book_id for book_id in db.all_book_ids() if db.cover_last_modified(book_id) is not None}
+                    self.ae(pregen.num_generated, len(books_with_covers))
+                    for book_id in books_with_covers:
+                        data, ts = store[book_id]
+                        self.ae(identify(data)[0], 'jpeg')
+                        self.assertTrue(thumbnails.is_fresh(ts, timestampfromdt(db.cover_last_modified(book_id))))
+                    book_id = min(books_with_covers)
+                    conn = server.connect()
+                    conn.request('GET', f'/get/thumb/{book_id}/{library_id}?sz=60x80')
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), store[book_id][0])
+
+                    # Changed covers are re-generated
+                    db.set_cover({book_id: I('lt.png', data=True)})
+                    mtime = timestampfromdt(db.cover_last_modified(book_id))
+                    st = time.monotonic()
+                    while not thumbnails.is_fresh(store[book_id][1], mtime) and time.monotonic() - st < 60:
+                        time.sleep(0.05)
+                    self.assertTrue(thumbnails.is_fresh(store[book_id][1], mtime))
+            finally:
+                thumbnails.thumbnail_store = orig
+    # }}}
+
+    def test_thumbnail_worker_crash(self):  # {{{
+        'Test that thumbnail generation continues with a new pool when a worker crashes'
+        from queue import Queue
+
+        from calibre.db.utils import ThumbnailCache
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv import thumbnails
+        from calibre.utils.date import utcnow
+        from calibre.utils.ipc import pool
+        from calibre.utils.logging import ThreadSafeLog
+
+        pools = []
+
+        class Pool:
+
+            def __init__(self, max_workers=None, name=None):
+                self.results, self.terminal_failure = Queue(), None
+                pools.append(self)
+
+            @property
+            def failed(self):
+                return self.terminal_failure is not None
+
+            def __call__(self, job_id, module, func, batch, sizes):
+                if len(pools) == 1:
+                    # The worker of the first pool crashes, the result of the
+                    # job that crashed it is never returned
+                    self.terminal_failure = 'crashed'
+                    return
+                self.results.put(pool.WorkerResult(job_id, pool.Result(
+                    [(book_id, mtime, {size: b'thumb' for size in sizes}) for book_id, mtime, cdata in batch], None, None), False, None))
+
+            def shutdown(self):
+                pass
+
+        class DB:
+
+            def cover_last_modified(self, book_id):
+                return utcnow()
+
+            def cover(self, book_id):
+                return b'cover'
+
+        class Broker:
+
+            def get(self, library_id):
+                return DB()
+
+        with TemporaryDirectory() as tdir:
+            caches = {}
+
+            def thumbnail_store(library_id, width, height):
+                key = library_id, width, height
+                if key not in caches:
+                    caches[key] = ThumbnailCache(name=f'{width}x{height}', location=tdir, thumbnail_size=(width, height), test_mode=True)
+                return caches[key]
+
+            orig_store, orig_pool = thumbnails.thumbnail_store, pool.Pool
+            thumbnails.thumbnail_store, pool.Pool = thumbnail_store, Pool
+            try:
+                pregen = thumbnails.ThumbnailPregenerator(Broker(), max_workers=1)
+                pregen.log, pregen.sizes = ThreadSafeLog(level=ThreadSafeLog.ERROR + 1), ((60, 80),)
+                book_ids = range(1, 3 * thumbnails.BATCH_SIZE + 1)
+                pregen.process('lib', book_ids)
+                self.ae(len(pools), 2)
+                # Only the books in the batch that crashed the worker are skipped
+                self.ae(pregen.num_generated, len(book_ids) - thumbnails.BATCH_SIZE)
+                store = thumbnail_store('lib', 60, 80)
+                self.assertIsNone(store[1][0])
+                self.ae(store[len(book_ids)][0], b'thumb')
+            finally:
+                thumbnails.thumbnail_store, pool.Pool = orig_store, orig_pool
+    # }}}
+
+    def test_server_metrics(self):  # {{{
+        'Test the performance metrics endpoint'
+        from calibre.srv.metrics import metrics
+        metrics.reset()
+        with self.create_server() as server:
+            conn = server.connect()
+            conn.request('GET', '/metrics')
+            r = conn.getresponse()
+            self.ae(r.status, http_client.FORBIDDEN), r.read()
+        with self.create_server(local_write=True) as server:
+            conn = server.connect()
+            for i in range(3):
+                conn.request('GET', '/ajax/search')
+                r = conn.getresponse()
+                self.ae(r.status, http_client.OK), r.read()
+            conn.request('GET', '/metrics')
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK)
+            self.assertTrue(r.getheader('Content-Type').startswith('text/plain'))
+            lines = r.read().decode('utf-8').splitlines()
+        route = '/ajax/search/{library_id=None}'
+        self.assertIn(f'calibre_server_requests_total{{route="{route}",code="200"}} 3', lines)
+        self.assertIn('calibre_server_requests_total{route="/metrics",code="403"} 1', lines)
+        self.assertIn(f'calibre_server_request_duration_seconds_count{{route="{route}"}} 3', lines)
+        self.assertIn(f'calibre_server_request_duration_seconds_bucket{{route="{route}",le="+Inf"}} 3', lines)
+        self.assertIn('calibre_server_cache_hits_total{cache="response"} 2', lines)
+        self.assertIn('calibre_server_cache_misses_total{cache="response"} 1', lines)
+        self.assertTrue(any(x.startswith('calibre_server_db_lock_waits_total{library_id=') for x in lines))
+        self.assertTrue(any(x.startswith('calibre_server_queue_wait_seconds_count ') for x in lines))
+    # }}}
+
     def test_char_count(self):  # {{{
         from calibre.ebooks.oeb.parse_utils import html5_parse
         from calibre.srv.render_book import get_length
@@ -281,4 +436,123 @@ def test_last_read_cache(self):  # {{{
         for book_id in range(2, 7):
             lrc.add_last_read_position('lib', book_id, 'FMT', 'user', 'epubcfi(/)', 0.1, 'tt')
         self.ae(len(lrc.get_recently_read('user')), lrc.limit)
+        lrc.add_last_read_position('lib', 3, 'FMT', 'other', 'epubcfi(/)', 0.1, 'tt')
+        self.ae(lrc.most_read(2), (('lib', 3, 'FMT'), ('lib', 6, 'FMT')))
+    # }}}
+
+    def test_render_cache(self):  # {{{
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.render_cache import MANIFEST_NAME, RenderCache, content_hash
+        with TemporaryDirectory() as base:
+            os.mkdir(os.path.join(base, 'f'))
+
+            def render(name, data, size=10):
+                src = os.path.join(base, name)
+                with open(src, 'wb') as f:
+                    f.write(data)
+                tdir = os.path.join(base, 'rendered-' + name)
+                os.mkdir(tdir)
+                with open(os.path.join(tdir, MANIFEST_NAME), 'wb') as f:
+                    f.write(b'x' * size)
+                return content_hash(src, 'epub'), tdir
+
+            rc = RenderCache(base)
+            chash, tdir = render('one', b'one')
+            self.assertIsNone(rc.manifest_path('lib1-one'))
+            self.assertFalse(rc.link('lib1-one', chash))
+            rc.add('lib1-one', chash, tdir)
+            self.assertTrue(os.path.exists(rc.manifest_path('lib1-one')))
+            self.ae(rc.file_path('lib1-one', 'a/b'), os.path.join(base, 'f', chash, 'a', 'b'))
+            # The same book file in another library is not rendered again
+            self.ae(render('one-again', b'one')[0], chash)
+            self.assertTrue(rc.link('lib2-one', chash))
+            self.ae(rc.manifest_path('lib2-one'), rc.manifest_path('lib1-one'))
+            for i in range(5):
+                rc.manifest_path('lib1-one')
+            chash2, tdir = render('two', b'two')
+            rc.add('lib1-two', chash2, tdir)
+            self.ae(rc.stats(), {
+                'books': 2, 'links': 3, 'size': 20, 'hits': 8, 'misses': 1, 'renders': 2, 'dedup_hits': 1, 'evictions': 0})
+            # The index is persistent
+            rc = RenderCache(base)
+            self.ae((len(rc.entries), len(rc.links)), (2, 3))
+            # The least read book is evicted first, and never the one just rendered
+            chash3, tdir = render('three', b'three')
+            rc.add('lib1-three', chash3, tdir, max_size=25)
+            self.ae(set(rc.entries), {chash, chash3})
+            self.assertIsNone(rc.manifest_path('lib1-two'))
+            self.assertFalse(os.path.exists(os.path.join(base, 'f', chash2)))
+            self.ae(rc.evictions, 1)
+            # Reads lose weight as they age
+            rc.entries[chash]['last_read'] -= 10 * 7 * 24 * 60 * 60
+            chash4, tdir = render('four', b'four')
+            rc.add('lib1-four', chash4, tdir, max_size=25)
+            self.ae(set(rc.entries), {chash3, chash4})
+            self.assertIsNone(rc.manifest_path('lib2-one'))
+            rc.remove('lib1-four')
+            self.ae(set(os.listdir(os.path.join(base, 'f'))), {chash3})
+            # Several processes can share the cache
+            other = RenderCache(base)
+            rc.add('lib1-four', chash4, render('four', b'four')[1])
+            self.assertTrue(os.path.exists(other.manifest_path('lib1-four')))
+            other.add('lib1-two', chash2, render('two', b'two')[1])
+            rc.link('lib2-four', chash4)
+            self.ae(set(rc.entries), {chash2, chash3, chash4})
+            self.ae(set(rc.links), {'lib1-two', 'lib1-three', 'lib1-four', 'lib2-four'})
+            other.save()
+            rc.manifest_path('lib1-four')
+            rc.save()
+            self.ae(RenderCache(base).entries[chash4]['reads'], 2)
+            self.ae(set(os.listdir(os.path.join(base, 'f'))), {chash2, chash3, chash4})
+    # }}}
+
+    def test_file_copy_cache(self):  # {{{
+        'Test the locking and eviction of the cache of copied files'
+        from threading import Event, Thread
+
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.content import FileCopyCache
+        fc = FileCopyCache()
+        with TemporaryDirectory() as tdir:
+            names = [os.path.join(tdir, x) for x in 'abcd']
+
+            def store(fname, size=10):
+                with fc.locked(fname):
+                    with open(fname, 'wb') as f:
+                        f.write(b'x' * size)
+                    fc.stored(fname, size, 30)
+
+            for fname in names[:3]:
+                store(fname)
+            fc.used(names[0])
+            store(names[3])
+            # The least recently used file is deleted
+            self.ae([os.path.exists(x) for x in names], [True, False, True, True])
+            self.ae(fc.stats(), {'hits': 1, 'misses': 4, 'evictions': 1, 'files': 3, 'size': 30})
+            # Files in use are not deleted
+            in_use, done = Event(), Event()
+
+            def use():
+                with fc.locked(names[2]):
+                    in_use.set()
+                    done.wait(10)
+            t = Thread(target=use, daemon=True)
+            t.start()
+            self.assertTrue(in_use.wait(10))
+            # Unrelated files are not blocked by a file being in use
+            store(names[1], 20)
+            self.ae([os.path.exists(x) for x in names], [False, True, True, False])
+            self.ae(fc.stats()['size'], 30)
+            done.set()
+            t.join()
+            self.assertFalse(fc.file_locks)
+            # Files being served are not deleted
+            f = fc.serving(names[2], open(names[2], 'rb'))
+            store(names[0])
+            self.ae([os.path.exists(x) for x in names], [True, False, True, False])
+            f.close()
+            del f
+            self.assertFalse(fc.readers)
+            store(names[3], 20)
+            self.ae([os.path.exists(x) for x in names], [True, False, False, True])
     # }}}
@@ -427,6 +427,91 @@ def edfunc():
 
     # }}}
 
+    def test_precompressed_files(self):  # {{{
+        'Test serving of precompressed files'
+        from calibre.srv.http_response import precompressed_encoding, precompressed_files
+        self.ae(precompressed_encoding('gzip, deflate, br, zstd', {'gzip', 'zstd'}), 'zstd')
+        self.ae(precompressed_encoding('gzip, deflate, br, zstd', {'gzip'}), 'gzip')
+        self.ae(precompressed_encoding('deflate', {'gzip', 'zstd'}), None)
+        with NamedTemporaryFile(suffix='.js') as f, NamedTemporaryFile(suffix='.png') as img, NamedTemporaryFile(suffix='.js') as dup:
+            raw = b'console.log("precompressed");\n' * 1000
+            for x in (f, dup):
+                x.write(raw), x.flush()
+            img.write(raw), img.flush()
+            self.assertIsNone(precompressed_files(img.name))
+            self.assertIs(precompressed_files(f.name), precompressed_files(dup.name))
+
+            def handler(conn):
+                return conn.precompressed_file(f.name)
+            with TestServer(handler) as server:
+                conn = server.connect()
+                conn.request('GET', '/js')
+                r = conn.getresponse()
+                self.ae(r.status, http_client.OK), self.ae(r.read(), raw)
+                self.assertIsNone(r.getheader('Content-Encoding'))
+                self.ae(r.getheader('Content-Type'), 'application/javascript; charset=UTF-8')
+                etag = r.getheader('ETag')
+                self.ae(etag, '"%s"' % hashlib.sha1(raw).hexdigest())
+
+                conn.request('GET', '/js', headers={'Accept-Encoding': 'gzip'})
+                r = conn.getresponse()
+                self.ae(r.status, http_client.OK)
+                data = r.read()
+                self.ae(r.getheader('Content-Encoding'), 'gzip')
+                self.ae(r.getheader('Content-Length'), str(len(data)))
+                self.ae(r.getheader('Vary'), 'Accept-Encoding')
+                self.ae(zlib.decompress(data, 16+zlib.MAX_WBITS), raw)
+                gzip_etag = r.getheader('ETag')
+                self.assertNotEqual(etag, gzip_etag)
+                self.assertIs(precompressed_files(f.name).compressed['gzip'], precompressed_files(f.name).encoded('gzip'))
+
+                conn.request('GET', '/js', headers={'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag})
+                r = conn.getresponse()
+                self.ae(r.status, http_client.NOT_MODIFIED), self.ae(r.read(), b'')
+
+                f.seek(0), f.write(b'x' * len(raw)), f.flush()
+                os.utime(f.name, ns=(0, 0))
+                conn.request('GET', '/js', headers={'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag})
+                r = conn.getresponse()
+                self.ae(r.status, http_client.OK)
+                self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), b'x' * len(raw))
+    # }}}
+
+    def test_streamed_json(self):  # {{{
+        'Test streaming serialization of JSON responses'
+        import json
+
+        from calibre.srv.utils import iterjson, spooled_output
+        from calibre.utils.serialize import json_dumps
+        for obj in ({'a': 1, 'b': [1, 2]}, list(range(5000)), {'ids': tuple(range(3000)), 'x': None}, [], {}, 'x'):
+            self.ae(b''.join(iterjson(obj, chunk_size=100)), json_dumps(obj))
+        books = {i: {'title': 'Book %d' % i, 'authors': ['A', 'B']} for i in range(1000)}
+        chunks = list(iterjson(iter(books.items()), chunk_size=1024))
+        self.assertGreater(len(chunks), 10)
+        self.ae(json.loads(b''.join(chunks)), {str(k): v for k, v in books.items()})
+        obj = {'num': 1000, 'books': iter(books.items())}
+        self.ae(json.loads(b''.join(iterjson(obj))), {'num': 1000, 'books': {str(k): v for k, v in books.items()}})
+
+        self.ae(spooled_output(lambda f: f.write(b'small'), max_size=10), b'small')
+        raw = json_dumps(books)
+        ans = spooled_output(lambda f: f.writelines(iterjson(iter(books.items()))), max_size=1024)
+        self.assertNotIsInstance(ans, bytes)
+        self.ae(ans.read(), raw)
+
+        def handler(conn):
+            conn.outheaders.set('Content-Type', 'application/json; charset=UTF-8')
+            return spooled_output(lambda f: f.writelines(iterjson(iter(books.items()))), max_size=1024)
+        with TestServer(handler) as server:
+            conn = server.connect()
+            conn.request('GET', '/books')
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK), self.ae(r.read(), raw)
+            conn.request('GET', '/books', headers={'Accept-Encoding': 'gzip'})
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK), self.ae(r.getheader('Content-Encoding'), 'gzip')
+            self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
+    # }}}
+
     def test_static_generation(self):  # {{{
         'Test static generation'
         nums = list(map(str, range(10)))
@@ -13,7 +13,9 @@
 from threading import Event
 from unittest import skipIf
 
+from calibre.constants import iswindows
 from calibre.ptempfile import TemporaryDirectory
+from calibre.srv.http_response import create_http_handler
 from calibre.srv.pre_activated import has_preactivated_support
 from calibre.srv.tests.base import BaseTest, TestServer
 from calibre.utils.certgen import create_server_cert
@@ -102,6 +104,54 @@ def test_workers(self):
             w.join()
         self.ae(0, sum(int(w.is_alive()) for w in server.loop.pool.workers))
 
+    def test_worker_lanes(self):
+        ' Test that slow requests are handled by their own workers '
+        block = Event()
+
+        def handler(data):
+            if data.path[0] == 'slow':
+                block.wait(10)
+            return data.path[0]
+
+        def lane_for(data):
+            return 'slow' if data.path[0] == 'slow' else None
+
+        with TestServer(handler, worker_count=2, slow_worker_count=1, slow_queue_size=1) as server:
+            pool = server.loop.pool
+            self.ae(len(pool.workers), 2), self.ae(len(pool.lane_workers), 1)
+            server.loop.handler = create_http_handler(handler, lane_for=lane_for)
+            slow = [server.connect() for i in range(3)]
+            for conn in slow[:2]:
+                conn.request('GET', '/slow')
+            st = monotonic()
+            while pool.queue_depth < 1 and monotonic() - st < 5:
+                time.sleep(0.01)
+            self.ae(pool.busy, 1)
+            # The slow lane is saturated
+            slow[2].request('GET', '/slow')
+            r = slow[2].getresponse()
+            self.ae(r.status, http_client.SERVICE_UNAVAILABLE)
+            self.ae(r.getheader('Retry-After'), '5')
+            r.read()
+            # Fast requests are not held up
+            conn = server.connect()
+            conn.request('GET', '/fast')
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK), self.ae(r.read(), b'fast')
+            block.set()
+            for conn in slow[:2]:
+                r = conn.getresponse()
+                self.ae(r.status, http_client.OK), self.ae(r.read(), b'slow')
+        self.ae(0, sum(int(w.is_alive()) for w in pool.workers))
+        # Without workers of their own, slow requests use the default workers
+        with TestServer(handler, worker_count=2, slow_worker_count=0) as server:
+            server.loop.handler = create_http_handler(handler, lane_for=lane_for)
+            self.ae(len(server.loop.pool.lane_workers), 0)
+            conn = server.connect()
+            conn.request('GET', '/slow')
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK), self.ae(r.read(), b'slow')
+
     def test_fallback_interface(self):
         'Test falling back to default interface'
         with TestServer(lambda data:(data.path[0] + data.read()), listen_on='1.1.1.1', fallback_to_detected_interface=True) as server:
@@ -126,6 +176,21 @@ def test_bonjour(self):
 
         self.assertTrue(b.stopped.wait(5), 'BonJour not stopped')
 
+    @skipIf(not hasattr(socket, 'SO_REUSEPORT'), 'SO_REUSEPORT not supported')
+    def test_reuse_port(self):
+        'Test that server loops in multiple processes can listen on the same port'
+        with TestServer(lambda data:(data.path[0] + data.read().decode('utf-8')), worker_processes=2) as server:
+            self.ae(server.loop.socket.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT), 1)
+            with TestServer(lambda data:(data.path[0] + data.read().decode('utf-8')), worker_processes=2, port=server.address[1]) as other:
+                self.ae(other.address, server.address)
+                for i in range(10):
+                    conn = server.connect()
+                    conn.request('GET', '/test', 'body')
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), b'testbody')
+                    conn.close()
+
     def test_dual_stack(self):
         from calibre.srv.loop import IPPROTO_IPV6
         with TestServer(lambda data:(data.path[0] + data.read().decode('utf-8')), listen_on='::') as server:
@@ -232,6 +297,47 @@ def test_socket_activation(self):
             self.ae(r.read(), b'testbody')
             self.ae(server.loop.bound_address[1], port)
 
+    @skipIf(iswindows, 'The select() based event loop used on Windows cannot handle many connections')
+    def test_many_idle_connections(self):
+        'Test holding thousands of idle keep-alive connections'
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        want = 5000 if hard == resource.RLIM_INFINITY else min(hard, 5000)
+        if soft < want:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+        try:
+            # Each connection uses a descriptor in both the client and the server
+            num = min(2000, (resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 200) // 2)
+            if num < 1100:
+                self.skipTest('Not enough file descriptors available')
+            with TestServer(lambda data:(data.path[0] + data.read().decode('utf-8')), timeout=60) as server:
+                conns = []
+                for i in range(num):
+                    conn = server.connect(timeout=10)
+                    conn.request('GET', '/test', str(i))
+                    r = conn.getresponse()
+                    self.ae(r.read(), f'test{i}'.encode())
+                    conns.append(conn)
+                self.ae(server.loop.num_active_connections, num)
+                # Requests on connections that were idle must be served, and
+                # quickly, with all the other connections still open
+                st = monotonic()
+                for i in range(0, num, 50):
+                    conns[i].request('GET', '/again', str(i))
+                    r = conns[i].getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), f'again{i}'.encode())
+                self.assertLess(monotonic() - st, 10)
+                self.ae(server.loop.num_active_connections, num)
+                for conn in conns:
+                    conn.close()
+                st = monotonic()
+                while server.loop.num_active_connections and monotonic() - st < 10:
+                    time.sleep(0.01)
+                self.ae(server.loop.num_active_connections, 0)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
     def test_monotonic(self):
         'Test the monotonic() clock'
         a = monotonic()
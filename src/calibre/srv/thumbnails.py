@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# License: GPL v3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Pre-generation of cover thumbnails for the content server. When enabled, a
+server plugin scales the covers of all books in all libraries to the
+configured thumbnail sizes, in worker processes, and stores the thumbnails in
+persistent, on disk, caches. Books whose covers change are re-scaled as the
+database reports the changes. Requests for thumbnails of these
+sizes are then served from the caches, without scaling the cover on the
+request thread.
+'''
+
+import os
+from itertools import count
+from queue import Empty, Queue
+from threading import Event, Lock
+
+from calibre.db.listeners import EventType
+from calibre.srv.metrics import metrics
+from calibre.utils.config_base import tweaks
+from calibre.utils.date import timestampfromdt
+from calibre.utils.filenames import ascii_filename
+
+# The number of covers sent to a worker process in a single job
+BATCH_SIZE = 16
+stores_lock = Lock()
+stores = {}
+
+
+def parse_thumbnail_sizes(raw):
+    ' Parse a comma separated list of sizes such as 60x80,100x150 '
+    ans = []
+    for part in (raw or '').split(','):
+        w, sep, h = part.strip().partition('x')
+        try:
+            size = int(w), int(h)
+        except Exception:
+            continue
+        if min(size) > 0 and size not in ans:
+            ans.append(size)
+    return tuple(ans)
+
+
+def thumbnail_store(library_id, width, height):
+    from calibre.db.utils import ThumbnailCache
+    key = library_id, width, height
+    with stores_lock:
+        ans = stores.get(key)
+        if ans is None:
+            ans = stores[key] = ThumbnailCache(
+                name=os.path.join('srv-thumbnails', ascii_filename(library_id), f'{width}x{height}'), thumbnail_size=(width, height))
+        return ans
+
+
+def is_fresh(timestamp, mtime):
+    # The cache stores timestamps with a precision of 0.01 seconds
+    return timestamp is not None and abs(timestamp - mtime) < 0.01
+
+
+def cached_thumbnail(opts, library_id, book_id, width, height, mtime):
+    ' Return the pre-generated thumbnail, if any, for a cover with the specified modification timestamp '
+    if not opts.pregenerate_thumbnails or (width, height) not in parse_thumbnail_sizes(opts.thumbnail_sizes):
+        return
+    store = thumbnail_store(library_id, width, height)
+    data, timestamp = store[book_id]
+    if not (data and is_fresh(timestamp, mtime)) and store.rescan(book_id):
+        # The thumbnail may have been generated by another server process
+        data, timestamp = store[book_id]
+    if data and is_fresh(timestamp, mtime):
+        metrics.inc('thumbnail_cache_hits')
+        return data
+    metrics.inc('thumbnail_cache_misses')
+
+
+def store_thumbnail(opts, library_id, book_id, width, height, mtime, data):
+    if opts.pregenerate_thumbnails and (width, height) in parse_thumbnail_sizes(opts.thumbnail_sizes):
+        thumbnail_store(library_id, width, height).insert(book_id, mtime, data)
+
+
+def scale_thumbnail(cdata, width, height):
+    from calibre.utils.img import scale_image
+    quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
+    return scale_image(cdata, width=width, height=height, compression_quality=quality)[-1]
+
+
+def scale_covers(covers, sizes):
+    ' Run in a worker process. Return a list of (book_id, mtime, {size: thumbnail}) for the specified covers '
+    ans = []
+    for book_id, mtime, cdata in covers:
+        try:
+            ans.append((book_id, mtime, {size: scale_thumbnail(cdata, *size) for size in sizes}))
+        except Exception:
+            import traceback
+            traceback.print_exc()
+    return ans
+
+
+class CoverChanges:
+
+    ''' Registered with the database as a cover cache, so that it is told about
+    every change to a cover, not only the ones that add or remove a cover,
+    which are the only ones that cause metadata_changed events. '''
+
+    def __init__(self, library_id, queue):
+        self.library_id, self.queue = library_id, queue
+
+    def invalidate(self, book_ids):
+        # Called with the database write lock held
+        self.queue.put((self.library_id, tuple(book_ids)))
+
+
+class ThumbnailPregenerator:
+
+    ''' A server plugin that keeps the thumbnail caches up to date. It scales
+    the covers of all books when the server starts and then the covers of
+    books as they are created or changed. '''
+
+    def __init__(self, library_broker, max_workers=None):
+        self.library_broker = library_broker
+        self.max_workers = max_workers or max(1, min(4, (os.cpu_count() or 2) // 2))
+        self.queue = Queue()
+        self.shutdown = Event()
+        self.started = Event()
+        # Set whenever the queue of books to process has been emptied
+        self.idle = Event()
+        # the db holds only a weak reference to listeners
+        self.db_listener = self.on_db_event
+        # Map of library id to CoverChanges
+        self.cover_changes = {}
+        self.pool = None
+        self.job_ids = count(1)
+        self.num_generated = 0
+
+    def start(self, loop):
+        self.opts = loop.opts
+        self.log = loop.log
+        self.sizes = parse_thumbnail_sizes(self.opts.thumbnail_sizes)
+        self.shutdown.clear()  # the embedded server re-uses its plugins when restarted
+        self.started.set()
+        if not self.sizes:
+            return
+        for library_id in self.library_broker.library_map:
+            self.queue.put((library_id, None))
+        while not self.shutdown.is_set():
+            try:
+                library_id, book_ids = self.queue.get(timeout=0.1)
+            except Empty:
+                self.idle.set()
+                continue
+            self.idle.clear()
+            try:
+                self.process(library_id, book_ids)
+            except Exception:
+                self.log.exception('Failed to generate thumbnails for library:', library_id)
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def stop(self):
+        self.shutdown.set()
+
+    def on_db_event(self, event_type, library_id, event_data):
+        if event_type is EventType.book_created:
+            self.queue.put((library_id, (event_data[0],)))
+        elif event_type is EventType.books_removed:
+            for width, height in self.sizes:
+                thumbnail_store(library_id, width, height).invalidate(event_data[0])
+
+    def process(self, library_id, book_ids):
+        db = self.library_broker.get(library_id)
+        if db is None:
+            return
+        db = db.new_api if hasattr(db, 'new_api') else db
+        if book_ids is None:
+            db.add_listener(self.db_listener, check_already_added=True)
+            cc = self.cover_changes.get(library_id)
+            if cc is None:
+                cc = self.cover_changes[library_id] = CoverChanges(library_id, self.queue)
+            db.add_cover_cache(cc)
+            book_ids = db.all_book_ids()
+        caches = {size: thumbnail_store(library_id, *size) for size in self.sizes}
+        batch = []
+        jobs = {}
+        for book_id in book_ids:
+            if self.shutdown.is_set():
+                return
+            mtime = db.cover_last_modified(book_id)
+            if mtime is None:
+                continue
+            mtime = timestampfromdt(mtime)
+            if all(is_fresh(s[book_id][1], mtime) for s in caches.values()):
+                continue
+            cdata = db.cover(book_id)
+            if cdata:
+                batch.append((book_id, mtime, cdata))
+            if len(batch) >= BATCH_SIZE:
+                self.submit(jobs, batch)
+                batch = []
+                while len(jobs) >= self.max_workers:
+                    self.collect(jobs, caches)
+        if batch:
+            self.submit(jobs, batch)
+        while jobs:
+            self.collect(jobs, caches)
+
+    def submit(self, jobs, batch):
+        if self.pool is None:
+            from calibre.utils.ipc.pool import Pool
+            self.pool = Pool(max_workers=self.max_workers, name='Thumbnails')
+        job_id = next(self.job_ids)
+        jobs[job_id] = batch
+        self.pool(job_id, 'calibre.srv.thumbnails', 'scale_covers', batch, self.sizes)
+
+    def collect(self, jobs, caches):
+        while not self.shutdown.is_set():
+            try:
+                wr = self.pool.results.get(timeout=0.1)
+            except Empty:
+                if self.pool.failed:
+                    # The result of the job that crashed its worker is never
+                    # put in the results queue
+                    self.pool_failed(jobs)
+                    return
+                continue
+            jobs.pop(wr.id, None)
+            if wr.is_terminal_failure:
+                self.pool_failed(jobs)
+                return
+            if wr.result.err:
+                self.log.error('Failed to generate thumbnails:', wr.result.err)
+                self.log.error(wr.result.traceback)
+                return
+            for book_id, mtime, thumbnails in wr.result.value:
+                for size, data in thumbnails.items():
+                    caches[size].insert(book_id, mtime, data)
+                self.num_generated += 1
+            return
+        jobs.clear()
+
+    def pool_failed(self, jobs):
+        # A pool cannot be used after one of its workers crashes. The books in
+        # the batches it did not finish are skipped, rather than risk crashing
+        # again, they are processed the next time the server starts. Later
+        # batches are processed by a new pool.
+        self.log.error('Thumbnail worker process failed:', self.pool.terminal_failure)
+        self.log.error('Skipping thumbnails for {} books'.format(sum(map(len, jobs.values()))))
+        jobs.clear()
+        self.pool.shutdown()
+        self.pool = None
@@ -7,14 +7,18 @@
 import errno
 import os
 import socket
+from collections.abc import Iterator
 from email.utils import formatdate
+from io import DEFAULT_BUFFER_SIZE
 from operator import itemgetter
 
 from calibre import prints
 from calibre.constants import iswindows
+from calibre.ptempfile import SpooledTemporaryFile
 from calibre.srv.errors import HTTPNotFound
 from calibre.utils.localization import get_translator
 from calibre.utils.logging import ThreadSafeLog
+from calibre.utils.serialize import json_dumps
 from calibre.utils.shared_file import share_open
 from calibre.utils.socket_inheritance import set_socket_inherit
 from polyglot import reprlib
@@ -28,6 +32,11 @@
 HTTP1  = 'HTTP/1.0'
 HTTP11 = 'HTTP/1.1'
 DESIRED_SEND_BUFFER_SIZE = 16 * 1024  # windows 7 uses an 8KB sndbuf
+# Responses larger than this are spooled to a temporary file instead of being
+# held in memory
+MAX_IN_MEMORY_RESPONSE_SIZE = 1024 * 1024
+# Long JSON arrays are serialized this many items at a time
+JSON_ARRAY_SLICE = 1024
 encode_name, decode_name
 
 
@@ -418,6 +427,58 @@ def getvalue(self):
 # }}}
 
 
+def json_pieces(obj):  # {{{
+    if isinstance(obj, Iterator) or (isinstance(obj, dict) and any(isinstance(v, Iterator) for v in obj.values())):
+        yield b'{'
+        for i, (key, val) in enumerate(obj.items() if isinstance(obj, dict) else obj):
+            yield (b', ' if i else b'') + json_dumps(key if isinstance(key, str) else str(key)) + b': '
+            yield from json_pieces(val)
+        yield b'}'
+    elif isinstance(obj, (list, tuple)) and len(obj) > JSON_ARRAY_SLICE:
+        yield b'['
+        for i in range(0, len(obj), JSON_ARRAY_SLICE):
+            yield (b', ' if i else b'') + json_dumps(list(obj[i:i+JSON_ARRAY_SLICE]))[1:-1]
+        yield b']'
+    else:
+        yield json_dumps(obj)
+
+
+def iterjson(obj, chunk_size=DEFAULT_BUFFER_SIZE):
+    ''' Serialize obj as UTF-8 encoded JSON, yielding chunks of about
+    chunk_size bytes. Iterators, such as generators, in obj, either obj
+    itself or values in its dicts, must yield (key, value) pairs and are
+    serialized as JSON objects, one pair at a time, so that the full object
+    never has to be in memory. '''
+    buf, size = [], 0
+    for piece in json_pieces(obj):
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b''.join(buf)
+
+
+def spooled_output(write, max_size=MAX_IN_MEMORY_RESPONSE_SIZE):
+    ''' Generate a response by calling write() with a file object. The
+    response is returned as bytes if it is no larger than max_size, otherwise
+    it is returned as a temporary file, positioned at its start. '''
+    buf = SpooledTemporaryFile(prefix='srv-response-', max_size=max_size)
+    try:
+        write(buf)
+    except BaseException:
+        buf.close()
+        raise
+    if buf.tell() <= max_size:
+        buf.seek(0)
+        return buf.read()
+    buf.flush()
+    buf.seek(0)
+    return buf
+# }}}
+
+
 def get_db(ctx, rd, library_id):
     db = ctx.get_library(rd, library_id)
     if db is None:
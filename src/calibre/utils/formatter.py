@@ -12,6 +12,7 @@
 import string
 import traceback
 from collections import OrderedDict
+from contextlib import suppress
 from functools import partial
 from math import modf
 from sys import exc_info
@@ -967,7 +968,7 @@ def error(self, message, line_number):
         raise ValueError(m)
 
     def program(self, funcs, parent, prog, val, is_call=False, args=None,
-                global_vars=None, break_reporter=None):
+                global_vars=None, break_reporter=None, compiled=None):
         self.parent = parent
         self.parent_kwargs = parent.kwargs
         self.parent_book = parent.book
@@ -986,6 +987,8 @@ def program(self, funcs, parent, prog, val, is_call=False, args=None,
             if is_call:
                 # prog is an instance of the function definition class
                 ret =  self.do_node_stored_template_call(StoredTemplateCallNode(1, prog.name, prog, None), args=args)
+            elif compiled is not None and self.break_reporter is None:
+                ret = compiled(self)
             else:
                 ret = self.expression_list(prog)
         except ReturnExecuted as e:
@@ -1582,6 +1585,388 @@ def expr(self, prog):
                        prog.line_number)
 
 
+# The number of templates without a column name, such as the templates in
+# searches, that are kept in a template cache
+MAX_CACHED_TEMPLATES_WITHOUT_COLUMN = 128
+
+
+class CompiledTemplate:
+    '''
+    A parsed General Program Mode template, along with the closure it is
+    compiled to, see :class:`_Compiler`. These are stored in the template
+    caches passed to :meth:`TemplateFormatter.safe_format`.
+    '''
+
+    __slots__ = ('text', 'tree', '_func')
+
+    def __init__(self, text, tree):
+        self.text = text
+        self.tree = tree
+        self._func = None
+
+    @property
+    def func(self):
+        if self._func is None:
+            self._func = _Compiler().compile_list(self.tree)
+        return self._func
+
+
+class _Compiler:
+    '''
+    Turns the tree produced by :class:`_Parser` into nested closures that take
+    the :class:`_Interpreter` as their only argument and use it to hold the
+    state of the evaluation (locals, book, formatter functions, etc.). This
+    avoids dispatching on the node type and looking up node attributes every
+    time a template is evaluated, which matters as the same template is
+    typically evaluated for every book in the library.
+
+    The closures behave exactly like the corresponding do_node_*() methods of
+    the interpreter, including the errors raised. They do not support the
+    break reporter used by the template tester, the interpreter is used for
+    that. Rarely used nodes are evaluated by the interpreter as well.
+    '''
+
+    def compile(self, node):
+        if isinstance(node, list):
+            return self.compile_list(node)
+        meth = self.NODE_COMPILERS.get(node.node_type)
+        if meth is None:
+            return self.interpreted(node)
+        func, needs_guard = meth(self, node)
+        return self.guarded(node, func) if needs_guard else func
+
+    def compile_list(self, nodes):
+        funcs = tuple(map(self.compile, nodes))
+
+        def expression_list(ip):
+            val = ''
+            try:
+                for f in funcs:
+                    val = f(ip)
+            except (BreakExecuted, ContinueExecuted) as e:
+                e.set_value(val)
+                raise e
+            return val
+        return expression_list
+
+    def guarded(self, node, func):
+        # The equivalent of _Interpreter.expr()
+        line_number = node.line_number
+
+        def guard(ip):
+            try:
+                return func(ip)
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                if (DEBUG):
+                    traceback.print_exc()
+                ip.error(_("Internal error evaluating an expression: '{0}'").format(str(e)), line_number)
+        return guard
+
+    def interpreted(self, node):
+        return lambda ip: ip.expr(node)
+
+    def compile_if(self, node):
+        condition = self.compile(node.condition)
+        then_part = self.compile_list(node.then_part)
+        else_part = self.compile_list(node.else_part) if node.else_part else None
+
+        def if_node(ip):
+            if condition(ip):
+                return then_part(ip)
+            elif else_part is not None:
+                return else_part(ip)
+            return ''
+        return if_node, True
+
+    def compile_for(self, node):
+        line_number = node.line_number
+        separator_expr = None if node.separator is None else self.compile(node.separator)
+        v = node.variable
+        list_field_expr = self.compile(node.list_field_expr)
+        block = self.compile_list(node.block)
+
+        def for_node(ip):
+            try:
+                separator = ',' if separator_expr is None else separator_expr(ip)
+                f = list_field_expr(ip)
+                res = getattr(ip.parent_book, f, f)
+                if res is not None:
+                    if isinstance(res, str):
+                        res = [r.strip() for r in res.split(separator) if r.strip()]
+                    ret = ''
+                    try:
+                        for x in res:
+                            try:
+                                ip.locals[v] = x
+                                ret = block(ip)
+                            except ContinueExecuted as e:
+                                ret = e.get_value()
+                    except BreakExecuted as e:
+                        ret = e.get_value()
+                return ret
+            except (StopException, ValueError, ReturnExecuted) as e:
+                raise e
+            except Exception as e:
+                ip.error(_("Unhandled exception '{0}'").format(e), line_number)
+        return for_node, True
+
+    def compile_rvalue(self, node):
+        name, line_number = node.name, node.line_number
+
+        def rvalue(ip):
+            try:
+                return ip.locals[name]
+            except:
+                ip.error(_("Unknown identifier '{0}'").format(name), line_number)
+        return rvalue, False
+
+    def compile_func(self, node):
+        args = tuple(map(self.compile, node.expression_list))
+        id_ = node.name.strip()
+
+        def func(ip):
+            vals = [a(ip) for a in args]
+            return ip.funcs[id_].eval_(ip.parent, ip.parent_kwargs, ip.parent_book, ip.locals, *vals)
+        return func, True
+
+    def compile_constant(self, node):
+        value = node.value
+        return (lambda ip: value), False
+
+    def compile_field(self, node):
+        expression, line_number = self.compile(node.expression), node.line_number
+
+        def field(ip):
+            try:
+                name = expression(ip)
+                try:
+                    return ip.parent.get_value(name, [], ip.parent_kwargs)
+                except StopException:
+                    raise
+                except:
+                    ip.error(_("Unknown field '{0}'").format(name), line_number)
+            except (StopException, ValueError):
+                raise
+            except:
+                ip.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return field, True
+
+    def compile_raw_field(self, node):
+        expression, line_number = self.compile(node.expression), node.line_number
+        default = None if node.default is None else self.compile(node.default)
+
+        def raw_field(ip):
+            try:
+                name = field_metadata.search_term_to_field_key(expression(ip))
+                res = getattr(ip.parent_book, name, None)
+                if res is None and default is not None:
+                    return default(ip)
+                if res is not None:
+                    if isinstance(res, list):
+                        fm = ip.parent_book.metadata_for_field(name)
+                        if fm is None:
+                            res = ', '.join(res)
+                        else:
+                            res = fm['is_multiple']['list_to_ui'].join(res)
+                    else:
+                        res = str(res)
+                else:
+                    res = str(res)  # Should be the string "None"
+                return res
+            except (StopException, ValueError) as e:
+                raise e
+            except:
+                ip.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return raw_field, True
+
+    def compile_assign(self, node):
+        left, right = node.left, self.compile(node.right)
+
+        def assign(ip):
+            t = ip.locals[left] = right(ip)
+            return t
+        return assign, True
+
+    def compile_first_non_empty(self, node):
+        exprs = tuple(map(self.compile, node.expression_list))
+
+        def first_non_empty(ip):
+            for expr in exprs:
+                v = expr(ip)
+                if v:
+                    return v
+            return ''
+        return first_non_empty, True
+
+    def compile_switch(self, node):
+        exprs = tuple(map(self.compile, node.expression_list))
+        value, default = exprs[0], exprs[-1]
+        cases = tuple((exprs[i], exprs[i+1]) for i in range(1, len(exprs)-1, 2))
+
+        def switch(ip):
+            val = value(ip)
+            for pat, res in cases:
+                if re.search(pat(ip), val, flags=re.I):
+                    return res(ip)
+            return default(ip)
+        return switch, True
+
+    def compile_switch_if(self, node):
+        exprs = tuple(map(self.compile, node.expression_list))
+        cases = tuple((exprs[i], exprs[i+1]) for i in range(0, len(exprs)-1, 2))
+        default = exprs[-1]
+
+        def switch_if(ip):
+            for tst, res in cases:
+                if tst(ip):
+                    return res(ip)
+            return default(ip)
+        return switch_if, True
+
+    def compile_strcat(self, node):
+        exprs = tuple(map(self.compile, node.expression_list))
+        return (lambda ip: ''.join([expr(ip) for expr in exprs])), True
+
+    def compile_break(self, node):
+        def break_node(ip):
+            raise BreakExecuted()
+        return break_node, True
+
+    def compile_continue(self, node):
+        def continue_node(ip):
+            raise ContinueExecuted()
+        return continue_node, True
+
+    def compile_return(self, node):
+        expr = self.compile(node.expr)
+
+        def return_node(ip):
+            e = ReturnExecuted()
+            e.set_value(expr(ip))
+            raise e
+        return return_node, True
+
+    def compile_contains(self, node):
+        value = self.compile(node.value_expression)
+        test = self.compile(node.test_expression)
+        match = self.compile(node.match_expression)
+        not_match = self.compile(node.not_match_expression)
+
+        def contains(ip):
+            v = value(ip)
+            if re.search(test(ip), v, flags=re.I):
+                return match(ip)
+            return not_match(ip)
+        return contains, True
+
+    def operator_error(self, msg, node):
+        # Compile an operator node whose evaluation, like in the interpreter,
+        # turns all unexpected exceptions into an error with msg
+        line_number, operator = node.line_number, node.operator
+
+        def wrap(func):
+            def operator_node(ip):
+                try:
+                    return func(ip)
+                except (StopException, ValueError) as e:
+                    raise e
+                except:
+                    ip.error(msg.format(operator), line_number)
+            return operator_node, False
+        return wrap
+
+    def compile_string_infix(self, node):
+        op = _Interpreter.INFIX_STRING_COMPARE_OPS[node.operator]
+        left, right = self.compile(node.left), self.compile(node.right)
+        return self.operator_error(_("Error during string comparison: operator '{0}'"), node)(
+            lambda ip: '1' if op(left(ip), right(ip)) else '')
+
+    def compile_numeric_infix(self, node):
+        op = _Interpreter.INFIX_NUMERIC_COMPARE_OPS[node.operator]
+        left, right = self.compile(node.left), self.compile(node.right)
+        fdn = _Interpreter.float_deal_with_none
+        return self.operator_error(_("Value used in comparison is not a number: operator '{0}'"), node)(
+            lambda ip: '1' if op(fdn(ip, left(ip)), fdn(ip, right(ip))) else '')
+
+    def compile_logop(self, node):
+        left, right = self.compile(node.left), self.compile(node.right)
+        if node.operator == 'and':
+            func = lambda ip: '1' if left(ip) and right(ip) else ''  # noqa
+        else:
+            func = lambda ip: '1' if left(ip) or right(ip) else ''  # noqa
+        return self.operator_error(_("Error during operator evaluation: operator '{0}'"), node)(func)
+
+    def compile_logop_unary(self, node):
+        op = _Interpreter.LOGICAL_UNARY_OPS[node.operator]
+        expr = self.compile(node.expr)
+        return self.operator_error(_("Error during operator evaluation: operator '{0}'"), node)(
+            lambda ip: '1' if op(expr(ip)) else '')
+
+    def compile_binary_arithop(self, node):
+        op = _Interpreter.ARITHMETIC_BINARY_OPS[node.operator]
+        left, right = self.compile(node.left), self.compile(node.right)
+        fdn = _Interpreter.float_deal_with_none
+
+        def binary_arithop(ip):
+            answer = op(fdn(ip, left(ip)), fdn(ip, right(ip)))
+            return str(answer if modf(answer)[0] != 0 else int(answer))
+        return self.operator_error(_("Error during operator evaluation: operator '{0}'"), node)(binary_arithop)
+
+    def compile_unary_arithop(self, node):
+        op = _Interpreter.ARITHMETIC_UNARY_OPS[node.operator]
+        expr = self.compile(node.expr)
+
+        def unary_arithop(ip):
+            answer = op(float(expr(ip)))
+            return str(answer if modf(answer)[0] != 0 else int(answer))
+        return self.operator_error(_("Error during operator evaluation: operator '{0}'"), node)(unary_arithop)
+
+    def compile_stringops(self, node):
+        left, right = self.compile(node.left), self.compile(node.right)
+        return self.operator_error(_("Error during operator evaluation: operator '{0}'"), node)(
+            lambda ip: left(ip) + right(ip))
+
+    def compile_character(self, node):
+        expression, line_number = self.compile(node.expression), node.line_number
+
+        def character(ip):
+            key = expression(ip)
+            ret = _Interpreter.characters.get(key, None)
+            if ret is None:
+                ip.error(_("Function {0}: invalid character name '{1}").format('character', key), line_number)
+            return ret
+        return character, True
+
+    NODE_COMPILERS = {
+        Node.NODE_IF:                    compile_if,
+        Node.NODE_ASSIGN:                compile_assign,
+        Node.NODE_CONSTANT:              compile_constant,
+        Node.NODE_RVALUE:                compile_rvalue,
+        Node.NODE_FUNC:                  compile_func,
+        Node.NODE_FIELD:                 compile_field,
+        Node.NODE_RAW_FIELD:             compile_raw_field,
+        Node.NODE_COMPARE_STRING:        compile_string_infix,
+        Node.NODE_COMPARE_NUMERIC:       compile_numeric_infix,
+        Node.NODE_FIRST_NON_EMPTY:       compile_first_non_empty,
+        Node.NODE_SWITCH:                compile_switch,
+        Node.NODE_SWITCH_IF:             compile_switch_if,
+        Node.NODE_FOR:                   compile_for,
+        Node.NODE_CONTAINS:              compile_contains,
+        Node.NODE_BINARY_LOGOP:          compile_logop,
+        Node.NODE_UNARY_LOGOP:           compile_logop_unary,
+        Node.NODE_BINARY_ARITHOP:        compile_binary_arithop,
+        Node.NODE_UNARY_ARITHOP:         compile_unary_arithop,
+        Node.NODE_BREAK:                 compile_break,
+        Node.NODE_CONTINUE:              compile_continue,
+        Node.NODE_RETURN:                compile_return,
+        Node.NODE_CHARACTER:             compile_character,
+        Node.NODE_STRCAT:                compile_strcat,
+        Node.NODE_BINARY_STRINGOP:       compile_stringops,
+    }
+
+
 class TemplateFormatter(string.Formatter):
     '''
     Provides a format function that substitutes '' for any missing value
@@ -1589,6 +1974,10 @@ class TemplateFormatter(string.Formatter):
 
     _validation_string = 'This Is Some Text THAT SHOULD be LONG Enough.%^&*'
 
+    # Evaluate cached General Program Mode templates using closures instead of
+    # walking the parse tree, see _Compiler
+    compile_templates = True
+
     # Dict to do recursion detection. It is up to the individual get_value
     # method to use it. It is cleared when starting to format a template
     composite_values = {}
@@ -1676,15 +2065,34 @@ def _explode_format_string(self, fmt):
         ], flags=re.DOTALL)
 
     def _eval_program(self, val, prog, column_name, global_vars, break_reporter):
-        if column_name is not None and self.template_cache is not None:
-            tree = self.template_cache.get(column_name, None)
-            if not tree:
-                tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
-                self.template_cache[column_name] = tree
+        if self.template_cache is not None:
+            if column_name is None:
+                # Templates without a column name, such as those in searches,
+                # are cached by their text, in a size limited LRU cache
+                cache = self.template_cache.get('program:')
+                if cache is None:
+                    cache = self.template_cache['program:'] = OrderedDict()
+                key = prog
+            else:
+                cache, key = self.template_cache, column_name
+            compiled = cache.get(key, None)
+            if compiled is None or compiled.text != prog:
+                compiled = CompiledTemplate(prog, self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog)))
+                cache[key] = compiled
+                if column_name is None:
+                    while len(cache) > MAX_CACHED_TEMPLATES_WITHOUT_COLUMN:
+                        with suppress(KeyError):
+                            cache.popitem(last=False)
+            elif column_name is None:
+                with suppress(KeyError):
+                    cache.move_to_end(key)
+            tree = compiled.tree
+            func = compiled.func if self.compile_templates and break_reporter is None else None
         else:
             tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
+            func = None
         return self.gpm_interpreter.program(self.funcs, self, tree, val,
-                                global_vars=global_vars, break_reporter=break_reporter)
+                                global_vars=global_vars, break_reporter=break_reporter, compiled=func)
 
     def _eval_sfm_call(self, template_name, args, global_vars):
         func = self.funcs[template_name]